@@ -41,6 +41,8 @@ class RecordChartDataProvider():
         self.t_minus = t_minus
         self.thread = threading.Thread(target=self.update)
         self.record = Record.load(self.root_dir)
+        self.rates = None
+        self.rates_ohlcv = None
 
     def initialize(self):
         self.thread.start()
@@ -54,23 +56,31 @@ class RecordChartDataProvider():
     def get_config(self):
         return self.record.config
 
+    def get_start_idx(self):
+        return max(len(self.record.ohlcv) - abs(self.t_minus), 0)
+
+    def get_rates(self):
+        """Cross rates of the record's ohlcv, rebuilt when it reloads"""
+        ohlcv = self.record.ohlcv
+        if self.rates is None or self.rates_ohlcv is not ohlcv:
+            self.rates = ohlcv_feed.CrossRates(ohlcv)
+            self.rates_ohlcv = ohlcv
+        return self.rates
+
     def get_ohlcv(self, cash_coin=None):
-        if abs(self.t_minus) >= len(self.record.ohlcv):
-            data = ohlcv_feed.OHLCVData(self.record.ohlcv.copy())
-        else:
-            data = ohlcv_feed.OHLCVData(
-                self.record.ohlcv.iloc[-self.t_minus:].copy())
+        start = self.get_start_idx()
+        data = ohlcv_feed.OHLCVData(self.record.ohlcv.iloc[start:].copy())
         if cash_coin is None or cash_coin == self.record.portfolio.cash_currency:
             return data
-        assets = self.get_assets()
-        ex_ids = self.get_exchange_ids()
-        for ex_id in ex_ids:
-            for asset in assets:
-                for field in ['open','high','low','close']:
-                    col_name = ohlcv_feed.get_col_name(field, asset.symbol, ex_id)
-                    cash_value = ohlcv_feed.get_cash_value(
-                        data.ohlcv_df, field, asset, ex_id, cash_coin)
-                    data.ohlcv_df[col_name] = cash_value
+        rates = self.get_rates()
+        for col_name in data.columns:
+            if col_name in ['epoch', 'utc']:
+                continue
+            field, symbol, ex_id = col_name.split('_')
+            if field in ohlcv_feed.CrossRates.FIELDS:
+                cash_value = rates.cash_value(
+                    field, Asset.from_symbol(symbol), ex_id, cash_coin)
+                data.ohlcv_df[col_name] = cash_value[start:]
         return data
 
     def get_assets(self, exchange_id=None):
@@ -119,8 +129,8 @@ class RecordChartDataProvider():
     def get_pnl(self, quote_coin, ex_id):
         periods = self.record.portfolio.perf.periods
         cash_currency = self.record.portfolio.cash_currency
-        ex_rates = ohlcv_feed.get_exchange_rate(
-            self.get_ohlcv().df, cash_currency, quote_coin, ex_id)
+        ex_rates = self.get_rates().rate(
+            cash_currency, quote_coin, ex_id)[self.get_start_idx():]
         df = pd.DataFrame([
             [p['end_time'], p['pnl']] for p in periods
         ], columns=['utc','pnl'])
@@ -130,8 +140,8 @@ class RecordChartDataProvider():
     def get_returns(self, quote_coin, ex_id):
         periods = self.record.portfolio.perf.periods
         cash_currency = self.record.portfolio.cash_currency
-        ex_rates = ohlcv_feed.get_exchange_rate(
-            self.get_ohlcv().df, cash_currency, quote_coin, ex_id)
+        ex_rates = self.get_rates().rate(
+            cash_currency, quote_coin, ex_id)[self.get_start_idx():]
         start_cash = self.record.portfolio.starting_cash * ex_rates[0]
         df = pd.DataFrame([
             [p['end_time'], p['pnl']] for p in periods],
@@ -7,8 +7,11 @@ TEST = 'tst'
 
 # File extensions
 JSON = '.json'
+JSONL = '.jsonl'
 BCOLZ = '.bc'
 CSV = '.csv'
+NPZ = '.npz'
+TEA = '.tea'
 
 # PyTorch
 MODEL_EXT = '.mdl'
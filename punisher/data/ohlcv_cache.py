@@ -0,0 +1,120 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import punisher.constants as c
+from punisher.utils.dates import epochs_to_utc
+
+"""
+Binary columnar cache for the OHLCV csv files named by
+`ohlcv_feed.get_ohlcv_fpath`. Each csv gets a sibling .npz holding the
+int64 epoch index, the column names and one float64 array per column.
+
+The csv stays the source of record (fetchers, S3, notebooks). The cache
+remembers the mtime/size of the csv it was built from and is rebuilt
+whenever the csv changes, so files written or appended to by other tools
+are converted transparently on the next load.
+"""
+
+EPOCH = 'epoch'
+COLUMNS = 'columns'
+DATA = 'data'
+SOURCE = 'source'
+
+
+def get_cache_fpath(fpath):
+    return Path(fpath).with_suffix(c.NPZ)
+
+def get_source_stamp(fpath):
+    if not os.path.exists(fpath):
+        return np.array([-1, -1], dtype=np.int64)
+    stat = os.stat(fpath)
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+def get_stamp(fpath):
+    """Identifies the current contents of an OHLCV file (csv, else cache)"""
+    if os.path.exists(fpath):
+        return get_source_stamp(fpath)
+    return get_source_stamp(get_cache_fpath(fpath))
+
+def load_source(fpath):
+    """Stamp of the source the cache was built from, None if unknown"""
+    cache_fpath = get_cache_fpath(fpath)
+    if not os.path.exists(cache_fpath):
+        return None
+    with np.load(cache_fpath) as npz:
+        if SOURCE not in npz.files:
+            return None
+        return npz[SOURCE]
+
+def is_fresh(fpath, source=None):
+    """
+    True if the cache was built from the current csv at `fpath`,
+    or from `source` when the cache is derived from another file
+    """
+    stamp = load_source(fpath)
+    if stamp is None:
+        return False
+    if source is None:
+        if not os.path.exists(fpath):
+            return True
+        source = get_source_stamp(fpath)
+    return bool(np.array_equal(stamp, source))
+
+def exists(fpath):
+    return os.path.exists(fpath) or os.path.exists(get_cache_fpath(fpath))
+
+def save(df, fpath, source=None):
+    """Writes the epoch indexed OHLCV frame next to `fpath`"""
+    if source is None:
+        source = get_source_stamp(fpath)
+    cache_fpath = get_cache_fpath(fpath)
+    tmp_fpath = Path(str(cache_fpath) + '.tmp')
+    columns = [col for col in df.columns if col != 'utc']
+    with open(tmp_fpath, 'wb') as f:
+        np.savez(
+            f,
+            epoch=df.index.values.astype(np.int64),
+            columns=np.array(columns, dtype=str),
+            source=source,
+            # One contiguous row per column
+            data=np.ascontiguousarray(
+                df[columns].to_numpy(dtype=np.float64).T)
+        )
+    os.replace(tmp_fpath, cache_fpath)
+    return cache_fpath
+
+def load(fpath):
+    with np.load(get_cache_fpath(fpath)) as npz:
+        epochs = npz[EPOCH]
+        columns = npz[COLUMNS]
+        data = npz[DATA]
+    df = pd.DataFrame(
+        {str(col): values for col, values in zip(columns, data)},
+        index=pd.Index(epochs, name=EPOCH))
+    df['utc'] = epochs_to_utc(epochs)
+    return df
+
+def read_csv(fpath):
+    """
+    Reads an OHLCV csv without parsing the utc strings,
+    the utc column is rebuilt from the epoch index instead.
+    Rows appended for an epoch already in the file replace it
+    """
+    df = pd.read_csv(fpath, index_col=EPOCH)
+    if 'utc' in df.columns:
+        df.drop('utc', axis=1, inplace=True)
+    df.index = df.index.astype(np.int64)
+    df = df[~df.index.duplicated(keep='last')]
+    df['utc'] = epochs_to_utc(df.index.values)
+    return df
+
+def load_or_convert(fpath):
+    """Loads the cache, converting the csv first if it is stale"""
+    if is_fresh(fpath):
+        return load(fpath)
+    df = read_csv(fpath)
+    save(df, fpath)
+    return df
@@ -70,6 +70,36 @@ class FileStore(DataStore):
         fpath = self.get_fpath(name, c.JSON)
         return files.load_json(fpath)
 
+    def csv_header(self, name):
+        """Column names of the csv (index first), None if it doesn't exist"""
+        fpath = self.get_fpath(name, c.CSV)
+        if not os.path.exists(fpath):
+            return None
+        return list(pd.read_csv(fpath, nrows=0).columns)
+
+    def append_df_to_csv(self, df, name):
+        fpath = self.get_fpath(name, c.CSV)
+        header = not os.path.exists(fpath)
+        df.to_csv(fpath, index=True, mode='a', header=header)
+
+    def append_json_lines(self, name, dcts):
+        fpath = self.get_fpath(name, c.JSONL)
+        files.append_json_lines(fpath, dcts)
+
+    def load_json_lines(self, name):
+        fpath = self.get_fpath(name, c.JSONL)
+        if not os.path.exists(fpath):
+            return []
+        return files.load_json_lines(fpath)
+
+    def exists(self, name, file_ext):
+        return os.path.exists(self.get_fpath(name, file_ext))
+
+    def delete(self, name, file_ext):
+        fpath = self.get_fpath(name, file_ext)
+        if os.path.exists(fpath):
+            os.remove(fpath)
+
     def get_date_cols(self, columns):
         return [
             col for col in columns
@@ -89,7 +119,7 @@ class FileStore(DataStore):
 
 
 FILE_STORE = 'FILE_STORE'
-TIMESCALE_STORE = 'FILE_STORE'
+TIMESCALE_STORE = 'TIMESCALE_STORE'
 
 DATA_STORES = {
     FILE_STORE: FileStore,
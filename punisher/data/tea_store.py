@@ -0,0 +1,173 @@
+import os
+from pathlib import Path
+
+import numpy as np
+from numpy.lib import recfunctions
+
+import punisher.config as cfg
+import punisher.constants as c
+from punisher.utils.dates import utc_to_epoch
+from punisher.utils.teafiles import TeaFile
+from punisher.utils.teafiles.teafile import FieldType
+
+"""
+OHLCV storage backed by the bundled TeaFile format
+One file per exchange/asset/timeframe. Items are
+    Time (int64, java time = epoch milliseconds), Open, High, Low, Close, Volume
+
+Files are read through np.memmap as read-only structured arrays, so
+backtest processes reading the same history share the OS page cache
+instead of each holding a private pandas copy.
+
+http://discretelogics.com/teafiles/
+"""
+
+TIME = 'Time'
+FIELD_NAMES = [TIME, 'Open', 'High', 'Low', 'Close', 'Volume']
+FIELD_FORMAT = 'qddddd'
+OHLCV_DTYPE = np.dtype([
+    (TIME, '<i8'), ('Open', '<f8'), ('High', '<f8'),
+    ('Low', '<f8'), ('Close', '<f8'), ('Volume', '<f8'),
+])
+MS_PER_SEC = 1000
+
+
+def get_tea_fname(asset, exchange_id, timeframe):
+    fname = '{:s}_{:s}_{:s}{:s}'.format(
+        exchange_id, asset.id, timeframe.id, c.TEA)
+    return fname
+
+def make_records(epochs, open_, high, low, close, volume):
+    """Packs OHLCV columns (epoch seconds) into TeaFile items"""
+    records = np.empty(len(epochs), dtype=OHLCV_DTYPE)
+    records[TIME] = np.asarray(epochs, dtype=np.int64) * MS_PER_SEC
+    records['Open'] = open_
+    records['High'] = high
+    records['Low'] = low
+    records['Close'] = close
+    records['Volume'] = volume
+    return records
+
+def get_epochs(records):
+    return records[TIME] // MS_PER_SEC
+
+def get_values(records):
+    """(n_items, 5) float64 OHLCV view over the records, strided not copied"""
+    return recfunctions.structured_to_unstructured(
+        records[FIELD_NAMES[1:]], copy=False)
+
+def read_layout(fpath):
+    """Returns (itemareastart, itemsize) after checking the item layout"""
+    with TeaFile.openread(str(fpath)) as tf:
+        fields = tf.description.itemdescription.fields
+        layout = [
+            (f.name, FieldType.getformatcharacter(f.fieldtype), f.offset)
+            for f in fields
+        ]
+        expected = [
+            (name, fmt, OHLCV_DTYPE.fields[name][1])
+            for name, fmt in zip(FIELD_NAMES, FIELD_FORMAT)
+        ]
+        if layout != expected or tf.itemsize != OHLCV_DTYPE.itemsize:
+            raise Exception("Not an OHLCV TeaFile: {:s} {}".format(
+                str(fpath), layout))
+        return tf.itemareastart, tf.itemsize
+
+
+class OHLCVTeaStore():
+    def __init__(self, root=cfg.DATA_DIR):
+        self.root = root
+        self._maps = {}
+        self.initialize()
+
+    def initialize(self):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+    def get_fpath(self, ex_id, asset, timeframe):
+        return Path(self.root, get_tea_fname(asset, ex_id, timeframe))
+
+    def exists(self, ex_id, asset, timeframe):
+        return os.path.exists(self.get_fpath(ex_id, asset, timeframe))
+
+    def save(self, ex_id, asset, timeframe, records):
+        """Writes a new file, replacing any existing one atomically"""
+        fpath = self.get_fpath(ex_id, asset, timeframe)
+        tmp_fpath = Path(str(fpath) + '.tmp')
+        records = np.sort(records, order=TIME)
+        desc = '{:s} {:s} {:s}'.format(ex_id, asset.symbol, timeframe.id)
+        tf = TeaFile.create(str(tmp_fpath), FIELD_NAMES, FIELD_FORMAT, desc)
+        try:
+            tf.file.write(records.tobytes())
+        finally:
+            tf.close()
+        os.replace(tmp_fpath, fpath)
+        self._maps.pop(str(fpath), None)
+        return fpath
+
+    def append(self, ex_id, asset, timeframe, records):
+        """
+        Appends items newer than the last stored Time, returns how many
+        An item with the last stored Time replaces it in place (the bar
+        was stored while still forming), older items are never rewritten
+        """
+        if not self.exists(ex_id, asset, timeframe):
+            self.save(ex_id, asset, timeframe, records)
+            return len(records)
+        records = np.sort(records, order=TIME)
+        stored = self.read(ex_id, asset, timeframe)
+        fpath = self.get_fpath(ex_id, asset, timeframe)
+        if len(stored) > 0:
+            last_time = stored[TIME][-1]
+            last = records[records[TIME] == last_time]
+            if len(last) > 0:
+                with open(fpath, 'r+b') as f:
+                    f.seek(os.path.getsize(fpath) - OHLCV_DTYPE.itemsize)
+                    f.write(last[-1:].tobytes())
+            records = records[records[TIME] > last_time]
+        if len(records) > 0:
+            with open(fpath, 'ab') as f:
+                f.write(records.tobytes())
+        return len(records)
+
+    def read(self, ex_id, asset, timeframe):
+        """Returns all items as a read-only memory mapped structured array"""
+        fpath = str(self.get_fpath(ex_id, asset, timeframe))
+        size = os.path.getsize(fpath)
+        cached = self._maps.get(fpath)
+        if cached is not None and cached[0] == size:
+            return cached[1]
+        itemareastart, itemsize = read_layout(fpath)
+        n_items = (size - itemareastart) // itemsize
+        if n_items == 0:
+            records = np.empty(0, dtype=OHLCV_DTYPE)
+        else:
+            records = np.memmap(
+                fpath, dtype=OHLCV_DTYPE, mode='r',
+                offset=itemareastart, shape=(n_items,))
+        self._maps[fpath] = (size, records)
+        return records
+
+    def range(self, ex_id, asset, timeframe, start=None, end=None):
+        """
+        Items with start <= Time < end (utc datetimes)
+        Binary search on Time, returns a view into the memmap
+        """
+        records = self.read(ex_id, asset, timeframe)
+        times = records[TIME]
+        lo, hi = 0, len(records)
+        if start is not None:
+            lo = np.searchsorted(
+                times, utc_to_epoch(start) * MS_PER_SEC, side='left')
+        if end is not None:
+            hi = np.searchsorted(
+                times, utc_to_epoch(end) * MS_PER_SEC, side='left')
+        return records[lo:hi]
+
+    def last_epoch(self, ex_id, asset, timeframe):
+        if not self.exists(ex_id, asset, timeframe):
+            return None
+        records = self.read(ex_id, asset, timeframe)
+        if len(records) == 0:
+            return None
+        return int(records[TIME][-1] // MS_PER_SEC)
@@ -9,25 +9,56 @@ from punisher.trading.order import Order, ExchangeOrder
 from punisher.trading.order import OrderType, OrderStatus
 from punisher.trading import order_manager
 from punisher.trading.trade import Trade
-from punisher.utils.dates import str_to_date
-from punisher.utils.dates import utc_to_epoch
+from punisher.utils.dates import str_to_date, date_to_str
+from punisher.utils.dates import utc_to_epoch, epoch_to_utc
 
 from .exchange import Exchange
 from .ex_cfg import *
+from .limits import get_rate_limiter, get_request_weight, get_max_workers
+from .limits import supports_all_open_orders
+
+# ex_cfg keys for punisher only, ccxt would map them onto the client
+LOCAL_KEYS = set([
+    'rate_limit', 'request_weights', 'max_workers', 'all_open_orders',
+    'nonce_signed', 'fee_schedule', 'latency'])
 
 
 class CCXTExchange(Exchange):
     def __init__(self, ex_id, config):
         super().__init__(ex_id)
         self.config = config
-        self.client = EXCHANGE_CLIENTS[ex_id](config)
+        # Requests are throttled by the shared TokenBucket instead of
+        # ccxt's throttle, which sleeps between every call. Local keys
+        # are dropped since ccxt maps config keys onto client attributes
+        # (rate_limit -> rateLimit)
+        client_config = {
+            k: v for k, v in config.items() if k not in LOCAL_KEYS}
+        client_config['enableRateLimit'] = False
+        self.client = EXCHANGE_CLIENTS[ex_id](client_config)
+        self.max_workers = get_max_workers(ex_id)
+        self.all_open_orders = supports_all_open_orders(ex_id)
+        if self.all_open_orders:
+            # Account wide calls are weighted by the rate limiter,
+            # binance refuses them unless this warning is turned off
+            options = getattr(self.client, 'options', {})
+            if 'warnOnFetchOpenOrdersWithoutSymbol' in options:
+                options['warnOnFetchOpenOrdersWithoutSymbol'] = False
+
+    def _request(self, method, *args, weight_key=None):
+        """
+        Calls the ccxt client method once the rate limiter allows it.
+        `weight_key` overrides the method name used to look up its weight
+        """
+        weight = get_request_weight(self.id, weight_key or method)
+        get_rate_limiter(self.id).acquire(weight)
+        return getattr(self.client, method)(*args)
 
     def get_markets(self):
         if self.client.markets is None:
-            return self.client.load_markets(reload=True)
+            return self._request('load_markets', True)
         return self.client.markets
 
-    def fetch_ohlcv(self, asset, timeframe, start_utc):
+    def fetch_ohlcv(self, asset, timeframe, start_utc, limit=None):
         """
         Returns OHLCV for the symbol based on the time_period
         ex. fetch_ohlcv(btcusd, 1d)
@@ -37,7 +68,8 @@ class CCXTExchange(Exchange):
         assert self.client.hasFetchOHLCV
         # CCXT expects milliseconds since epoch for 'since'
         epoch_ms = utc_to_epoch(start_utc) * 1000
-        return self.client.fetch_ohlcv(asset.symbol, timeframe.id, since=epoch_ms)
+        return self._request(
+            'fetch_ohlcv', asset.symbol, timeframe.id, epoch_ms, limit)
 
     def fetch_order_book(self, asset, params=None):
         """
@@ -50,7 +82,7 @@ class CCXTExchange(Exchange):
         The asks array is sorted by price in ascending order.
         """
         params = self.get_default_params_if_none(params)
-        return self.client.fetch_l2_order_book(asset.symbol, params)
+        return self._request('fetch_l2_order_book', asset.symbol, params)
 
     def fetch_raw_order_book(self, asset, depth=1000, level=3):
         """
@@ -67,7 +99,7 @@ class CCXTExchange(Exchange):
             params['level'] = level
         elif self.id == POLONIEX:
             params['depth'] = 200000
-        return self.client.fetch_order_book(asset.symbol, params)
+        return self._request('fetch_order_book', asset.symbol, params)
 
     def fetch_public_trades(self, asset, start=None, end=None, limit=None):
         """Returns list of trades for a particular symbol"""
@@ -78,14 +110,16 @@ class CCXTExchange(Exchange):
                 'end': utc_to_epoch(end) if end is not None else utc_to_epoch(datetime.utcnow())
             }
         start = utc_to_epoch(start)*1000 if start is not None else utc_to_epoch(start)
-        response = self.client.fetch_trades(asset.symbol, start, limit, params)
+        response = self._request(
+            'fetch_trades', asset.symbol, start, limit, params)
         return self._build_trades(response)
 
     def fetch_my_trades(self, asset, start=None, limit=None, params=None):
         """Returns list of most recent trades for a particular symbol"""
         params = self.get_default_params_if_none(params)
         start = utc_to_epoch(start)*1000 if start is not None else start
-        response = self.client.fetch_my_trades(asset.symbol, since, limit, params)
+        response = self._request(
+            'fetch_my_trades', asset.symbol, start, limit, params)
         return self._build_trades(response)
 
     def fetch_order_trades(self, order_id, asset):
@@ -97,66 +131,82 @@ class CCXTExchange(Exchange):
         return trades
 
     def fetch_ticker(self, asset):
-        return self.client.fetch_ticker(asset.symbol)
+        return self._request('fetch_ticker', asset.symbol)
 
     def fetch_tickers(self):
         """Fetch all tickers at once"""
-        return self.client.fetch_tickers()
+        return self._request('fetch_tickers')
 
     def fetch_balance(self):
         """Returns dict in format of sample-data/account_balance"""
-        return Balance.from_dict(self.client.fetch_balance())
+        return Balance.from_dict(self._request('fetch_balance'))
 
     def create_limit_buy_order(self, asset, quantity, price, params=None):
         params = self.get_default_params_if_none(params)
-        response = self.client.create_limit_buy_order(
-            asset.symbol, quantity, price, params)
-        return self.fetch_order(response['id'], asset)
+        response = self._request(
+            'create_limit_buy_order', asset.symbol, quantity, price, params)
+        return self._build_created_order(
+            response, asset, quantity, price, OrderType.LIMIT_BUY)
 
     def create_limit_sell_order(self, asset, quantity, price, params=None):
         params = self.get_default_params_if_none(params)
-        response = self.client.create_limit_sell_order(
-            asset.symbol, quantity, price, params)
-        return self.fetch_order(response['id'], asset)
+        response = self._request(
+            'create_limit_sell_order', asset.symbol, quantity, price, params)
+        return self._build_created_order(
+            response, asset, quantity, price, OrderType.LIMIT_SELL)
 
     def create_market_buy_order(self, asset, quantity, params=None):
         params = self.get_default_params_if_none(params)
-        response = self.client.create_market_buy_order(
-            asset.symbol, quantity, params)
-        return self.fetch_order(response['id'], asset)
+        response = self._request(
+            'create_market_buy_order', asset.symbol, quantity, params)
+        return self._build_created_order(
+            response, asset, quantity, None, OrderType.MARKET_BUY)
 
     def create_market_sell_order(self, asset, quantity, params=None):
         params = self.get_default_params_if_none(params)
-        response =  self.client.create_market_sell_order(
-            asset.symbol, quantity, params)
-        return self.fetch_order(response['id'], asset)
+        response = self._request(
+            'create_market_sell_order', asset.symbol, quantity, params)
+        return self._build_created_order(
+            response, asset, quantity, None, OrderType.MARKET_SELL)
 
     def cancel_order(self, order_id, asset, params=None):
         """https://github.com/ccxt/ccxt/wiki/Manual#cancelling-orders"""
         params = self.get_default_params_if_none(params)
-        return self.client.cancel_order(order_id, asset.symbol)
+        return self._request('cancel_order', order_id, asset.symbol)
 
     def fetch_order(self, order_id, asset, params=None):
         """https://github.com/ccxt/ccxt/wiki/Manual#orders"""
         params = self.get_default_params_if_none(params)
-        response = self.client.fetch_order(order_id, asset.symbol, params)
+        response = self._request('fetch_order', order_id, asset.symbol, params)
         return self._build_order(response)
 
     def fetch_orders(self, asset, since=None, limit=None, params=None):
         params = self.get_default_params_if_none(params)
-        response = self.client.fetch_orders(asset.symbol, since, limit, params)
+        response = self._request(
+            'fetch_orders', asset.symbol, since, limit, params)
         return self._build_orders(response)
 
-    def fetch_open_orders(self, asset, since=None, limit=None, params=None):
+    def fetch_open_orders(self, asset, since=None, limit=None, params=None,
+                          trades=True):
+        """
+        Open orders for the asset, or for every asset if None
+        and the venue supports it (see all_open_orders)
+        """
         params = self.get_default_params_if_none(params)
-        response =  self.client.fetch_open_orders(
-            asset.symbol, since, limit, params)
-        return self._build_orders(response)
+        if asset is None:
+            assert self.all_open_orders
+            response = self._request(
+                'fetch_open_orders', None, since, limit, params,
+                weight_key='fetch_all_open_orders')
+        else:
+            response = self._request(
+                'fetch_open_orders', asset.symbol, since, limit, params)
+        return self._build_orders(response, trades)
 
     def fetch_closed_orders(self, asset, since=None, limit=None, params=None):
         params = self.get_default_params_if_none(params)
-        response = self.client.fetch_closed_orders(
-            asset.symbol, since, limit, params)
+        response = self._request(
+            'fetch_closed_orders', asset.symbol, since, limit, params)
         return self._build_orders(response)
 
     def deposit(self, asset):
@@ -196,21 +246,48 @@ class CCXTExchange(Exchange):
             trade_dct['fee'] = 0.0
         return Trade.from_dict(trade_dct)
 
-    def _build_orders(self, orders_dct):
+    def _build_orders(self, orders_dct, fetch_trades=True):
         orders = []
         for order in orders_dct:
-            orders.append(self._build_order(order))
+            orders.append(self._build_order(order, fetch_trades))
         return orders
 
-    def _build_order(self, order_dct):
+    def _build_order(self, order_dct, fetch_trades=True):
         # TODO: Add Fees and commissions (using trades)
         order_dct['status'] = self._get_order_status(order_dct)
         order_dct['exchange_id'] = self.id
         order = ExchangeOrder.from_dict(order_dct)
-        order.trades = self.fetch_order_trades(
-            order.ex_order_id, order.asset)
+        if fetch_trades:
+            order.trades = self.fetch_order_trades(
+                order.ex_order_id, order.asset)
         return order
 
+    def _build_created_order(self, response, asset, quantity, price,
+                             order_type):
+        """
+        Builds the order from the create response instead of a follow up
+        fetch_order. Fields the venue leaves out of the ack are taken
+        from the request. Trades are only fetched if it already filled
+        """
+        dct = dict(response)
+        dct['status'] = dct.get('status') or 'open'
+        dct['symbol'] = dct.get('symbol') or asset.symbol
+        dct['amount'] = dct.get('amount') or quantity
+        dct['price'] = dct.get('price') or price
+        dct['type'] = dct.get('type') or order_type.type
+        dct['side'] = dct.get('side') or order_type.side
+        if dct.get('filled') is None:
+            closed = dct['status'].lower() == 'closed'
+            dct['filled'] = dct['amount'] if closed else 0.0
+        if dct.get('datetime') is None:
+            # Opened when the venue stamped the ack, or when we got it
+            if dct.get('timestamp') is not None:
+                opened = epoch_to_utc(dct['timestamp'] / 1000)
+            else:
+                opened = datetime.utcnow()
+            dct['datetime'] = date_to_str(opened)
+        return self._build_order(dct, fetch_trades=dct['filled'] > 0)
+
     def _get_order_status(self, order_dct):
         # TODO: Only aware of 2 statuses - What about pending / failed?
         status = order_dct['status'].upper()
@@ -251,7 +328,7 @@ class CCXTExchange(Exchange):
 
     @property
     def rate_limit(self):
-        return self.client.rate_limit / 1000
+        return self.client.rateLimit / 1000
 
     def __repr__(self):
         return 'CCXTExchange({:s})'.format(self.id)
@@ -1,8 +1,9 @@
 import abc
 import numpy as np
 
-from datetime import datetime
-from punisher.utils.dates import utc_to_epoch
+from datetime import datetime, timedelta
+from punisher.utils.dates import Timeframe
+from punisher.utils.dates import epoch_to_utc, utc_to_epoch
 
 supported_timeframes = { '1m': 1, '5m': 5, '15m': 900, '30m': 1800 }
 
@@ -16,7 +17,7 @@ class ExchangeDataProvider(metaclass=abc.ABCMeta):
         pass
 
     @abc.abstractmethod
-    def fetch_ohlcv(self, asset):
+    def fetch_ohlcv(self, asset, timeframe, start_utc, limit=None):
         pass
 
     @abc.abstractmethod
@@ -31,6 +32,14 @@ class ExchangeDataProvider(metaclass=abc.ABCMeta):
     def fetch_ticker(self, asset):
         pass
 
+    @abc.abstractmethod
+    def fetch_bar(self, asset):
+        pass
+
+    @abc.abstractmethod
+    def get_bar_time(self):
+        pass
+
     @abc.abstractmethod
     def timeframes(self):
         pass
@@ -76,9 +85,21 @@ class FeedExchangeDataProvider(ExchangeDataProvider):
         markets.append(market)
         return markets
 
-    def fetch_ohlcv(self, asset, timeframe, start_utc):
-        #TODO: Currently ignores start time
-        return self.feed.history()
+    def fetch_ohlcv(self, asset, timeframe, start_utc, limit=None):
+        """
+        Bars the feed has vended from `start_utc` on, at most `limit`,
+        as ccxt rows [epoch_ms, open, high, low, close, volume].
+        The feed's own timeframe is used
+        """
+        epochs = self.feed.epochs[:self.feed.cursor]
+        start = int(np.searchsorted(epochs, utc_to_epoch(start_utc)))
+        end = len(epochs) if limit is None else min(len(epochs), start + limit)
+        cols = [self.feed.column_map.offset(field, asset.symbol, self.ex_id)
+                for field in ['open', 'high', 'low', 'close', 'volume']]
+        values = self.feed.values[start:end, cols]
+        return [[int(epoch) * 1000] + row.tolist()
+                for epoch, row in zip(epochs[start:end], values)
+                if not np.isnan(row[3])]
 
     def fetch_order_book(self, asset):
         order_book = {
@@ -94,19 +115,21 @@ class FeedExchangeDataProvider(ExchangeDataProvider):
         return trades
 
     def fetch_ticker(self, asset):
-        history = self.feed.history(t_minus=1)
-        open_ = history.get('open', asset.symbol, self.ex_id, idx=-1)
-        close = history.get('close', asset.symbol, self.ex_id, idx=-1)
-        low = history.get('low', asset.symbol, self.ex_id, idx=-1)
-        high = history.get('high', asset.symbol, self.ex_id, idx=-1)
-        volume = history.get('volume', asset.symbol, self.ex_id, idx=-1)
-        utc = history.get('utc')
+        """Ticker faked from the latest bar vended by the feed"""
+        bar = self.feed.get_bar(self.feed.cursor - 1)
+        open_ = bar.get('open', asset.symbol, self.ex_id)
+        close = bar.get('close', asset.symbol, self.ex_id)
+        low = bar.get('low', asset.symbol, self.ex_id)
+        high = bar.get('high', asset.symbol, self.ex_id)
+        volume = bar.get('volume', asset.symbol, self.ex_id)
+        utc = bar.utc
+        average = (open_ + close) / 2
         return {
             'symbol': asset.symbol,
             'info': {},
             'timestamp': utc_to_epoch(utc),
             'datetime': utc,
-            'high': open_,
+            'high': high,
             'low': low,
             'bid': close, # faking with close
             'ask': close, # faking with close
@@ -115,15 +138,34 @@ class FeedExchangeDataProvider(ExchangeDataProvider):
             'first': open_,
             'last': close,
             'change': None, #(percentage change),
-            'average': np.mean([open_, close]), #TODO: No idea what this means
+            'average': average, #TODO: No idea what this means
             'baseVolume': volume, #(volume of base currency),
             #TODO: should be based on weighted average price
-            'quoteVolume': volume * np.mean([open_, close]),
+            'quoteVolume': volume * average,
         }
 
+    def fetch_bar(self, asset):
+        """Latest OHLCV bar vended by the feed, None before the first"""
+        if self.feed.cursor == 0:
+            return None
+        bar = self.feed.get_bar(self.feed.cursor - 1)
+        dct = {'utc': bar.utc}
+        for field in ['open', 'high', 'low', 'close', 'volume']:
+            dct[field] = bar.get(field, asset.symbol, self.ex_id)
+        return dct
+
     def get_time(self):
-        return self.feed.history(1).get('utc')
-        #return self.feed.peek().get('utc')
+        """
+        Simulated clock, the time of the latest bar vended by the feed.
+        Paper order and cancel latency is measured against it
+        """
+        if self.feed.cursor == 0:
+            return None
+        return self.feed.get_bar(self.feed.cursor - 1).utc
+
+    def get_bar_time(self):
+        """Open time of the bar fetch_bar returns, the simulated clock"""
+        return self.get_time()
 
     @property
     def timeframes(self):
@@ -142,8 +184,8 @@ class CCXTExchangeDataProvider(ExchangeDataProvider):
     def get_markets(self):
         return self.exchange.get_markets()
 
-    def fetch_ohlcv(self, asset, timeframe, start_utc):
-        return self.exchange.fetch_ohlcv(asset, timeframe, start_utc)
+    def fetch_ohlcv(self, asset, timeframe, start_utc, limit=None):
+        return self.exchange.fetch_ohlcv(asset, timeframe, start_utc, limit)
 
     def fetch_order_book(self, asset):
         return self.exchange.fetch_order_book(asset)
@@ -154,9 +196,39 @@ class CCXTExchangeDataProvider(ExchangeDataProvider):
     def fetch_ticker(self, asset):
         return self.exchange.fetch_ticker(asset)
 
+    def fetch_bar(self, asset):
+        """
+        Latest closed 1m candle from the exchange. The one still forming
+        is left out, its range would be matched before it's complete
+        """
+        now = datetime.utcnow()
+        start = now - timedelta(minutes=3)
+        rows = self.exchange.fetch_ohlcv(asset, Timeframe.ONE_MIN, start)
+        forming_ms = (utc_to_epoch(now) - 60) * 1000
+        rows = [row for row in rows if row[0] <= forming_ms]
+        if len(rows) == 0:
+            return None
+        epoch_ms, open_, high, low, close, volume = rows[-1][:6]
+        return {
+            'utc': epoch_to_utc(epoch_ms // 1000),
+            'open': open_,
+            'high': high,
+            'low': low,
+            'close': close,
+            'volume': volume,
+        }
+
     def get_time(self):
         return datetime.utcnow()
 
+    def get_bar_time(self):
+        """
+        Open time of the latest closed 1m candle. Resting paper orders
+        are only matched again once it moves, not on every poll
+        """
+        now = datetime.utcnow().replace(second=0, microsecond=0)
+        return now - timedelta(minutes=1)
+
     @property
     def timeframes(self):
         return self.exchange.timeframes
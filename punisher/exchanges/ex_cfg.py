@@ -29,6 +29,29 @@ EXCHANGE_CONFIGS = {
         'usd_coin': coins.USDT,
         'cash_coins': set([coins.BTC, coins.ETH, coins.USDT]),
         'enableRateLimit': True,
+        'ohlcv_limit': None, # returns the full range
+        'rate_limit': {'rate': 6.0, 'capacity': 6.0},
+        # sign() puts an increasing `nonce` in the signed body, requests
+        # reaching the exchange out of order fail with InvalidNonce
+        'nonce_signed': True,
+        # [mean, std] seconds
+        'latency': {
+            'ack': [0.4, 0.2],
+            'cancel': [0.4, 0.2],
+            'market_data': [0.2, 0.1],
+        },
+        # [min 30 day volume, maker, taker]
+        'fee_schedule': {
+            'volume_coin': coins.BTC,
+            'tiers': [
+                [0, 0.0015, 0.0025],
+                [600, 0.0014, 0.0024],
+                [1200, 0.0012, 0.0022],
+                [2400, 0.0010, 0.0020],
+                [6000, 0.0008, 0.0016],
+                [12000, 0.0005, 0.0014],
+            ],
+        },
     },
     GEMINI: {
         'apiKey': cfg.GEMINI_API_KEY,
@@ -37,6 +60,19 @@ EXCHANGE_CONFIGS = {
         'cash_coins': set([coins.BTC, coins.ETH, coins.USD]),
         'verbose':False,
         'enableRateLimit': True,
+        'ohlcv_limit': None,
+        'rate_limit': {'rate': 1.0, 'capacity': 2.0},
+        # sign() puts an increasing `nonce` in the signed payload
+        'nonce_signed': True,
+        'latency': {
+            'ack': [0.2, 0.1],
+            'cancel': [0.2, 0.1],
+            'market_data': [0.1, 0.05],
+        },
+        'fee_schedule': {
+            'volume_coin': coins.USD,
+            'tiers': [[0, 0.0025, 0.0025]],
+        },
     },
     GDAX: {
         'apiKey': cfg.GDAX_API_KEY,
@@ -46,6 +82,24 @@ EXCHANGE_CONFIGS = {
         'cash_coins': set([coins.BTC, coins.ETH, coins.USD]),
         'verbose':False,
         'enableRateLimit': True,
+        'ohlcv_limit': 300,
+        'rate_limit': {'rate': 3.0, 'capacity': 6.0},
+        # sign() stamps CB-ACCESS-TIMESTAMP, not a strictly increasing
+        # nonce, so private requests can run in parallel
+        'max_workers': 6,
+        'latency': {
+            'ack': [0.2, 0.1],
+            'cancel': [0.2, 0.1],
+            'market_data': [0.1, 0.05],
+        },
+        'fee_schedule': {
+            'volume_coin': coins.USD,
+            'tiers': [
+                [0, 0.0, 0.0030],
+                [10000000, 0.0, 0.0025],
+                [100000000, 0.0, 0.0020],
+            ],
+        },
     },
     BINANCE: {
         'apiKey': cfg.BINANCE_API_KEY,
@@ -54,6 +108,34 @@ EXCHANGE_CONFIGS = {
         'cash_coins': set([coins.BTC, coins.ETH, coins.USDT]),
         'verbose':False,
         'enableRateLimit': True,
+        'ohlcv_limit': 500,
+        'rate_limit': {'rate': 20.0, 'capacity': 20.0}, # 1200 weight/min
+        'request_weights': {
+            'fetch_balance': 5,
+            'fetch_orders': 5,
+            'fetch_my_trades': 5,
+            'fetch_tickers': 40,
+            'fetch_all_open_orders': 40,
+            'load_markets': 1,
+        },
+        'max_workers': 10,
+        'all_open_orders': True,
+        'latency': {
+            'ack': [0.15, 0.05],
+            'cancel': [0.15, 0.05],
+            'market_data': [0.1, 0.05],
+        },
+        'fee_schedule': {
+            'volume_coin': coins.BTC,
+            'tiers': [
+                [0, 0.0010, 0.0010],
+                [100, 0.0009, 0.0010],
+                [500, 0.0008, 0.0010],
+                [1500, 0.0007, 0.0010],
+                [4500, 0.0007, 0.0009],
+                [10000, 0.0006, 0.0008],
+            ],
+        },
     },
     PAPER: {
         'data_provider_exchange_id': DEFAULT_EXCHANGE_ID,
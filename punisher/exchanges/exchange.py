@@ -2,6 +2,12 @@ import abc
 
 
 class Exchange(metaclass=abc.ABCMeta):
+    # Concurrent order requests order_manager may send, exchanges
+    # that aren't thread safe (ex. PaperExchange) keep 1
+    max_workers = 1
+    # Whether fetch_open_orders(None) returns open orders for all assets
+    all_open_orders = False
+
     def __init__(self, ex_id):
         self.id = ex_id
 
@@ -0,0 +1,145 @@
+import bisect
+import collections
+import datetime
+import os
+from pathlib import Path
+
+import numpy as np
+
+import punisher.config as cfg
+import punisher.constants as c
+from punisher.utils import files
+
+from .ex_cfg import EXCHANGE_CONFIGS
+
+FEES_DIR = Path(cfg.DATA_DIR, 'fees')
+ROLLING_WINDOW = datetime.timedelta(days=30)
+ZERO_FEES = {'volume_coin': None, 'tiers': [[0, 0.0, 0.0]]}
+
+
+class FeeSchedule():
+    """
+    Maker/taker rates by rolling 30 day volume tier
+    - tiers : [[min_volume, maker, taker], ...]
+    - volume_coin : coin the tier volumes are measured in,
+        None counts every trade's quote notional
+    """
+    def __init__(self, tiers, volume_coin=None):
+        self.tiers = sorted([list(tier) for tier in tiers])
+        self.thresholds = [tier[0] for tier in self.tiers]
+        self.volume_coin = volume_coin
+
+    def get_tier(self, volume):
+        idx = bisect.bisect_right(self.thresholds, volume) - 1
+        return self.tiers[max(idx, 0)]
+
+    def to_dict(self):
+        return {'volume_coin': self.volume_coin, 'tiers': self.tiers}
+
+    @classmethod
+    def from_dict(self, d):
+        return FeeSchedule(d['tiers'], d.get('volume_coin'))
+
+
+class FeeTracker():
+    """
+    Tracks an account's rolling traded volume and the maker/taker rates
+    of its tier. Rates are only recomputed when the volume changes,
+    so looking one up per fill is a dict access
+    """
+    def __init__(self, schedule, window=ROLLING_WINDOW):
+        self.schedule = schedule
+        self.window = window
+        self.fills = collections.deque()
+        self.volume = 0.0
+        self.rates = {}
+        self._set_rates()
+
+    def get_rate(self, taker_or_maker, time=None):
+        """Rate at `time` (drops volume older than the window first)"""
+        if time is not None:
+            self.expire(time)
+        return self.rates[taker_or_maker or 'taker']
+
+    def add_trade(self, trade):
+        notional = self.get_notional(trade)
+        if notional > 0:
+            self.fills.append((trade.trade_time, notional))
+            self.volume += notional
+        self.expire(trade.trade_time)
+        self._set_rates()
+
+    def expire(self, time):
+        if time is None:
+            return
+        start = time - self.window
+        expired = False
+        while len(self.fills) > 0 and self.fills[0][0] <= start:
+            self.volume -= self.fills.popleft()[1]
+            expired = True
+        if expired:
+            self.volume = max(self.volume, 0.0)
+            self._set_rates()
+
+    def get_notional(self, trade):
+        """
+        Trade size in the schedule's volume coin. Trades that are
+        neither quoted in it nor buying/selling it don't count
+        """
+        coin = self.schedule.volume_coin
+        if coin is None or trade.asset.quote == coin:
+            return abs(trade.quantity) * trade.price
+        if trade.asset.base == coin:
+            return abs(trade.quantity)
+        return 0.0
+
+    def _set_rates(self):
+        _, maker, taker = self.schedule.get_tier(self.volume)
+        self.rates = {'maker': maker, 'taker': taker}
+
+
+def get_fee_fpath(ex_id, outdir=FEES_DIR):
+    return Path(outdir, ex_id + c.JSON)
+
+def load_fee_schedule(ex_id, outdir=FEES_DIR):
+    """
+    Schedule cached on disk by `seed_fee_schedule`, else the one in
+    ex_cfg, else no fees
+    """
+    fpath = get_fee_fpath(ex_id, outdir)
+    if os.path.exists(fpath):
+        return FeeSchedule.from_dict(files.load_json(fpath))
+    config = EXCHANGE_CONFIGS.get(ex_id, {})
+    return FeeSchedule.from_dict(config.get('fee_schedule', ZERO_FEES))
+
+def seed_fee_schedule(exchange, outdir=FEES_DIR):
+    """
+    Builds the schedule from the ccxt client's trading fee tiers,
+    or the markets' flat maker/taker rates, and caches it on disk
+    """
+    trading = getattr(exchange.client, 'fees', {}).get('trading', {})
+    tiers = trading.get('tiers') or {}
+    if tiers.get('maker') and tiers.get('taker'):
+        maker = dict(tiers['maker'])
+        taker = dict(tiers['taker'])
+        volumes = sorted(set(maker) | set(taker))
+        schedule = [[v, get_tier_rate(maker, v), get_tier_rate(taker, v)]
+                    for v in volumes]
+    else:
+        markets = exchange.get_markets()
+        markets = markets.values() if isinstance(markets, dict) else markets
+        rates = np.array([[m.get('maker', np.nan), m.get('taker', np.nan)]
+                          for m in markets], dtype=float)
+        rates = (np.nan_to_num(np.nanmedian(rates, axis=0))
+                 if len(rates) else [0.0, 0.0])
+        schedule = [[0, float(rates[0]), float(rates[1])]]
+    config = EXCHANGE_CONFIGS.get(exchange.id, {}).get('fee_schedule', {})
+    fee_schedule = FeeSchedule(schedule, config.get('volume_coin'))
+    os.makedirs(outdir, exist_ok=True)
+    files.save_dct(get_fee_fpath(exchange.id, outdir), fee_schedule.to_dict())
+    return fee_schedule
+
+def get_tier_rate(tiers, volume):
+    """Rate of the highest tier at or below volume in {min_volume: rate}"""
+    below = [v for v in tiers if v <= volume]
+    return tiers[max(below)] if below else tiers[min(tiers)]
@@ -0,0 +1,43 @@
+import datetime
+
+import numpy as np
+
+from .ex_cfg import EXCHANGE_CONFIGS
+
+NO_LATENCY = [0.0, 0.0]
+
+
+class LatencyModel():
+    """
+    Per-exchange delays in seconds, each a [mean, std] normal
+    distribution truncated at 0
+    - ack : order sent until it's live on the exchange
+    - cancel : cancel sent until the order stops filling
+    - market_data : exchange event until the strategy sees it
+    Seeded so backtests are reproducible
+    """
+    def __init__(self, ack=NO_LATENCY, cancel=NO_LATENCY,
+                 market_data=NO_LATENCY, seed=0):
+        self.delays = {
+            'ack': ack,
+            'cancel': cancel,
+            'market_data': market_data,
+        }
+        self.random = np.random.RandomState(seed)
+
+    @classmethod
+    def from_config(self, ex_id, seed=0):
+        config = EXCHANGE_CONFIGS.get(ex_id, {}).get('latency', {})
+        return LatencyModel(seed=seed, **config)
+
+    def sample(self, kind):
+        mean, std = self.delays[kind]
+        seconds = mean if std == 0 else self.random.normal(mean, std)
+        return datetime.timedelta(seconds=max(seconds, 0.0))
+
+    def get_order_delay(self):
+        """Orders react to market data that is already stale"""
+        return self.sample('market_data') + self.sample('ack')
+
+    def get_cancel_delay(self):
+        return self.sample('market_data') + self.sample('cancel')
@@ -0,0 +1,52 @@
+import threading
+
+from punisher.utils.rate_limit import TokenBucket
+
+from .ex_cfg import EXCHANGE_CONFIGS
+
+DEFAULT_RATE_LIMIT = {'rate': 1.0, 'capacity': 1.0}
+DEFAULT_REQUEST_WEIGHT = 1.0
+DEFAULT_MAX_WORKERS = 1
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_rate_limiter(ex_id):
+    """One shared TokenBucket per exchange id"""
+    with _lock:
+        if ex_id not in _limiters:
+            config = EXCHANGE_CONFIGS.get(ex_id, {})
+            limit = config.get('rate_limit', DEFAULT_RATE_LIMIT)
+            _limiters[ex_id] = TokenBucket(
+                rate=limit['rate'], capacity=limit['capacity'])
+        return _limiters[ex_id]
+
+def get_ohlcv_page_limit(ex_id):
+    """Max OHLCV rows per request, None if the exchange returns all rows"""
+    return EXCHANGE_CONFIGS.get(ex_id, {}).get('ohlcv_limit')
+
+def get_request_weight(ex_id, request):
+    """
+    Tokens a request spends from the exchange's TokenBucket.
+    `request` is the ccxt method name, ex. 'fetch_order'
+    """
+    weights = EXCHANGE_CONFIGS.get(ex_id, {}).get('request_weights', {})
+    return weights.get(request, DEFAULT_REQUEST_WEIGHT)
+
+def get_max_workers(ex_id):
+    """
+    Max concurrent order requests sent to the exchange. Always 1 for
+    venues flagged `nonce_signed` in ex_cfg (the ccxt client's sign()
+    adds an increasing nonce to each private request), requests signed
+    in parallel can reach the exchange out of nonce order and fail
+    with InvalidNonce
+    """
+    config = EXCHANGE_CONFIGS.get(ex_id, {})
+    if config.get('nonce_signed', False):
+        return 1
+    return config.get('max_workers', DEFAULT_MAX_WORKERS)
+
+def supports_all_open_orders(ex_id):
+    """Whether one fetch_open_orders call can cover every symbol"""
+    return EXCHANGE_CONFIGS.get(ex_id, {}).get('all_open_orders', False)
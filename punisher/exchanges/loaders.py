@@ -23,10 +23,13 @@ def load_exchange(ex_id, config=None):
 
     return CCXTExchange(ex_id, config)
 
-def load_feed_based_paper_exchange(balance, feed, feed_ex_id):
+def load_feed_based_paper_exchange(balance, feed, feed_ex_id,
+                                   order_books=None, latency=None):
     balance = deepcopy(balance)
     data_provider = FeedExchangeDataProvider(feed, feed_ex_id)
-    return PaperExchange(feed_ex_id, balance, data_provider)
+    return PaperExchange(
+        feed_ex_id, balance, data_provider, order_books=order_books,
+        latency=latency)
 
 def load_ccxt_based_paper_exchange(balance, exchange_id):
     balance = deepcopy(balance)
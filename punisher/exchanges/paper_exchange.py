@@ -1,15 +1,20 @@
+import heapq
+import itertools
 import uuid
+from collections import OrderedDict
 from datetime import datetime
 from copy import deepcopy
 
 import ccxt
+import numpy as np
 
 from punisher.portfolio.asset import Asset
 from punisher.portfolio.balance import Balance, BalanceType
 from punisher.trading.order import Order, ExchangeOrder
 from punisher.trading.order import OrderType, OrderStatus
+from punisher.trading.order import TERMINAL_STATUSES
 from punisher.trading import order_manager
-from punisher.trading.trade import Trade
+from punisher.trading.trade import Trade, TradeSide
 from punisher.utils.dates import str_to_date, date_to_str
 from punisher.utils.dates import utc_to_epoch
 
@@ -17,21 +22,195 @@ from .data_providers import CCXTExchangeDataProvider
 from .data_providers import FeedExchangeDataProvider
 from .exchange import Exchange
 from .ex_cfg import *
+from .fees import FeeTracker, load_fee_schedule
+from .latency import LatencyModel
+
+# Max fraction of a bar's volume resting orders can fill per side
+DEFAULT_PARTICIPATION = 0.1
+# Terminal orders kept queryable before the oldest are dropped
+DEFAULT_MAX_ARCHIVED = 10000
+
+
+class PaperOrderStore():
+    """
+    Paper exchange orders by ex_order_id with per-asset indexes.
+    Orders in a terminal status move to an archive holding the latest
+    `max_archived`, so memory stays bounded in long simulations
+    """
+    def __init__(self, max_archived=DEFAULT_MAX_ARCHIVED):
+        self.max_archived = max_archived
+        self.open = {}
+        self.open_by_symbol = {}
+        self.archive = OrderedDict()
+        self.archive_by_symbol = {}
+
+    def add(self, order):
+        if order.status in TERMINAL_STATUSES:
+            self._archive(order)
+        else:
+            self.open[order.ex_order_id] = order
+            self.open_by_symbol.setdefault(
+                order.asset.symbol, {})[order.ex_order_id] = order
+
+    def update(self, order):
+        """Archives the order if its status became terminal"""
+        if (order.status in TERMINAL_STATUSES
+            and order.ex_order_id in self.open):
+            del self.open[order.ex_order_id]
+            del self.open_by_symbol[order.asset.symbol][order.ex_order_id]
+            self._archive(order)
+
+    def get(self, ex_order_id):
+        order = self.open.get(ex_order_id)
+        if order is None:
+            order = self.archive.get(ex_order_id)
+        return order
+
+    def get_open(self, symbol):
+        return list(self.open_by_symbol.get(symbol, {}).values())
+
+    def get_closed(self, symbol):
+        return list(self.archive_by_symbol.get(symbol, {}).values())
+
+    def get_all(self, symbol):
+        return self.get_closed(symbol) + self.get_open(symbol)
+
+    def _archive(self, order):
+        self.archive[order.ex_order_id] = order
+        self.archive_by_symbol.setdefault(
+            order.asset.symbol, OrderedDict())[order.ex_order_id] = order
+        while len(self.archive) > self.max_archived:
+            _, oldest = self.archive.popitem(last=False)
+            del self.archive_by_symbol[oldest.asset.symbol][oldest.ex_order_id]
+
+    def __len__(self):
+        return len(self.open) + len(self.archive)
+
+
+class LimitBook():
+    """
+    Resting limit orders for one asset. Each side is kept as arrays in
+    price/time priority (best price first) so a bar is matched against
+    every resting order with a searchsorted and a cumsum. Each order
+    also tracks the displayed size queued ahead of it at its price
+    (FIFO), which must trade before a bar touching that price fills it,
+    and the epoch it opened at so it only meets bars opening after it
+    """
+    def __init__(self):
+        # Buys are keyed by -price so both sides sort ascending
+        self.keys = {'buy': np.empty(0), 'sell': np.empty(0)}
+        self.remaining = {'buy': np.empty(0), 'sell': np.empty(0)}
+        self.queue = {'buy': np.empty(0), 'sell': np.empty(0)}
+        self.opened = {'buy': np.empty(0), 'sell': np.empty(0)}
+        self.orders = {'buy': [], 'sell': []}
+        self.last_bar_time = None
+
+    def add(self, order, queue_ahead=0.0):
+        side = order.order_type.side
+        key = -order.price if side == 'buy' else order.price
+        idx = int(np.searchsorted(self.keys[side], key, side='right'))
+        remaining = order.quantity - order.filled_quantity
+        opened = -np.inf
+        if order.opened_time is not None:
+            opened = utc_to_epoch(order.opened_time)
+        self.keys[side] = np.insert(self.keys[side], idx, key)
+        self.remaining[side] = np.insert(self.remaining[side], idx, remaining)
+        self.queue[side] = np.insert(self.queue[side], idx, queue_ahead)
+        self.opened[side] = np.insert(self.opened[side], idx, opened)
+        self.orders[side].insert(idx, order)
+
+    def remove(self, order):
+        """Returns False if the order isn't resting in the book"""
+        side = order.order_type.side
+        for i, resting in enumerate(self.orders[side]):
+            if resting is order:
+                self._keep(side, np.arange(len(self.orders[side])) != i)
+                return True
+        return False
+
+    def match(self, high, low, max_quantity, bar_epoch=np.inf):
+        """
+        Fills buys priced at or above the bar low and sells at or below
+        the bar high, in priority order until max_quantity per side.
+        Orders priced at the bar's extreme (touch) only get what trades
+        past the volume queued ahead of them. Orders opened at or after
+        `bar_epoch` (the bar's open) sit the bar out.
+        Returns [(order, fill quantity)]
+        """
+        fills = []
+        for side, bound in [('buy', -low), ('sell', high)]:
+            n = int(np.searchsorted(self.keys[side], bound, side='right'))
+            if n == 0:
+                continue
+            touch = int(np.searchsorted(self.keys[side], bound, side='left'))
+            eligible = self.opened[side][:n] < bar_epoch
+            remaining = self.remaining[side][:n]
+            queue = self.queue[side][:n]
+            matchable = np.where(eligible, remaining, 0.0)
+            ahead = np.cumsum(matchable) - matchable
+            ahead[touch:] += queue[touch:]
+            filled = np.clip(max_quantity - ahead, 0.0, matchable)
+            for i in np.flatnonzero(filled):
+                fills.append((self.orders[side][i], filled[i]))
+            remaining -= filled
+            traded = eligible[touch:]
+            queue[touch:][traded] = np.maximum(
+                queue[touch:][traded] - max_quantity, 0.0)
+            self._keep(side, self.remaining[side] > 0.0)
+        return fills
+
+    def _keep(self, side, mask):
+        self.keys[side] = self.keys[side][mask]
+        self.remaining[side] = self.remaining[side][mask]
+        self.queue[side] = self.queue[side][mask]
+        self.opened[side] = self.opened[side][mask]
+        self.orders[side] = [
+            order for order, keep in zip(self.orders[side], mask) if keep]
+
+    def __len__(self):
+        return len(self.orders['buy']) + len(self.orders['sell'])
 
 
 class PaperExchange(Exchange):
-    def __init__(self, ex_id, balance, data_provider):
+    def __init__(self, ex_id, balance, data_provider,
+                 participation=DEFAULT_PARTICIPATION, order_books=None,
+                 fees=None, max_archived=DEFAULT_MAX_ARCHIVED, latency=None):
+        """
+        - order_books : {symbol: BookReplay} recorded L2 books market
+            orders fill against, others fill at the ticker
+        - fees : FeeTracker, defaults to the exchange's fee schedule
+        - latency : LatencyModel, defaults to none. Pass
+            LatencyModel.from_config(ex_id) for the exchange's delays.
+            Orders and cancels take effect on the first bar at or after
+            they reach the exchange on the data provider's clock
+        """
         super().__init__(ex_id)
         self.balance = balance
         self.data_provider = data_provider
-        self.orders = []
+        self.participation = participation
+        self.order_books = {} if order_books is None else order_books
+        if fees is None:
+            fees = FeeTracker(load_fee_schedule(ex_id))
+        self.fees = fees
+        if latency is None:
+            latency = LatencyModel()
+        self.latency = latency
+        self.orders = PaperOrderStore(max_archived)
+        # Heaps of (arrival time, seq, order, ...) in flight to the exchange
+        self.pending = []
+        self.cancels = []
+        self.seq = itertools.count()
+        self.books = {}
+        self.last_match_time = None
+        self.last_bar_time = None
         self.commissions = []
 
     def get_markets(self):
         return self.data_provider.get_markets()
 
-    def fetch_ohlcv(self, asset, timeframe, start_utc):
-        return self.data_provider.fetch_ohlcv(asset, timeframe, start_utc)
+    def fetch_ohlcv(self, asset, timeframe, start_utc, limit=None):
+        return self.data_provider.fetch_ohlcv(
+            asset, timeframe, start_utc, limit)
 
     def fetch_order_book(self, asset):
         return self.data_provider.fetch_order_book(asset)
@@ -61,10 +240,10 @@ class PaperExchange(Exchange):
     def fetch_my_trades(self, asset, since=None, limit=None, params=None):
         """Returns list of most recent trades for a particular symbol"""
         # TODO: implement since and limit
+        self._match_resting_orders()
         trades = []
-        for order in orders:
-            if order.asset == asset:
-                trades.append(order.trades)
+        for order in self.orders.get_all(asset.symbol):
+            trades.extend(order.trades)
         return trades
 
     def fetch_balance(self):
@@ -78,44 +257,46 @@ class PaperExchange(Exchange):
         return self._create_order(asset, quantity, price, OrderType.LIMIT_SELL)
 
     def create_market_buy_order(self, asset, quantity):
-        price = self.fetch_ticker(asset)['ask']
-        return self._create_order(asset, quantity, price, OrderType.MARKET_BUY)
+        return self._create_market_order(asset, quantity, OrderType.MARKET_BUY)
 
     def create_market_sell_order(self, asset, quantity):
-        price = self.fetch_ticker(asset)['bid']
-        return self._create_order(asset, quantity, price, OrderType.MARKET_SELL)
-
-    def cancel_order(self, order_id):
-        # TODO: Implement this when we have pending orders
-        return NotImplemented
+        return self._create_market_order(asset, quantity, OrderType.MARKET_SELL)
+
+    def cancel_order(self, order_id, asset=None):
+        """
+        The order can still fill until the cancel reaches the exchange
+        Returns the order, None if it isn't known
+        """
+        self._match_resting_orders()
+        order = self.orders.get(order_id)
+        if order is None or order.status != OrderStatus.OPEN:
+            return order
+        now = self.data_provider.get_time()
+        arrival = now + self.latency.get_cancel_delay()
+        if arrival > now:
+            heapq.heappush(self.cancels, (arrival, next(self.seq), order))
+        else:
+            self._cancel_order(order)
+        return order
 
     def fetch_order(self, order_id, asset):
         """Asset Required for CCXT"""
-        for order in self.orders:
-            if order.ex_order_id == order_id:
-                return order
-        return None
+        self._match_resting_orders()
+        return self.orders.get(order_id)
 
     def fetch_orders(self, asset):
-        orders = []
-        for order in self.orders:
-            if order.asset.id == asset.id:
-                orders.append(order)
-        return orders
-
-    def fetch_open_orders(self, asset):
-        open_orders = []
-        for order in self.orders:
-            if order.status == OrderStatus.OPEN and order.asset.id == asset.id:
-                open_orders.append(order)
-        return open_orders
+        self._match_resting_orders()
+        return self.orders.get_all(asset.symbol)
+
+    def fetch_open_orders(self, asset, trades=True):
+        """Paper orders always carry their trades"""
+        self._match_resting_orders()
+        return self.orders.get_open(asset.symbol)
 
     def fetch_closed_orders(self, asset):
-        open_orders = []
-        for order in self.orders:
-            if order.status == OrderStatus.OPEN and order.asset.id == asset.id:
-                open_orders.append(order)
-        return open_orders
+        """Filled/canceled orders still in the archive"""
+        self._match_resting_orders()
+        return self.orders.get_closed(asset.symbol)
 
     def deposit(self, asset):
         return NotImplemented
@@ -124,9 +305,10 @@ class PaperExchange(Exchange):
 
     def calculate_fee(self, asset, type, side, quantity,
                       price, taker_or_maker=None, params=None):
-        # TODO: Implement this
-        # taker = market order
-        # maker = limit order
+        """
+        Fee in the quote currency. Takers cross the book (market orders,
+        marketable limits), makers are resting limit orders
+        """
         cost = abs(quantity) * price
         fee_rate = self._get_fee_rate(asset, taker_or_maker)
         fee = cost * fee_rate
@@ -135,9 +317,42 @@ class PaperExchange(Exchange):
     def order_on_margin(self, price):
         return NotImplemented
 
-    def _create_order(self, asset, quantity, price, order_type):
+    def _create_market_order(self, asset, quantity, order_type):
+        """
+        Fills at the ticker, or at the volume weighted price of walking
+        the recorded L2 book in effect if one is loaded for the asset.
+        What the book can't fill is canceled
+        """
+        ticker = self.fetch_ticker(asset)
+        price = ticker['ask'] if order_type.is_buy() else ticker['bid']
+        price, fillable = self._get_market_price(
+            asset, order_type.side, quantity,
+            self.data_provider.get_time(), price)
+        return self._create_order(
+            asset, quantity, price, order_type, fillable=fillable)
+
+    def _get_market_price(self, asset, side, quantity, time, price):
+        """
+        (price, fillable quantity) of a market order reaching the book
+        at `time`, `price` if there's no recorded book to walk or no
+        snapshot in effect (the replay doesn't cover `time`)
+        """
+        replay = self.order_books.get(asset.symbol)
+        if replay is None:
+            return price, None
+        epoch_ms = utc_to_epoch(time) * 1000
+        if replay.get_snapshot_idx([epoch_ms])[0] < 0:
+            return price, None
+        vwap, filled = replay.fill(side, [quantity], [epoch_ms])
+        if filled[0] > 0:
+            price = vwap[0]
+        return price, filled[0]
+
+    def _create_order(self, asset, quantity, price, order_type,
+                      fillable=None):
         assert quantity != 0 and price != 0
-        print("TIME", self.data_provider.get_time())
+        # Resting orders get the current bar before new orders can fill
+        self._match_resting_orders()
         order = ExchangeOrder.from_dict({
             'id': self.make_order_id(),
             'exchange_id': self.id,
@@ -155,7 +370,8 @@ class PaperExchange(Exchange):
             asset=asset,
             quantity=quantity,
             price=price,
-            order_type=order_type):
+            order_type=order_type,
+            fee=self._get_max_fee(asset, order_type, quantity, price)):
 
             # TODO: Implement our own InsufficientFunds
             raise ccxt.errors.InsufficientFunds((
@@ -170,21 +386,206 @@ class PaperExchange(Exchange):
         # Now that we have created the order, update it's status to open
         # since it is in the exchange
         order.status = OrderStatus.OPEN
-        order = self._fill_order(order)
-        self.orders.append(order)
+        now = self.data_provider.get_time()
+        arrival = now + self.latency.get_order_delay()
+        if arrival > now:
+            # Funds are held while the order is in flight
+            self.orders.add(order)
+            heapq.heappush(
+                self.pending, (arrival, next(self.seq), order, fillable))
+        else:
+            self._activate_order(order, fillable)
+            self.orders.add(order)
 
         return order
 
-    def _fill_order(self, order):
-        # TODO: implement slippage
+    def _activate_order(self, order, fillable=None, price=None, time=None):
+        """
+        Fills market and marketable limit orders, rests the others
+        behind the size displayed at their price. `price` is the market
+        price the order meets, the latest ticker if None. Marketable
+        limits fill at it when it beats their limit. `time` is when
+        the order reached the exchange, now if None
+        """
+        if time is None:
+            time = self.data_provider.get_time()
+        order.opened_time = time
+        fill_price = order.price
+        if order.order_type.type == 'limit':
+            if price is None:
+                ticker = self.fetch_ticker(order.asset)
+                price = ticker['ask'] if order.order_type.is_buy() else ticker['bid']
+            if not self._is_marketable(order, price):
+                self._get_book(order.asset).add(
+                    order, self._get_queue_size(order))
+                return order
+            fill_price = price
+        if fillable is None or fillable >= order.quantity:
+            self._fill_order(order, order.quantity, 'taker', fill_price)
+        else:
+            if fillable > 0:
+                self._fill_order(order, fillable, 'taker', fill_price)
+            self._cancel_remaining(order)
+        return order
+
+    def _apply_cancels(self, time):
+        """
+        Cancels reaching the exchange by `time`. They go before pending
+        orders are activated and books matched, so an order canceled
+        before a bar can't trade on it, even if it arrives in the same pass
+        """
+        while len(self.cancels) > 0 and self.cancels[0][0] <= time:
+            self._cancel_order(heapq.heappop(self.cancels)[2])
+
+    def _activate_pending(self, time, bars):
+        """
+        Orders reaching the exchange by `time` meet the latest bar's
+        open. Market orders are repriced to it (or to the recorded book
+        at arrival) and the funds held for them adjusted. Buys the free
+        balance can no longer cover are rejected (KILLED)
+        """
+        while len(self.pending) > 0 and self.pending[0][0] <= time:
+            arrival, _, order, fillable = heapq.heappop(self.pending)
+            if order.status != OrderStatus.OPEN:
+                continue
+            bar = self._get_bar(order.asset.symbol, bars)
+            price = None if bar is None else bar['open']
+            if order.order_type.type == 'market' and price is not None:
+                price, fillable = self._get_market_price(
+                    order.asset, order.order_type.side, order.quantity,
+                    arrival, price)
+                if not self._reprice(order, price):
+                    print("Insufficient funds for order {:s} at {:.5f}".format(
+                        order.ex_order_id, price))
+                    self._cancel_remaining(order, OrderStatus.KILLED)
+                    continue
+            self._activate_order(order, fillable, price, arrival)
+
+    def _reprice(self, order, price):
+        """
+        Moves the funds held for a buy to the new price
+        Returns False, leaving the order as is, if funds are short
+        (including the fee at the new price)
+        """
+        if order.order_type.is_buy():
+            delta = order.quantity * (price - order.price)
+            free = self.balance.get(order.asset.quote)[BalanceType.FREE]
+            fee = self._get_max_fee(
+                order.asset, order.order_type, order.quantity, price)
+            if delta + fee > free:
+                return False
+            self.balance.update(
+                currency=order.asset.quote,
+                delta_free=-delta,
+                delta_used=delta
+            )
+        order.price = price
+        return True
+
+    def _get_queue_size(self, order):
+        """Size displayed ahead of the order, 0.0 without a recorded book"""
+        replay = self.order_books.get(order.asset.symbol)
+        if replay is None:
+            return 0.0
+        epoch_ms = utc_to_epoch(self.data_provider.get_time()) * 1000
+        return replay.queue_size(
+            order.order_type.side, [order.price], [epoch_ms])[0]
+
+    def _is_marketable(self, order, price):
+        """Limit orders crossing the market price fill on arrival"""
+        if order.order_type.is_buy():
+            return order.price >= price
+        return order.price <= price
+
+    def _get_book(self, asset):
+        if asset.symbol not in self.books:
+            self.books[asset.symbol] = LimitBook()
+        return self.books[asset.symbol]
+
+    def _match_resting_orders(self):
+        """
+        Matches resting limit orders against each asset's latest bar,
+        once per closed bar. Fills are capped at `participation` of bar
+        volume. Cancels and orders that reached the exchange since the
+        last pass are applied first. Each asset's bar is fetched at most
+        once per pass
+        """
+        time = self.data_provider.get_time()
+        if time == self.last_match_time:
+            return
+        self.last_match_time = time
+        bars = {}
+        self._apply_cancels(time)
+        self._activate_pending(time, bars)
+        bar_time = self.data_provider.get_bar_time()
+        if bar_time == self.last_bar_time:
+            return
+        self.last_bar_time = bar_time
+        for symbol, book in self.books.items():
+            if len(book) == 0:
+                continue
+            bar = self._get_bar(symbol, bars)
+            if bar is None or bar['utc'] == book.last_bar_time:
+                continue
+            book.last_bar_time = bar['utc']
+            max_quantity = bar['volume'] * self.participation
+            if np.isnan(max_quantity):
+                max_quantity = np.inf
+            for order, quantity in book.match(
+                    bar['high'], bar['low'], max_quantity,
+                    utc_to_epoch(bar['utc'])):
+                self._fill_order(order, quantity, 'maker')
+
+    def _get_bar(self, symbol, bars):
+        """Latest bar for the symbol, cached in `bars` for the pass"""
+        if symbol not in bars:
+            bars[symbol] = self.data_provider.fetch_bar(
+                Asset.from_symbol(symbol))
+        return bars[symbol]
+
+    def _cancel_order(self, order):
+        if order.status != OrderStatus.OPEN:
+            return order
+        book = self.books.get(order.asset.symbol)
+        if book is not None:
+            book.remove(order)
+        return self._cancel_remaining(order)
+
+    def _cancel_remaining(self, order, status=OrderStatus.CANCELED):
+        """Cancels the order, releasing funds held for the unfilled part"""
+        remaining = order.quantity - order.filled_quantity
+        if order.order_type.is_buy():
+            self.balance.update(
+                currency=order.asset.quote,
+                delta_free=remaining * order.price,
+                delta_used=-remaining * order.price
+            )
+        else:
+            self.balance.update(
+                currency=order.asset.base,
+                delta_free=remaining,
+                delta_used=-remaining
+            )
+        order.status = status
+        if status == OrderStatus.CANCELED:
+            order.canceled_time = self.data_provider.get_time()
+        self.orders.update(order)
+        return order
 
+    def _fill_order(self, order, quantity, taker_or_maker, price=None):
+        """
+        Trades `quantity` at `price`, the order's price if None. Buys
+        filling below it get back the funds held for the difference
+        """
+        if price is None:
+            price = order.price
         fee = self.calculate_fee(
                 asset=order.asset,
                 type=order.order_type,
                 side=order.order_type.side,
-                quantity=order.quantity,
-                price=order.price,
-                taker_or_maker=None
+                quantity=quantity,
+                price=price,
+                taker_or_maker=taker_or_maker
             )
 
         trade = Trade(
@@ -192,24 +593,48 @@ class PaperExchange(Exchange):
             exchange_id=self.id,
             exchange_order_id=order.ex_order_id,
             asset=order.asset,
-            price=order.price,
-            quantity=order.quantity,
+            price=price,
+            quantity=quantity,
             trade_time=self.data_provider.get_time(),
-            side=order.order_type.side,
+            side=TradeSide.from_side(order.order_type.side),
             fee=fee
         )
 
         self.balance.update_with_trade(trade)
+        if order.order_type.is_buy() and price != order.price:
+            self.balance.update(
+                currency=order.asset.quote,
+                delta_free=quantity * (order.price - price),
+                delta_used=-quantity * (order.price - price)
+            )
+        self.fees.add_trade(trade)
 
         order.trades.append(trade)
-        order.filled_quantity = trade.quantity
-        order.filled_time = self.data_provider.get_time()
-        order.status = OrderStatus.FILLED
+        order.filled_quantity += quantity
+        # Partial fills can leave float dust on the last one
+        if order.quantity - order.filled_quantity <= 1e-9 * order.quantity:
+            order.filled_time = trade.trade_time
+            order.status = OrderStatus.FILLED
+            self.orders.update(order)
         return order
 
+    def _get_max_fee(self, asset, order_type, quantity, price):
+        """
+        Fee of filling the whole order as a taker, the most it can pay.
+        Buys pay it from the free quote balance when they fill
+        """
+        return self.calculate_fee(
+            asset=asset,
+            type=order_type,
+            side=order_type.side,
+            quantity=quantity,
+            price=price,
+            taker_or_maker='taker'
+        )
+
     def _get_fee_rate(self, asset, taker_or_maker):
-        # TODO: do this crap
-        return 0.0
+        return self.fees.get_rate(
+            taker_or_maker, self.data_provider.get_time())
 
     def make_order_id(self):
         return uuid.uuid4().hex
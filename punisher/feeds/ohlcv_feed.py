@@ -1,15 +1,24 @@
 import os
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum, unique
+
+import numpy as np
 import pandas as pd
 from pathlib import Path
 
 import punisher.config as cfg
 import punisher.constants as c
+from punisher.data import ohlcv_cache
+import punisher.data.tea_store as tea
 from punisher.exchanges import ex_cfg
+from punisher.exchanges.limits import get_ohlcv_page_limit
 from punisher.portfolio.asset import Asset
 from punisher.trading import coins
+from punisher.utils.dates import Timeframe
 from punisher.utils.dates import get_time_range
 from punisher.utils.dates import epoch_to_utc, utc_to_epoch
+from punisher.utils.dates import epochs_to_utc
 from punisher.utils.dates import str_to_date
 
 
@@ -20,6 +29,14 @@ OHLCV_COLUMNS = ['epoch', 'open', 'high', 'low', 'close', 'volume']
 # Close - Bid/Ask? at end of time period (quoted in cash)
 # Volume - Quantity of base coin traded during time period (quoted in base)
 
+@unique
+class GapFill(Enum):
+    NONE = 'leave missing bars out'
+    FFILL = 'repeat the last close with zero volume'
+    MARK = 'insert missing bars as NaN'
+    REFETCH = 'download missing bars from the exchange'
+
+
 class OHLCVData():
     def __init__(self, ohlcv_df):
         self.ohlcv_df = ohlcv_df
@@ -42,10 +59,14 @@ class OHLCVData():
     def df(self):
         return self.ohlcv_df
 
+    @property
+    def columns(self):
+        return self.ohlcv_df.columns
+
     @property
     def cash_coins(self):
         cash = set()
-        columns = [c for c in self.ohlcv_df.columns if c not in ['utc', 'epoch']]
+        columns = [c for c in self.columns if c not in ['utc', 'epoch']]
         for col in columns:
             field,symbol,ex_id = col.split('_')
             asset = Asset.from_symbol(symbol)
@@ -59,12 +80,174 @@ class OHLCVData():
         return len(self.ohlcv_df)
 
 
+class ColumnMap():
+    """
+    Column name -> integer offset into a float64 block
+    Built once per frame and shared by every bar vended from it
+    """
+    def __init__(self, columns):
+        self.names = list(columns)
+        self.offsets = {name: i for i, name in enumerate(self.names)}
+        assert len(self.offsets) == len(self.names), (
+            "Duplicate columns: {}".format(self.names))
+        self._keys = {}
+
+    def offset(self, field, symbol=None, ex_id=None):
+        key = (field, symbol, ex_id)
+        if key not in self._keys:
+            col_name = get_col_name(field, symbol, ex_id)
+            self._keys[key] = self.offsets[col_name]
+        return self._keys[key]
+
+    def __contains__(self, col_name):
+        return col_name in self.offsets
+
+    def __len__(self):
+        return len(self.names)
+
+
+class CrossRates():
+    """
+    Conversion rates between the coins quoted in an OHLCV frame,
+    built once per frame so valuing a column is a single multiply.
+    Rates from every quote coin to the exchange's cash coins (ex_cfg)
+    are computed up front, directly or through one intermediate coin.
+    """
+    FIELDS = ['open', 'high', 'low', 'close']
+
+    def __init__(self, df):
+        self.n_rows = len(df)
+        self.ones = np.ones(self.n_rows)
+        self.rates = {}
+        quotes = {}
+        for col in df.columns:
+            if col in ['utc', 'epoch']:
+                continue
+            field, symbol, ex_id = col.split('_')
+            if field not in self.FIELDS:
+                continue
+            asset = Asset.from_symbol(symbol)
+            base = normalize_coin(asset.base, ex_id)
+            quote = normalize_coin(asset.quote, ex_id)
+            price = df[col].to_numpy(dtype=np.float64)
+            # Direct quotes win over inverted ones
+            self.rates[(field, base, quote, ex_id)] = price
+            with np.errstate(divide='ignore'):
+                inverse = 1.0 / price
+            self.rates.setdefault((field, quote, base, ex_id), inverse)
+            quotes.setdefault(ex_id, set()).add(quote)
+        for ex_id, quote_coins in quotes.items():
+            cash_coins = ex_cfg.EXCHANGE_CONFIGS.get(
+                ex_id, {}).get('cash_coins', [])
+            for field in self.FIELDS:
+                for quote in quote_coins:
+                    for cash_coin in cash_coins:
+                        try:
+                            self.rate(quote, cash_coin, ex_id, field)
+                        except Exception:
+                            # Frame does not quote this pair
+                            pass
+
+    def rate(self, from_coin, to_coin, ex_id, field='close'):
+        """Array of how much `to_coin` one `from_coin` buys at each row"""
+        from_coin = normalize_coin(from_coin, ex_id)
+        to_coin = normalize_coin(to_coin, ex_id)
+        if from_coin == to_coin:
+            return self.ones
+        key = (field, from_coin, to_coin, ex_id)
+        if key not in self.rates:
+            self.rates[key] = self._cross_rate(
+                from_coin, to_coin, ex_id, field)
+        return self.rates[key]
+
+    def _cross_rate(self, from_coin, to_coin, ex_id, field):
+        for (f, start, via, ex), rate in list(self.rates.items()):
+            if (f == field and ex == ex_id and start == from_coin
+                and (field, via, to_coin, ex_id) in self.rates):
+                return rate * self.rates[(field, via, to_coin, ex_id)]
+        raise Exception("No {:s} rate from {:s} to {:s} on {:s}".format(
+            field, from_coin, to_coin, ex_id))
+
+    def cash_value(self, field, asset, ex_id, cash_coin):
+        """Asset prices (`field`) valued in `cash_coin`"""
+        base = normalize_coin(asset.base, ex_id)
+        quote = normalize_coin(asset.quote, ex_id)
+        cash_coin = normalize_coin(cash_coin, ex_id)
+        price = self.rates[(field, base, quote, ex_id)]
+        if cash_coin in [quote, base]:
+            return price
+        return price * self.rate(quote, cash_coin, ex_id, field)
+
+
+class OHLCVBar(OHLCVData):
+    """
+    Single OHLCV row backed by a view into the feed's float64 block
+    Same get/col/row/df API as OHLCVData, the DataFrame is only
+    built if someone asks for it
+    """
+    def __init__(self, values, column_map, epoch):
+        self.values = values
+        self.column_map = column_map
+        self.epoch = epoch
+        self._utc = None
+        self._df = None
+
+    def get(self, field, symbol=None, ex_id=None, idx=0):
+        if field == 'utc':
+            return self.utc
+        if field == 'epoch':
+            return self.epoch
+        return self.values[self.column_map.offset(field, symbol, ex_id)]
+
+    def col(self, field, symbol=None, ex_id=None):
+        if field == 'utc':
+            return np.array([self.utc])
+        return self.values[[self.column_map.offset(field, symbol, ex_id)]]
+
+    def row(self, idx):
+        return self.df.iloc[idx]
+
+    @property
+    def utc(self):
+        if self._utc is None:
+            self._utc = epoch_to_utc(self.epoch)
+        return self._utc
+
+    @property
+    def df(self):
+        if self._df is None:
+            index = pd.Index([self.epoch], name='epoch')
+            self._df = pd.DataFrame(
+                [self.values], index=index, columns=self.column_map.names)
+            self._df['utc'] = [self.utc]
+        return self._df
+
+    @property
+    def ohlcv_df(self):
+        return self.df
+
+    @property
+    def columns(self):
+        return self.column_map.names
+
+    def __len__(self):
+        return 1
+
+
 class OHLCVFeed():
     def __init__(self, start=None, end=None):
         self.start = start
         self.end = end
         self.prior_time = None
-        self.ohlcv_df = None
+        self.cursor = 0
+        # epochs/values are views of the filled rows of the buffers,
+        # which keep spare capacity for rows added by upsert_rows
+        self.epochs = np.array([], dtype=np.int64)
+        self.values = None
+        self.column_map = None
+        self._epochs_buf = self.epochs
+        self._values_buf = None
+        self._ohlcv_df = None
 
     def initialize(self):
         if self.start is None:
@@ -73,6 +256,114 @@ class OHLCVFeed():
             self.end = datetime.datetime.utcnow()
         self.prior_time = self.start - datetime.timedelta(minutes=1)
 
+    @property
+    def ohlcv_df(self):
+        """Frame of every row, rebuilt from the arrays after upsert_rows"""
+        if self._ohlcv_df is None and self.values is not None:
+            self._ohlcv_df = self._make_df(0, len(self.epochs))
+        return self._ohlcv_df
+
+    @ohlcv_df.setter
+    def ohlcv_df(self, df):
+        """
+        Swapping in a new frame (initialize/update) re-seeks the cursor
+        so the feed keeps vending rows after prior_time
+        """
+        if df is not None and not df.index.is_monotonic_increasing:
+            df = df.sort_index()
+        self._ohlcv_df = df
+        if df is None:
+            self.epochs = np.array([], dtype=np.int64)
+            self.values = None
+            self.column_map = None
+        else:
+            columns = [col for col in df.columns if col != 'utc']
+            self.epochs = df.index.values.astype(np.int64, copy=False)
+            self.values = df[columns].to_numpy(dtype=np.float64)
+            self.column_map = ColumnMap(columns)
+        self._epochs_buf = self.epochs
+        self._values_buf = self.values
+        self.cursor = self.seek(self.prior_time)
+
+    def upsert_rows(self, epochs, values, columns):
+        """
+        Writes epoch sorted rows of `values` (n_rows, len(columns)) into
+        the feed's arrays in place. Rows of an existing epoch are
+        overwritten (NaN cells are kept), newer rows are appended to
+        buffers that double in capacity when full.
+        Returns False, changing nothing, if a column is new or a row
+        would have to be inserted before the last one. The caller then
+        rebuilds the frame (ohlcv_df setter)
+        """
+        if self.values is None or any(
+                col not in self.column_map for col in columns):
+            return False
+        epochs = np.asarray(epochs, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        n_rows = len(self.epochs)
+        rows = np.searchsorted(self.epochs, epochs)
+        existing = rows < n_rows
+        existing[existing] = self.epochs[rows[existing]] == epochs[existing]
+        new = ~existing
+        if (new.any() and n_rows > 0
+            and epochs[new][0] <= self.epochs[-1]):
+            return False
+
+        cols = [self.column_map.offsets[col] for col in columns]
+        n_new = int(new.sum())
+        self._reserve(n_rows + n_new)
+        if existing.any():
+            idx = np.ix_(rows[existing], cols)
+            updates = values[existing]
+            self.values[idx] = np.where(
+                np.isnan(updates), self.values[idx], updates)
+        if n_new > 0:
+            end = n_rows + n_new
+            self._epochs_buf[n_rows:end] = epochs[new]
+            self._values_buf[n_rows:end] = np.nan
+            self._values_buf[np.ix_(np.arange(n_rows, end), cols)] = (
+                values[new])
+            self.epochs = self._epochs_buf[:end]
+            self.values = self._values_buf[:end]
+        self._ohlcv_df = None
+        return True
+
+    def _reserve(self, n_rows):
+        """
+        Grows the buffers to fit n_rows. Arrays shared with a frame
+        (read-only) are copied into the feed's own buffers first
+        """
+        capacity = len(self._epochs_buf)
+        if (n_rows <= capacity and self._values_buf.flags.writeable
+            and self._epochs_buf.flags.writeable):
+            return
+        if n_rows > capacity:
+            capacity = max(n_rows, 2 * capacity)
+        n_filled = len(self.epochs)
+        epochs = np.empty(capacity, dtype=np.int64)
+        values = np.empty((capacity, len(self.column_map)), dtype=np.float64)
+        epochs[:n_filled] = self.epochs
+        values[:n_filled] = self.values
+        self._epochs_buf = epochs
+        self._values_buf = values
+        self.epochs = epochs[:n_filled]
+        self.values = values[:n_filled]
+
+    def _make_df(self, start, end):
+        epochs = self.epochs[start:end].copy()
+        df = pd.DataFrame(
+            self.values[start:end].copy(), columns=self.column_map.names,
+            index=pd.Index(epochs, name='epoch'))
+        df['utc'] = epochs_to_utc(epochs)
+        return df
+
+    def seek(self, utc):
+        """Returns position of the first row after `utc`"""
+        if utc is None:
+            return 0
+        return int(np.searchsorted(
+            self.epochs, utc_to_epoch(utc), side='right'))
+
     def update(self):
         pass
 
@@ -80,41 +371,54 @@ class OHLCVFeed():
         """Return t_minus rows from feed
         Which should represent the latest dates seen by Strategy
         """
-        data = self.ohlcv_df[self.ohlcv_df.index <= utc_to_epoch(
-            self.prior_time)]
-        return OHLCVData(data[-t_minus:])
+        if t_minus == 0:
+            return OHLCVData(self.ohlcv_df.iloc[:self.cursor])
+        start = max(self.cursor - t_minus, 0)
+        return OHLCVData(self._make_df(start, self.cursor))
 
     def peek(self):
-        row = self.ohlcv_df[self.ohlcv_df.index > utc_to_epoch(
-            self.prior_time)]
-        if len(row) > 0:
-            return OHLCVData(row.iloc[0].to_frame().T)
+        if self.cursor < len(self.epochs):
+            return self.get_bar(self.cursor)
         return None
 
     def next(self, refresh=False):
         if refresh:
             self.end = datetime.datetime.utcnow()
             self.update()
-        row = self.ohlcv_df[self.ohlcv_df.index > utc_to_epoch(
-            self.prior_time)]
-        if len(row) > 0:
-            row = row.iloc[0]
-            self.prior_time = row['utc']
-            return OHLCVData(row.to_frame().T)
+        if self.cursor < len(self.epochs):
+            bar = self.get_bar(self.cursor)
+            self.cursor += 1
+            self.prior_time = bar.utc
+            return bar
         print("No data after prior poll:", self.prior_time)
         return None
 
+    def get_bar(self, idx):
+        return OHLCVBar(
+            self.values[idx], self.column_map, int(self.epochs[idx]))
+
     def __len__(self):
-        return len(self.ohlcv_df)
+        return len(self.epochs)
 
 
 class OHLCVFileFeed(OHLCVFeed):
     def __init__(self, exchange_ids, assets, timeframe,
-                 start=None, end=None):
+                 start=None, end=None, tea_store=None,
+                 gap_fill=GapFill.NONE, join='outer', exchanges=None,
+                 report_gaps=False):
+        """
+        - exchanges : exchanges GapFill.REFETCH downloads gaps from
+        - report_gaps : print each asset's coverage when it has gaps
+        """
         super().__init__(start, end)
         self.exchange_ids = exchange_ids
         self.timeframe = timeframe
         self.assets = assets
+        self.tea_store = tea_store
+        self.gap_fill = gap_fill
+        self.join = join
+        self.exchanges = exchanges
+        self.report_gaps = report_gaps
         self.initialize()
 
     def initialize(self):
@@ -124,18 +428,21 @@ class OHLCVFileFeed(OHLCVFeed):
     def update(self):
         self.ohlcv_df = load_multiple_assets(
             self.exchange_ids, self.assets, self.timeframe,
-            self.start, self.end)
+            self.start, self.end, self.tea_store, self.gap_fill,
+            self.exchanges, self.join, report_gaps=self.report_gaps)
 
 
 class OHLCVExchangeFeed(OHLCVFeed):
     def __init__(self, exchanges, assets, timeframe,
-                 start, end=None, benchmark=True):
+                 start, end=None, benchmark=True, tea_store=None):
         super().__init__(start, end)
         self.exchanges = exchanges
         self.ex_ids = [ex.id for ex in exchanges]
         self.assets = assets
         self.timeframe = timeframe
         self.benchmark = benchmark
+        self.tea_store = tea_store
+        self.last_epochs = {}
         self.initialize()
 
     def initialize(self):
@@ -146,27 +453,62 @@ class OHLCVExchangeFeed(OHLCVFeed):
         self._download(self.start, self.end, update=False)
         self.ohlcv_df = load_multiple_assets(
             self.ex_ids, self.assets, self.timeframe,
-            self.start, self.end)
+            self.start, self.end, self.tea_store)
+        self.last_epochs = get_last_epochs(
+            self.ohlcv_df, self.exchanges, self.assets)
 
     def init_benchmarks(self):
         if self.benchmark:
+            symbols = set(asset.symbol for asset in self.assets)
             for ex in self.exchanges:
                 asset = get_benchmark_asset(ex)
-                self.assets.append(asset)
+                if asset is not None and asset.symbol not in symbols:
+                    symbols.add(asset.symbol)
+                    self.assets.append(asset)
 
     def next(self, refresh=True):
         return super().next(refresh)
 
     def update(self):
-        if self.ohlcv_df.empty:
-            most_recent_data_time = self.start
+        """
+        Fetches the last bar seen per asset and any newer ones, writes
+        them to the local file and into the feed's arrays in place
+        (see OHLCVFeed.upsert_rows). Other rows are left alone.
+        """
+        new_dfs = []
+        for ex in self.exchanges:
+            for asset in self.assets:
+                if is_asset_supported(ex, asset):
+                    df = self._fetch_new_bars(ex, asset)
+                    if len(df) > 0:
+                        new_dfs.append(df)
+        if len(new_dfs) == 0:
+            return
+        new_df = combine_asset_rows(new_dfs)
+        if not self.upsert_rows(
+                new_df.index.values, new_df.values, new_df.columns):
+            self.ohlcv_df = append_asset_rows(self.ohlcv_df, new_dfs)
+
+    def _fetch_new_bars(self, exchange, asset):
+        key = (exchange.id, asset.symbol)
+        last_epoch = self.last_epochs.get(key)
+        # The last bar may have been fetched while it was still forming,
+        # so it's fetched again and overwritten
+        if last_epoch is None:
+            since = self.start
         else:
-            most_recent_data_time = self.ohlcv_df.tail(1).iloc[0].get('utc')
-        self._download(
-            most_recent_data_time, self.end, update=True)
-        self.ohlcv_df = load_multiple_assets(
-            self.ex_ids, self.assets, self.timeframe,
-            self.start, self.end)
+            since = epoch_to_utc(last_epoch)
+        df = fetch_asset(exchange, asset, self.timeframe, since, self.end)
+        if last_epoch is not None:
+            df = df[df.index >= last_epoch]
+        if len(df) > 0:
+            fpath = get_ohlcv_fpath(asset, exchange.id, self.timeframe)
+            append_asset(df, fpath)
+            if self.tea_store is not None:
+                append_asset_tea(
+                    self.tea_store, df, asset, exchange.id, self.timeframe)
+            self.last_epochs[key] = int(df.index[-1])
+        return df
 
     def _download(self, start, end, update=True):
         for ex in self.exchanges:
@@ -174,7 +516,7 @@ class OHLCVExchangeFeed(OHLCVFeed):
                 if is_asset_supported(ex, asset):
                     download_ohlcv(
                         [ex], [asset], self.timeframe,
-                        start, end, update
+                        start, end, update, self.tea_store
                     )
 
 
@@ -183,47 +525,22 @@ class OHLCVExchangeFeed(OHLCVFeed):
 def get_usd_coin(ex_id):
     return ex_cfg.EXCHANGE_CONFIGS[ex_id]['usd_coin']
 
-def get_exchange_rate(df, quote_coin, new_cash_coin, ex_id):
-    assert coins.is_cash(new_cash_coin)
+def normalize_coin(coin, ex_id):
+    """USD and USDT are treated as the exchange's usd_coin"""
+    if coins.is_usd(coin):
+        return get_usd_coin(ex_id)
+    return coin
 
-    if coins.is_usd(new_cash_coin):
-        new_cash_coin = get_usd_coin(ex_id)
-    if coins.is_usd(quote_coin):
-        quote_coin = get_usd_coin(ex_id)
-    if quote_coin == new_cash_coin:
-        return pd.Series([1.0 for i in range(len(df))]).values
-
-    new_cash_symbol = coins.get_symbol(quote_coin, new_cash_coin)
-    cash_col_name = get_col_name('close', new_cash_symbol, ex_id)
-    if cash_col_name in df.columns:
-        return df[cash_col_name].values
-    else:
-        new_cash_symbol = coins.get_symbol(new_cash_coin, quote_coin)
-        cash_col_name = get_col_name('close', new_cash_symbol, ex_id)
-        return pd.Series(1.0 / df[cash_col_name]).values
+def get_exchange_rate(df, quote_coin, new_cash_coin, ex_id, rates=None):
+    assert coins.is_cash(new_cash_coin)
+    rates = CrossRates(df) if rates is None else rates
+    return rates.rate(quote_coin, new_cash_coin, ex_id)
 
-def get_cash_value(df, field, asset, ex_id, cash_coin):
+def get_cash_value(df, field, asset, ex_id, cash_coin, rates=None):
     assert coins.is_cash(cash_coin)
     assert field in ['open', 'high', 'low', 'close']
-    #print("Cash value of", asset.symbol, "in", cash_coin, "on exchange", ex_id)
-
-    if coins.is_usd(cash_coin):
-        cash_coin = get_usd_coin(ex_id)
-    if coins.is_usd(asset.quote):
-        asset.quote = get_usd_coin(ex_id)
-    cash_symbol = coins.get_symbol(asset.quote, cash_coin)
-
-    col_name = get_col_name(field, asset.symbol, ex_id)
-    col = df[col_name]
-
-    if asset.quote == cash_coin:
-        return col.values
-    if asset.base == cash_coin:
-        return col.values
-
-    cash_col_name = get_col_name(field, cash_symbol, ex_id)
-    cash_col = df[cash_col_name]
-    return (col * cash_col).values
+    rates = CrossRates(df) if rates is None else rates
+    return rates.cash_value(field, asset, ex_id, cash_coin)
 
 def is_asset_supported(exchange, asset):
     return asset.symbol in exchange.symbols
@@ -261,118 +578,542 @@ def get_ohlcv_fpath(asset, exchange_id, timeframe, outdir=cfg.DATA_DIR):
     return Path(outdir, fname)
 
 def fetch_asset(exchange, asset, timeframe, start, end=None):
-    ## TODO: Some exchanges adhere to limits. For instance BINANCE
-    # returns 500 rows, while POLONIEX returns all rows. Additionally
-    # exchanges offer different amounts of historical data. We need to
-    # update this method to:
-    #   1) Inform the user when requested dates are not available
-    #   2) Break up large date range into <500 so all exchanges work
+    """
+    Downloads [start, end) in exchange sized pages (see backfill_asset)
+    and tells the user about any range the exchange had no data for
+    """
     print("Downloading:", asset.symbol)
     assert timeframe.id in exchange.timeframes
     end = datetime.datetime.utcnow() if end is None else end
-    data = exchange.fetch_ohlcv(asset, timeframe, start)
-    df = make_asset_df(data, asset, exchange.id, start, end)
+    df, missing = backfill_asset(exchange, asset, timeframe, start, end)
+    for range_start, range_end in missing:
+        print("Data not available for {:s} on {:s}: {} - {}".format(
+            asset.symbol, exchange.id, range_start, range_end))
     print("Downloaded rows:", len(df))
     return df
 
-def fetch_and_save_asset(exchange, asset, timeframe, start, end=None):
+def fetch_ohlcv_page(exchange, asset, timeframe, start, end, limit=None):
+    # CCXTExchange requests are throttled by the exchange's TokenBucket
+    if limit is None:
+        data = exchange.fetch_ohlcv(asset, timeframe, start)
+    else:
+        data = exchange.fetch_ohlcv(asset, timeframe, start, limit=limit)
+    return make_asset_df(data, asset, exchange.id, start, end)
+
+def get_page_ranges(start, end, timeframe, limit):
+    """Splits [start, end) into windows of at most `limit` bars"""
+    span = timeframe.delta * limit
+    pages = []
+    page_start = start
+    while page_start < end:
+        page_end = min(page_start + span, end)
+        pages.append((page_start, page_end))
+        page_start = page_end
+    return pages
+
+def merge_ranges(ranges):
+    """Joins touching/overlapping (start, end) ranges"""
+    merged = []
+    for start, end in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def stitch_asset_dfs(dfs):
+    """Concatenates pages, dropping duplicate epochs (last one wins)"""
+    df = pd.concat(dfs)
+    df = df[~df.index.duplicated(keep='last')]
+    df.sort_index(inplace=True)
+    return df
+
+def backfill_asset(exchange, asset, timeframe, start, end=None,
+                   max_workers=4):
+    """
+    Fetches [start, end) in pages no larger than the exchange's
+    `ohlcv_limit` (ex_cfg). The first page finds where the exchange's
+    history begins, the remaining pages are fetched concurrently behind
+    the exchange's rate limiter and stitched together by epoch.
+    Returns (df, missing) where missing lists (start, end) ranges
+    the exchange returned no data for.
+    """
+    end = datetime.datetime.utcnow() if end is None else end
+    limit = get_ohlcv_page_limit(exchange.id)
+    first_df = fetch_ohlcv_page(
+        exchange, asset, timeframe, start, end, limit)
+    if len(first_df) == 0:
+        return first_df, [(start, end)]
+
+    missing = []
+    first_utc = epoch_to_utc(first_df.index[0])
+    if first_utc > start:
+        missing.append((start, first_utc))
+    if limit is None or len(first_df) < limit:
+        # Exchange returned everything it has up to `end`
+        last_utc = epoch_to_utc(first_df.index[-1]) + timeframe.delta
+        if last_utc < end:
+            missing.append((last_utc, end))
+        return first_df, missing
+
+    next_start = epoch_to_utc(first_df.index[-1]) + timeframe.delta
+    pages = get_page_ranges(next_start, end, timeframe, limit)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        page_dfs = list(pool.map(
+            lambda page: fetch_ohlcv_page(
+                exchange, asset, timeframe, page[0], page[1], limit),
+            pages))
+    df = stitch_asset_dfs([first_df] + page_dfs)
+    last_utc = epoch_to_utc(df.index[-1]) + timeframe.delta
+    for page, page_df in zip(pages, page_dfs):
+        if len(page_df) == 0 and page[0] < last_utc:
+            missing.append(page)
+    if last_utc < end:
+        missing.append((last_utc, end))
+    return df, merge_ranges(missing)
+
+def fetch_and_save_asset(exchange, asset, timeframe, start, end=None,
+                         tea_store=None):
+    """Saves the csv, and the TeaFile if given a `tea_store`"""
     df = fetch_asset(exchange, asset, timeframe, start, end)
     fpath = get_ohlcv_fpath(asset, exchange.id, timeframe)
-    df.to_csv(fpath, index=True)
+    save_asset(df, fpath)
+    if tea_store is not None:
+        save_asset_tea(tea_store, df, asset, exchange.id, timeframe)
     return df
 
-def update_local_asset_cache(exchange, asset, timeframe, start, end=None):
+def update_local_asset_cache(exchange, asset, timeframe, start, end=None,
+                             tea_store=None):
     fpath = get_ohlcv_fpath(asset, exchange.id, timeframe)
-    if os.path.exists(fpath):
+    if ohlcv_cache.exists(fpath):
         df = fetch_asset(exchange, asset, timeframe, start, end)
         df = merge_asset_dfs(df, fpath)
+        if tea_store is not None:
+            # The csv was rewritten anyway, rows may land anywhere
+            save_asset_tea(tea_store, df, asset, exchange.id, timeframe)
     else:
-        df = fetch_and_save_asset(exchange, asset, timeframe, start, end)
+        df = fetch_and_save_asset(
+            exchange, asset, timeframe, start, end, tea_store)
     return df
 
-def download_ohlcv(exchanges, assets, timeframe, start, end=None, update=False):
+def download_ohlcv(exchanges, assets, timeframe, start, end=None, update=False,
+                   tea_store=None):
     for ex in exchanges:
         for asset in assets:
             if update:
-                _ = update_local_asset_cache(ex, asset, timeframe, start, end)
+                _ = update_local_asset_cache(
+                    ex, asset, timeframe, start, end, tea_store)
             else:
-                _ = fetch_and_save_asset(ex, asset, timeframe, start, end)
+                _ = fetch_and_save_asset(
+                    ex, asset, timeframe, start, end, tea_store)
 
 def load_ohlcv(ex_id, asset, timeframe, start=None, end=None):
     fpath = get_ohlcv_fpath(asset, ex_id, timeframe)
     return load_asset(fpath, start, end)
 
+def save_asset(df, fpath):
+    df.to_csv(fpath, index=True)
+    ohlcv_cache.save(df, fpath)
+
 def load_asset(fpath, start=None, end=None):
-    df = pd.read_csv(
-        fpath, index_col='epoch',
-        parse_dates=['utc'],
-        date_parser=str_to_date)
+    df = ohlcv_cache.load_or_convert(fpath)
     df.sort_index(inplace=True)
     df = get_time_range(df, start, end)
     return df
 
-def load_multiple_assets(exchange_ids, assets, timeframe, start, end=None):
+def append_asset(df, fpath):
+    """
+    Appends new rows to the end of an asset file without rewriting it.
+    Rows can repeat the last epoch in the file, the latest row wins
+    when the file is loaded (ohlcv_cache.read_csv).
+    The binary cache goes stale and is rebuilt on the next full load.
+    """
+    if os.path.exists(fpath):
+        df.to_csv(fpath, mode='a', header=False, index=True)
+    elif ohlcv_cache.exists(fpath):
+        merge_asset_dfs(df, fpath)
+    else:
+        save_asset(df, fpath)
+
+def combine_asset_rows(asset_dfs):
+    """Joins per-asset rows on epoch, without the utc column"""
+    return pd.concat(
+        [df.drop('utc', axis=1) for df in asset_dfs], axis=1, sort=True)
+
+def append_asset_rows(ohlcv_df, asset_dfs):
+    """
+    Adds newly fetched per-asset rows to a multi-asset frame
+    Cells of existing rows are overwritten with the new non-NaN values,
+    rows newer than the frame are appended at the end.
+    """
+    new_df = combine_asset_rows(asset_dfs)
+    existing = new_df.index.isin(ohlcv_df.index)
+    if existing.any():
+        overlap = new_df[existing]
+        for col in overlap.columns:
+            values = overlap[col].dropna()
+            ohlcv_df.loc[values.index, col] = values
+        new_df = new_df[~existing]
+    if len(new_df) == 0:
+        return ohlcv_df
+    new_df['utc'] = epochs_to_utc(new_df.index.values)
+    ohlcv_df = pd.concat([ohlcv_df, new_df], sort=False)
+    ohlcv_df.index.name = 'epoch'
+    return ohlcv_df
+
+def get_last_epochs(ohlcv_df, exchanges, assets):
+    """Last epoch with data per (exchange id, symbol) in a multi-asset frame"""
+    last_epochs = {}
+    for ex in exchanges:
+        for asset in assets:
+            col_name = get_col_name('close', asset.symbol, ex.id)
+            if col_name in ohlcv_df.columns:
+                last_epoch = ohlcv_df[col_name].last_valid_index()
+                if last_epoch is not None:
+                    last_epochs[(ex.id, asset.symbol)] = int(last_epoch)
+    return last_epochs
+
+def load_multiple_assets(exchange_ids, assets, timeframe, start, end=None,
+                         tea_store=None, gap_fill=GapFill.NONE,
+                         exchanges=None, join='outer', max_workers=8,
+                         report_gaps=False):
     """
     Returns OHLCV dataframe for multiple assets + exchanges
     The data is loaded from previously downloaded files
+    (TeaFiles from `tea_store` when available, otherwise csv cache,
+    otherwise resampled from a finer cached timeframe)
     If it cannot find a particular file it skips it and keeps going (dangerous)
         Why? Not every exchange supports every asset. This is especially
         important for benchmark assets like USD / USDT.
-    Column name syntax = `field_asset_exchange`
+    Gaps are repaired according to `gap_fill`, GapFill.REFETCH downloads
+    them from `exchanges` (a list of exchanges). Each asset's coverage is
+    printed if it has gaps and `report_gaps` is set
+    Assets are loaded in parallel and joined on the union ('outer')
+    or intersection ('inner') of their epochs (see align_asset_dfs)
+    Column name syntax = `field_asset_exchange`, each exchange + asset
+    is loaded once even if listed twice
     """
-    df = pd.DataFrame()
+    exchanges = {ex.id: ex for ex in (exchanges or [])}
+    jobs = []
+    seen = set()
     for ex_id in exchange_ids:
         for asset in assets:
-            fpath = get_ohlcv_fpath(asset, ex_id, timeframe)
-            if os.path.exists(fpath):
-                data = load_asset(fpath, start, end)
-                for col in data.columns:
-                    df[col] = data[col]
-            else:
-                print("Fpath does not exist: {:s}".format(str(fpath)))
-    # TODO: Is this okay? How to fill in missing values? How to handle them?
-    # df.dropna(inplace=True)
-    df['utc'] = [epoch_to_utc(t) for t in df.index]
+            if (ex_id, asset.symbol) not in seen:
+                seen.add((ex_id, asset.symbol))
+                jobs.append((ex_id, asset))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        dfs = list(pool.map(
+            lambda job: load_asset_data(
+                job[0], job[1], timeframe, start, end, tea_store,
+                gap_fill, exchanges.get(job[0]), report_gaps),
+            jobs))
+    dfs = [data for data in dfs if data is not None]
+    epochs, values, column_map = align_asset_dfs(dfs, join)
+    df = pd.DataFrame(
+        values, columns=column_map.names,
+        index=pd.Index(epochs, name='epoch'), copy=False)
+    df['utc'] = epochs_to_utc(epochs)
+    return df
+
+def load_asset_data(ex_id, asset, timeframe, start, end=None,
+                    tea_store=None, gap_fill=GapFill.NONE, exchange=None,
+                    report_gaps=False):
+    """Loads and repairs a single asset for load_multiple_assets"""
+    fpath = get_ohlcv_fpath(asset, ex_id, timeframe)
+    if (tea_store is not None
+        and tea_store.exists(ex_id, asset, timeframe)):
+        data = load_asset_tea(
+            tea_store, ex_id, asset, timeframe, start, end)
+    elif ohlcv_cache.exists(fpath):
+        data = load_asset(fpath, start, end)
+    else:
+        data = load_resampled_asset(ex_id, asset, timeframe, start, end)
+        if data is None:
+            print("Fpath does not exist: {:s}".format(str(fpath)))
+            return None
+    report = get_gap_report(data.index.values, timeframe.seconds)
+    if report['gaps'] > 0:
+        if report_gaps:
+            print_gap_report(ex_id, asset, report)
+        data = fill_gaps(data, asset, ex_id, timeframe, gap_fill, exchange)
+        if gap_fill == GapFill.REFETCH and ohlcv_cache.exists(fpath):
+            merge_asset_dfs(data, fpath)
+        if gap_fill == GapFill.REFETCH and tea_store is not None:
+            save_asset_tea(tea_store, data, asset, ex_id, timeframe)
+    return data
+
+def align_asset_dfs(dfs, join='outer'):
+    """
+    Joins epoch indexed asset frames in one pass on the union ('outer')
+    or intersection ('inner') of their epochs. Cells an asset has no
+    bar for are NaN.
+    Returns (epochs, values, column_map) where values is a single
+    float64 block of shape (n_epochs, n_columns). A single asset needs
+    no join, its values are returned as is (a read-only view of a
+    TeaFile memmap stays one), otherwise they're copied into a new
+    contiguous block
+    """
+    if join not in ('outer', 'inner'):
+        raise Exception("Join {:s} not supported".format(str(join)))
+    if len(dfs) == 1:
+        columns = [col for col in dfs[0].columns if col != 'utc']
+        return (dfs[0].index.values.astype(np.int64, copy=False),
+                dfs[0][columns].to_numpy(dtype=np.float64, copy=False),
+                ColumnMap(columns))
+    indexes = [df.index.values.astype(np.int64) for df in dfs]
+    if len(indexes) == 0:
+        epochs = np.array([], dtype=np.int64)
+    else:
+        epochs, counts = np.unique(
+            np.concatenate(indexes), return_counts=True)
+        if join == 'inner':
+            epochs = epochs[counts == len(indexes)]
+
+    columns = [[col for col in df.columns if col != 'utc'] for df in dfs]
+    column_map = ColumnMap([col for cols in columns for col in cols])
+    values = np.full((len(epochs), len(column_map)), np.nan)
+    offset = 0
+    for df, index, cols in zip(dfs, indexes, columns):
+        rows = np.searchsorted(epochs, index)
+        found = rows < len(epochs)
+        found[found] = epochs[rows[found]] == index[found]
+        values[rows[found], offset:offset+len(cols)] = (
+            df[cols].to_numpy(dtype=np.float64)[found])
+        offset += len(cols)
+    return epochs, values, column_map
+
+def asset_df_to_tea_records(df, asset, ex_id):
+    cols = get_ohlcv_columns(asset, ex_id)[1:]
+    return tea.make_records(
+        df.index.values, *[df[col].values for col in cols])
+
+def save_asset_tea(store, df, asset, ex_id, timeframe):
+    records = asset_df_to_tea_records(df, asset, ex_id)
+    return store.save(ex_id, asset, timeframe, records)
+
+def append_asset_tea(store, df, asset, ex_id, timeframe):
+    """Appends newer rows, a row for the last stored epoch replaces it"""
+    records = asset_df_to_tea_records(df, asset, ex_id)
+    return store.append(ex_id, asset, timeframe, records)
+
+def load_asset_tea(store, ex_id, asset, timeframe, start=None, end=None):
+    """
+    Asset DataFrame over the memory mapped TeaFile range. The OHLCV
+    columns are a single read-only block viewing the memmap, not copies
+    """
+    records = store.range(ex_id, asset, timeframe, start, end)
+    epochs = tea.get_epochs(records)
+    cols = get_ohlcv_columns(asset, ex_id)[1:]
+    df = pd.DataFrame(
+        tea.get_values(records), columns=cols,
+        index=pd.Index(epochs, name='epoch'), copy=False)
+    df['utc'] = epochs_to_utc(epochs)
     return df
 
+def convert_asset_to_tea(store, ex_id, asset, timeframe):
+    """Writes the cached csv history of an asset into `store`"""
+    df = load_ohlcv(ex_id, asset, timeframe)
+    return save_asset_tea(store, df, asset, ex_id, timeframe)
+
+def get_resampled_fpath(asset, exchange_id, timeframe, base,
+                        outdir=cfg.DATA_DIR):
+    """Derived series only live in the binary cache, never as csv"""
+    fname = '{:s}_{:s}_{:s}_from_{:s}.csv'.format(
+        exchange_id, asset.id, timeframe.id, base.id)
+    return Path(outdir, fname)
+
+def get_base_timeframe(exchange_id, asset, timeframe, outdir=cfg.DATA_DIR):
+    """Finest locally cached timeframe `timeframe` can be built from"""
+    for base in sorted(Timeframe, key=lambda tf: tf.seconds):
+        if base.seconds >= timeframe.seconds:
+            break
+        fpath = get_ohlcv_fpath(asset, exchange_id, base, outdir)
+        if (timeframe.seconds % base.seconds == 0
+            and ohlcv_cache.exists(fpath)):
+            return base
+    return None
+
+def resample_ohlcv(epochs, values, seconds, base_seconds):
+    """
+    Aggregates epoch sorted rows of (open, high, low, close, volume)
+    into `seconds` wide bars aligned to the epoch (first/max/min/last/sum).
+    Bars the base series doesn't cover from their start (a series
+    beginning mid-interval) or to their end (still forming) are dropped,
+    so every bar matches a later resample of a longer series.
+    """
+    if len(epochs) == 0:
+        return epochs, values
+    buckets = epochs // seconds * seconds
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(buckets)) + 1])
+    ends = np.append(starts[1:], len(epochs))
+    bars = np.empty((len(starts), 5), dtype=np.float64)
+    bars[:, 0] = values[starts, 0]
+    bars[:, 1] = np.maximum.reduceat(values[:, 1], starts)
+    bars[:, 2] = np.minimum.reduceat(values[:, 2], starts)
+    bars[:, 3] = values[ends - 1, 3]
+    bars[:, 4] = np.add.reduceat(values[:, 4], starts)
+    bar_epochs = buckets[starts]
+    if epochs[-1] + base_seconds < bar_epochs[-1] + seconds:
+        bar_epochs, bars = bar_epochs[:-1], bars[:-1]
+    if len(bar_epochs) > 0 and epochs[0] > bar_epochs[0]:
+        bar_epochs, bars = bar_epochs[1:], bars[1:]
+    return bar_epochs, bars
+
+def resample_asset(df, asset, ex_id, timeframe, base):
+    cols = get_ohlcv_columns(asset, ex_id)[1:]
+    epochs, values = resample_ohlcv(
+        df.index.values.astype(np.int64),
+        df[cols].to_numpy(dtype=np.float64),
+        timeframe.seconds, base.seconds)
+    data = pd.DataFrame(
+        values, columns=cols, index=pd.Index(epochs, name='epoch'))
+    data['utc'] = epochs_to_utc(epochs)
+    return data
+
+def load_resampled_asset(ex_id, asset, timeframe, start=None, end=None,
+                         outdir=cfg.DATA_DIR):
+    """
+    Builds `timeframe` bars from the finest cached series of the asset.
+    The result is cached and rebuilt whenever the base series changes.
+    Returns None if no usable base series has been downloaded.
+    """
+    base = get_base_timeframe(ex_id, asset, timeframe, outdir)
+    if base is None:
+        return None
+    base_fpath = get_ohlcv_fpath(asset, ex_id, base, outdir)
+    fpath = get_resampled_fpath(asset, ex_id, timeframe, base, outdir)
+    stamp = ohlcv_cache.get_stamp(base_fpath)
+    if ohlcv_cache.is_fresh(fpath, stamp):
+        df = ohlcv_cache.load(fpath)
+    else:
+        print("Resampling {:s} from {:s}: {:s}".format(
+            timeframe.id, base.id, str(base_fpath)))
+        base_df = load_asset(base_fpath)
+        df = resample_asset(base_df, asset, ex_id, timeframe, base)
+        ohlcv_cache.save(df, fpath, source=stamp)
+    return get_time_range(df, start, end)
+
 def make_asset_df(data, asset, ex_id, start=None, end=None):
     columns = get_ohlcv_columns(asset, ex_id)
     df = pd.DataFrame(data, columns=columns)
     df['epoch'] = df['epoch'] // 1000 # ccxt includes millis
     df['epoch'] = df['epoch'].astype(int)
-    df['utc'] = [epoch_to_utc(t) for t in df['epoch']]
+    df['utc'] = epochs_to_utc(df['epoch'].values)
     df.set_index('epoch', inplace=True)
     df.sort_index(inplace=True)
     df = get_time_range(df, start, end)
     return df
 
 def merge_asset_dfs(new_data, fpath):
-    cur_df = pd.read_csv(
-        fpath, index_col='epoch',
-        parse_dates=['utc'],
-        date_parser=str_to_date)
+    cur_df = ohlcv_cache.load_or_convert(fpath)
     new_df = pd.DataFrame(new_data)
     cur_df = pd.concat([cur_df, new_df])
     cur_df = cur_df[~cur_df.index.duplicated(keep='last')]
-    cur_df.to_csv(fpath, index=True)
+    cur_df.sort_index(inplace=True)
+    save_asset(cur_df, fpath)
     return cur_df
 
+def find_gaps(epochs, timestep):
+    """
+    Returns (starts, ends) arrays of the missing [start, end) ranges in a
+    sorted array of epochs expected every `timestep` seconds
+    """
+    epochs = np.asarray(epochs, dtype=np.int64)
+    idx = np.flatnonzero(np.diff(epochs) > timestep)
+    return epochs[idx] + timestep, epochs[idx + 1]
+
+def count_missing(starts, ends, timestep):
+    return int((-((starts - ends) // timestep)).sum())
+
+def get_gap_report(epochs, timestep):
+    starts, ends = find_gaps(epochs, timestep)
+    n_bars = len(epochs)
+    n_missing = count_missing(starts, ends, timestep)
+    return {
+        'start': epoch_to_utc(int(epochs[0])) if n_bars else None,
+        'end': epoch_to_utc(int(epochs[-1])) if n_bars else None,
+        'bars': n_bars,
+        'gaps': len(starts),
+        'missing': n_missing,
+        'coverage': n_bars / (n_bars + n_missing) if n_bars else 0.0,
+    }
+
+def print_gap_report(ex_id, asset, report):
+    print("Coverage {:s} {:s}: {:.2%} ({:d} gaps, {:d} missing bars)".format(
+        ex_id, asset.symbol, report['coverage'],
+        report['gaps'], report['missing']))
+
+def get_coverage_report(exchange_ids, assets, timeframe, outdir=cfg.DATA_DIR):
+    """
+    Gap report of every cached asset file, one row per exchange + asset
+    """
+    rows = []
+    for ex_id in exchange_ids:
+        for asset in assets:
+            fpath = get_ohlcv_fpath(asset, ex_id, timeframe, outdir)
+            if not ohlcv_cache.exists(fpath):
+                continue
+            df = load_asset(fpath)
+            report = get_gap_report(df.index.values, timeframe.seconds)
+            report['exchange_id'] = ex_id
+            report['symbol'] = asset.symbol
+            rows.append(report)
+    return pd.DataFrame(rows)
+
+def fill_gaps(df, asset, ex_id, timeframe, gap_fill, exchange=None):
+    """
+    Repairs the missing bars of an epoch indexed asset DataFrame
+        FFILL - bars repeat the previous close with zero volume
+        MARK - bars are inserted with NaN values
+        REFETCH - missing ranges are downloaded from `exchange`
+    """
+    if gap_fill == GapFill.NONE or len(df) == 0:
+        return df
+    timestep = timeframe.seconds
+    epochs = df.index.values.astype(np.int64)
+    starts, ends = find_gaps(epochs, timestep)
+    if len(starts) == 0:
+        return df
+    if gap_fill == GapFill.REFETCH:
+        return refetch_gaps(exchange, df, asset, timeframe, starts, ends)
+
+    grid = np.union1d(
+        epochs, np.arange(epochs[0], epochs[-1] + 1, timestep))
+    cols = get_ohlcv_columns(asset, ex_id)[1:]
+    filled = df[cols].reindex(pd.Index(grid, name='epoch'))
+    if gap_fill == GapFill.FFILL:
+        open_, high, low, close, volume = cols
+        missing = filled[close].isnull()
+        filled[close] = filled[close].ffill()
+        for col in [open_, high, low]:
+            filled[col] = filled[col].where(~missing, filled[close])
+        filled[volume] = filled[volume].fillna(0.0)
+    filled['utc'] = epochs_to_utc(grid)
+    return filled
+
+def refetch_gaps(exchange, df, asset, timeframe, starts, ends):
+    """Downloads the missing ranges and stitches them into `df`"""
+    if exchange is None:
+        raise Exception("Exchange required to refetch missing bars")
+    dfs = [df]
+    for start, end in zip(starts, ends):
+        data, missing = backfill_asset(
+            exchange, asset, timeframe,
+            epoch_to_utc(int(start)), epoch_to_utc(int(end)))
+        for range_start, range_end in missing:
+            print("Data not available for {:s} on {:s}: {} - {}".format(
+                asset.symbol, exchange.id, range_start, range_end))
+        dfs.append(data)
+    return stitch_asset_dfs(dfs)
+
 def check_missing_timesteps(df, timestep):
-    df = df.sort_values(by='utc')
-    start_time = df.iloc[0]['utc']
-    end_time = df.iloc[-1]['utc']
-    print("Start", start_time)
-    print("End", end_time)
-    last_time = start_time
-    n_missing = 0
-    for idx,row in df[1:].iterrows():
-        cur_time = row['utc']
-        if cur_time != last_time + datetime.timedelta(seconds=timestep):
-            print("Expected:", last_time + datetime.timedelta(seconds=timestep),
-                  "| Time:", cur_time)
-            n_missing += (cur_time - last_time).seconds//timestep
-        last_time = cur_time
-    return n_missing
+    """Returns the number of bars missing from an epoch indexed DataFrame"""
+    epochs = np.sort(df.index.values.astype(np.int64))
+    report = get_gap_report(epochs, timestep)
+    print("Start", report['start'])
+    print("End", report['end'])
+    print("Gaps", report['gaps'], "| Missing", report['missing'])
+    return report['missing']
 
 EXCHANGE_FEED = 'EXCHANGE_FEED'
 CSV_FEED = 'CSV_FEED'
@@ -1,5 +1,6 @@
 import os
 import datetime
+import numpy as np
 import pandas as pd
 from pathlib import Path
 
@@ -11,9 +12,12 @@ from punisher.trading import coins
 from punisher.utils.dates import get_time_range
 from punisher.utils.dates import epoch_to_utc, utc_to_epoch
 from punisher.utils.dates import str_to_date
+from punisher.utils.files import load_json
 
 
 ORDER_BOOK_KEYS = {}
+# Where order_book_fetcher.py writes L2/L3 snapshots
+ORDER_BOOK_DIR = Path(cfg.DATA_DIR, 'order_book')
 
 class BookData():
     def __init__(self, book_df):
@@ -57,8 +61,134 @@ class BookFeed():
         return len(self.book_df)
 
 
+class BookReplay():
+    """
+    Recorded L2 snapshots compacted into (n_snapshots, depth) arrays,
+    asks ascending and bids descending like ccxt returns them. Levels past
+    a snapshot's depth have NaN prices and 0.0 sizes. Used to simulate
+    market order fills against the book in effect at a given time
+    - max_age : seconds a snapshot stays in effect, None for no limit
+    """
+    def __init__(self, epochs, ask_prices, ask_sizes, bid_prices, bid_sizes,
+                 max_age=None):
+        self.epochs = epochs
+        self.prices = {'buy': ask_prices, 'sell': bid_prices}
+        self.sizes = {'buy': ask_sizes, 'sell': bid_sizes}
+        self.max_age = max_age
+
+    @classmethod
+    def from_snapshots(cls, snapshots, depth=None, max_age=None):
+        """Snapshots are ccxt order book dicts (timestamp in ms)"""
+        snapshots = sorted(snapshots, key=lambda snap: snap['timestamp'])
+        if depth is None:
+            depth = max([max(len(snap['asks']), len(snap['bids']))
+                         for snap in snapshots] + [1])
+        epochs = np.array(
+            [snap['timestamp'] for snap in snapshots], dtype=np.int64)
+        sides = []
+        for key in ['asks', 'bids']:
+            prices = np.full((len(snapshots), depth), np.nan)
+            sizes = np.zeros((len(snapshots), depth))
+            for i, snap in enumerate(snapshots):
+                levels = np.array(snap[key][:depth], dtype=float).reshape(-1, 2)
+                prices[i, :len(levels)] = levels[:, 0]
+                sizes[i, :len(levels)] = levels[:, 1]
+            sides.extend([prices, sizes])
+        return cls(epochs, *sides, max_age=max_age)
+
+    @classmethod
+    def from_files(cls, fpaths, depth=None, max_age=None):
+        return cls.from_snapshots(
+            [load_json(fpath) for fpath in fpaths], depth, max_age)
+
+    @classmethod
+    def load(cls, fpath, max_age=None):
+        """Loads the compacted form written by `save`"""
+        with np.load(fpath) as npz:
+            return cls(npz['epochs'], npz['ask_prices'], npz['ask_sizes'],
+                       npz['bid_prices'], npz['bid_sizes'], max_age)
+
+    def save(self, fpath):
+        with open(fpath, 'wb') as f:
+            np.savez(
+                f,
+                epochs=self.epochs,
+                ask_prices=self.prices['buy'],
+                ask_sizes=self.sizes['buy'],
+                bid_prices=self.prices['sell'],
+                bid_sizes=self.sizes['sell'])
+
+    def get_snapshot_idx(self, epochs_ms):
+        """Latest snapshot at or before each time, -1 if none in effect"""
+        epochs_ms = np.asarray(epochs_ms, dtype=np.int64)
+        idx = np.searchsorted(self.epochs, epochs_ms, side='right') - 1
+        if self.max_age is not None:
+            age = epochs_ms - self.epochs[np.maximum(idx, 0)]
+            idx[age > self.max_age * 1000] = -1
+        return idx
+
+    def fill(self, side, quantities, epochs_ms):
+        """
+        Walks the book for each order ('buy' takes asks, 'sell' bids)
+        Returns (volume weighted prices, filled quantities). Orders larger
+        than the recorded depth fill partially, NaN price if nothing fills
+        """
+        idx = self.get_snapshot_idx(epochs_ms)
+        prices = self.prices[side][idx]
+        sizes = np.where((idx >= 0)[:, None], self.sizes[side][idx], 0.0)
+        quantities = np.asarray(quantities, dtype=float)[:, None]
+        ahead = np.cumsum(sizes, axis=1) - sizes
+        filled = np.clip(quantities - ahead, 0.0, sizes)
+        cost = np.where(filled > 0, filled * prices, 0.0).sum(axis=1)
+        total = filled.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            vwap = np.where(total > 0, cost / total, np.nan)
+        return vwap, total
+
+    def queue_size(self, side, prices, epochs_ms):
+        """
+        Size displayed at each price on the side of the book a limit
+        order of `side` joins (buys queue on the bids), 0.0 if the
+        price isn't a recorded level
+        """
+        book = 'sell' if side == 'buy' else 'buy'
+        idx = self.get_snapshot_idx(epochs_ms)
+        prices = np.asarray(prices, dtype=float)[:, None]
+        at_price = (self.prices[book][idx] == prices) & (idx >= 0)[:, None]
+        return np.where(at_price, self.sizes[book][idx], 0.0).sum(axis=1)
+
+    def __len__(self):
+        return len(self.epochs)
+
+
 # Helpers
 
+def get_snapshot_fpaths(ex_id, asset, level=2, outdir=ORDER_BOOK_DIR):
+    """Snapshot files written by order_book_fetcher, oldest first"""
+    pattern = '{:s}_{:s}_{:d}_*.json'.format(ex_id, asset.id, level)
+    return sorted(Path(outdir).glob(pattern), key=get_snapshot_epoch)
+
+def get_snapshot_epoch(fpath):
+    return int(Path(fpath).stem.rsplit('_', 1)[1])
+
+def load_book_replay(ex_id, asset, depth=None, max_age=None,
+                     outdir=ORDER_BOOK_DIR):
+    """
+    BookReplay of the asset's L2 snapshots. The compacted .npz is reused
+    until newer snapshot files show up
+    """
+    fpaths = get_snapshot_fpaths(ex_id, asset, 2, outdir)
+    npz_fpath = Path(outdir, '{:s}_{:s}_2{:s}'.format(ex_id, asset.id, c.NPZ))
+    if os.path.exists(npz_fpath):
+        replay = BookReplay.load(npz_fpath, max_age)
+        if len(fpaths) == 0 or (len(replay) > 0
+            and replay.epochs[-1] >= get_snapshot_epoch(fpaths[-1])):
+            return replay
+    replay = BookReplay.from_files(fpaths, depth, max_age)
+    replay.save(npz_fpath)
+    return replay
+
+
 
 def get_book_fname(exchange_id, asset):
     fname = '{:s}_{:s}.csv'.format(
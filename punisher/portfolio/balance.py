@@ -112,10 +112,12 @@ class Balance():
             # Performing the buy... so we take the funds allocated for trading
             # and subtract them by the trade cost
             # we then increase our base funds by the quantity of the trade
+            # Only price * quantity was held for the order, the fee comes
+            # out of the free funds
             self.update(
                 currency=asset.quote,
-                delta_free=0.0,
-                delta_used=-((price * quantity) + fee)
+                delta_free=-fee,
+                delta_used=-(price * quantity)
             )
             self.update(
                 currency=asset.base,
@@ -150,14 +152,16 @@ class Balance():
         self.used[currency] = 0.0
         self.total[currency] = 0.0
 
-    def is_balance_sufficient(self, asset, quantity, price, order_type):
+    def is_balance_sufficient(self, asset, quantity, price, order_type,
+                              fee=0.0):
         """
         We don't support Margin orders yet.
         All balances must be positive.
+        Buys must also cover `fee` (in the quote currency)
         """
         self._ensure_asset_in_balance(asset)
         if order_type.is_buy():
-            return price * quantity <= self.get(
+            return price * quantity + fee <= self.get(
                 asset.quote)[BalanceType.FREE]
         elif order_type.is_sell():
             return quantity <= self.get(
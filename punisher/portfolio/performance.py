@@ -2,6 +2,7 @@ import json
 import datetime
 import copy
 
+import numpy as np
 import pandas as pd
 
 from punisher.utils.encoders import EnumEncoder
@@ -44,11 +45,74 @@ class PerformanceTracker():
         })
         self.update_performance()
 
+    def add_periods(self, starts, ends, cash, values):
+        """
+        Appends one period per element of the equally sized arrays,
+        `cash` and `values` hold the end cash and end total value
+        """
+        if len(ends) == 0:
+            return
+        if len(self.periods) == 0:
+            first_cash = self.starting_cash
+            first_val = self.starting_cash
+        else:
+            first_cash = self.periods[-1]['end_cash']
+            first_val = self.periods[-1]['end_value']
+        cash = np.asarray(cash, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        start_cash = np.concatenate([[first_cash], cash[:-1]])
+        start_vals = np.concatenate([[first_val], values[:-1]])
+        pnl = values - self.starting_cash
+        if self.starting_cash == 0.0:
+            returns = np.zeros(len(values))
+        else:
+            returns = pnl / self.starting_cash
+        columns = zip(starts, ends, start_cash.tolist(), cash.tolist(),
+                      start_vals.tolist(), values.tolist(),
+                      pnl.tolist(), returns.tolist())
+        self.periods.extend({
+            'start_time': start,
+            'end_time': end,
+            'start_cash': s_cash,
+            'end_cash': e_cash,
+            'start_value': s_val,
+            'end_value': e_val,
+            'pnl': p,
+            'returns': r,
+        } for start, end, s_cash, e_cash, s_val, e_val, p, r in columns)
+        self.update_performance()
+
     def update_performance(self):
         if len(self.periods) > 0:
             self.pnl = self.periods[-1]['pnl']
             self.returns = self.periods[-1]['returns']
 
+    def summary(self):
+        """Headline metrics of the tracked periods"""
+        values = np.array([p['end_value'] for p in self.periods])
+        if len(values) == 0:
+            max_drawdown = 0.0
+        else:
+            peaks = np.maximum.accumulate(values)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                drawdowns = np.where(peaks > 0, values / peaks - 1.0, 0.0)
+            max_drawdown = float(drawdowns.min())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            period_returns = np.diff(values) / values[:-1]
+        period_returns = period_returns[np.isfinite(period_returns)]
+        if len(period_returns) > 1 and period_returns.std() > 0:
+            sharpe = float(period_returns.mean() / period_returns.std())
+        else:
+            sharpe = 0.0
+        return {
+            'pnl': self.pnl,
+            'returns': self.returns,
+            'end_value': float(values[-1]) if len(values) else self.starting_cash,
+            'max_drawdown': max_drawdown,
+            'sharpe': sharpe,
+            'periods': len(values),
+        }
+
     def calc_pnl(self, start_val, end_val):
         return end_val - start_val
 
@@ -72,12 +136,13 @@ class PerformanceTracker():
     def make_positions_dict(self, positions):
         return [pos.to_dict() for pos in positions]
 
-    def to_dict(self):
-        dct = copy.deepcopy(vars(self))
+    def to_dict(self, include_periods=True):
+        dct = {k: copy.deepcopy(v) for k, v in vars(self).items()
+               if k != 'periods'}
         dct['timeframe'] = self.timeframe.name
-        for p in dct['periods']:
-            p['start_time'] = date_to_str(p['start_time'])
-            p['end_time'] = date_to_str(p['end_time'])
+        dct['periods'] = []
+        if include_periods:
+            dct['periods'] = [period_to_dict(p) for p in self.periods]
         return dct
 
     @classmethod
@@ -87,10 +152,7 @@ class PerformanceTracker():
             starting_cash=dct['starting_cash'],
             timeframe=Timeframe[dct['timeframe']],
         )
-        for p in dct['periods']:
-            p['start_time'] = str_to_date(p['start_time'])
-            p['end_time'] = str_to_date(p['end_time'])
-        perf.periods = dct['periods']
+        perf.periods = [period_from_dict(p) for p in dct['periods']]
         perf.pnl = dct['pnl']
         perf.returns = dct['returns']
         return perf
@@ -109,3 +171,16 @@ class PerformanceTracker():
 
     def __repr__(self):
         return self.to_json()
+
+
+def period_to_dict(period):
+    dct = dict(period)
+    dct['start_time'] = date_to_str(period['start_time'])
+    dct['end_time'] = date_to_str(period['end_time'])
+    return dct
+
+def period_from_dict(dct):
+    period = dict(dct)
+    period['start_time'] = str_to_date(dct['start_time'])
+    period['end_time'] = str_to_date(dct['end_time'])
+    return period
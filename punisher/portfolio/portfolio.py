@@ -31,16 +31,17 @@ class Portfolio():
         self.positions = [] if positions is None else positions
 
     def update(self, last_update_time, orders, latest_prices):
-        self.update_positions(orders, last_update_time)
+        self.update_positions(orders)
         self.update_position_prices(latest_prices)
 
     def update_performance(self, start, end):
         self.perf.add_period(start, end, self.cash, self.positions)
 
-    def update_positions(self, orders, last_update_time):
+    def update_positions(self, orders):
         for order in orders:
-            # Updating postions with new orders from previous update:
-            for trade in order.get_new_trades(last_update_time):
+            # Updating positions with trades not applied yet. The order's
+            # trade cursor makes this safe to call repeatedly
+            for trade in order.consume_new_trades():
                 pos = self.get_position(order.asset)
                 if pos is None:
                     pos = Position(
@@ -116,7 +117,7 @@ class Portfolio():
     def starting_cash(self):
         return self.starting_balance.get(self.cash_currency)[BalanceType.TOTAL]
 
-    def to_dict(self):
+    def to_dict(self, include_periods=True):
         return {
             'cash_currency': self.cash_currency,
             'starting_balance': self.starting_balance.to_dict(),
@@ -126,7 +127,7 @@ class Portfolio():
             'pnl': self.perf.pnl,
             'returns': self.perf.returns,
             'total_value': self.total_value,
-            'performance': self.perf.to_dict(),
+            'performance': self.perf.to_dict(include_periods),
             'positions': [pos.to_dict() for pos in self.positions]
         }
 
@@ -4,6 +4,8 @@ import random
 import argparse
 from copy import deepcopy
 
+import numpy as np
+
 import punisher.config as cfg
 import punisher.constants as c
 from punisher.feeds import OHLCVFileFeed
@@ -26,7 +28,7 @@ from .strategy import Strategy
 parser = argparse.ArgumentParser(description='Punisher Dash Vizualizer')
 parser.add_argument('-n', '--name', help='name of your experiment', default='default', type=str)
 parser.add_argument('-p', '--plot', help='include Dash visualizations?', action="store_true")
-parser.add_argument('-m', '--mode', help='TradeMode - backtest, simulate, live', default='backtest', type=str)
+parser.add_argument('-m', '--mode', help='TradeMode - backtest, vectorized, simulate, live', default='backtest', type=str)
 parser.add_argument('-v', '--verbose', help='log to console?', action="store_true")
 parser.add_argument('-c', '--cash', help='starting cash', default=1.0, type=float)
 parser.add_argument('-a', '--asset', help='ETH/BTC (quote/base)', default=None, type=str)
@@ -92,6 +94,11 @@ class SimpleStrategy(Strategy):
             'cancel_ids': cancel_ids
         }
 
+    def target_positions(self, data):
+        """Holds `quantity` after the bars handle_data would buy on"""
+        holding = np.random.random(len(data)) > 0.5
+        return {self.asset.symbol: np.where(holding, self.quantity, 0.0)}
+
 
 if __name__ == "__main__":
     args = parser.parse_args()
@@ -151,6 +158,20 @@ if __name__ == "__main__":
         runner.backtest(experiment_name, exchange, portfolio.balance,
                         portfolio, feed, strategy)
 
+    elif trade_mode is TradeMode.VECTORIZED:
+        feed = OHLCVFileFeed(
+            exchange_ids=[exchange_id],
+            assets=[asset],
+            timeframe=timeframe,
+            start=None,
+            end=None
+        )
+        exchange = load_feed_based_paper_exchange(
+            deepcopy(balance), feed, exchange_id)
+        runner.backtest_vectorized(experiment_name, exchange,
+                                   portfolio.balance, portfolio, feed,
+                                   strategy)
+
     elif trade_mode is TradeMode.SIMULATE:
         exchange = load_ccxt_based_paper_exchange(
             deepcopy(balance), exchange_id)
@@ -74,3 +74,12 @@ class Strategy():
     def handle_data(self, data, ctx):
         orders = []
         return orders
+
+    def target_positions(self, data):
+        """
+        Vectorized strategies (TradeMode.VECTORIZED) return a dict of
+        {symbol: array} with the base quantity to hold after each row
+        of `data` (OHLCVData holding the whole feed).
+        None if the strategy can only be run bar by bar
+        """
+        return None
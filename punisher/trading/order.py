@@ -24,6 +24,11 @@ class OrderStatus(Enum):
         return str(self.name)
 
 
+# Orders that can no longer change on the exchange
+TERMINAL_STATUSES = set([
+    OrderStatus.FILLED, OrderStatus.CANCELED, OrderStatus.KILLED])
+
+
 @unique
 class OrderType(Enum):
     LIMIT_BUY = {'type':'limit', 'side':'buy', 'desc':''}
@@ -84,7 +89,7 @@ class Order():
         "id", "exchange_id", "exchange_order_id", "asset", "price",
         "quantity", "filled_quantity", "order_type", "status",
         "created_time", "opened_time", "filled_time", "canceled_time",
-        "fee", "attempts", "trades", "error"
+        "fee", "attempts", "trades", "trades_consumed", "error"
     ]
 
     def __init__(self, exchange_id, asset, price, quantity, order_type,
@@ -105,16 +110,20 @@ class Order():
         self.fee = 0.0
         self.attempts = 0
         self.trades = []
+        self.trades_consumed = 0
         self.error = None
 
-    def get_new_trades(self, last_update_time):
-        new_trades = []
-        for trade in self.trades:
-            print("Inspecting trade times...")
-            print("trade time", trade.trade_time)
-            print("last_update_time", last_update_time)
-            if trade.trade_time >= last_update_time:
-                new_trades.append(trade)
+    def get_new_trades(self):
+        """
+        Trades not yet applied to the portfolio. Exchanges append trades
+        in fill order, so everything past the consumed trade cursor is new
+        """
+        return self.trades[self.trades_consumed:]
+
+    def consume_new_trades(self):
+        """Returns the new trades and advances the cursor past them"""
+        new_trades = self.get_new_trades()
+        self.trades_consumed = len(self.trades)
         return new_trades
 
     def set_order_type(self, order_type):
@@ -161,6 +170,7 @@ class Order():
         order.filled_time = str_to_date(d['filled_time'])
         order.canceled_time = str_to_date(d['canceled_time'])
         order.attempts = d['attempts']
+        order.trades_consumed = d.get('trades_consumed', 0)
         order.fee = d['fee']
         order.error = OrderingError.from_dict(d['error'])
         return order
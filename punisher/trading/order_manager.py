@@ -1,7 +1,10 @@
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from enum import Enum, unique
 
 import ccxt
+import numpy as np
 
 from punisher.portfolio.asset import Asset
 from punisher.portfolio.balance import BalanceType
@@ -11,6 +14,12 @@ from .order import Order
 from .order import OrderType, OrderStatus
 
 
+@unique
+class SyncMode(Enum):
+    ORDER = 'fetch_order per open order'
+    RECONCILE = 'fetch_open_orders per asset, fetch_order on changes'
+
+
 def build_limit_buy_order(balance, exchange, asset, quantity, price, current_time):
     order = Order(
         exchange_id=exchange.id,
@@ -101,33 +110,250 @@ def get_order(exchange, ex_order_id, asset):
 #         ex_orders.append(ex_order)
 #     return ex_orders
 
-def process_orders(exchange, balance, open_or_new_orders):
+class OrderRegistry():
+    """
+    Orders keyed by id and exchange order id, with per-status
+    and per-asset index sets. Status changes are applied through
+    `update` so the indexes stay in sync without rescanning history
+    """
+    def __init__(self, orders=None):
+        self.orders = {}
+        self.by_ex_order_id = {}
+        self.by_status = {status: set() for status in OrderStatus}
+        self.by_symbol = {}
+        self._indexed = {}
+        self.add_all(orders or [])
+
+    def add(self, order):
+        self.orders[order.id] = order
+        self.update(order)
+
+    def add_all(self, orders):
+        for order in orders:
+            self.add(order)
+
+    def update(self, order):
+        """Re-indexes an order after its status or exchange id changed"""
+        status, ex_order_id = self._indexed.get(order.id, (None, None))
+        if status != order.status:
+            if status is not None:
+                self.by_status[status].discard(order.id)
+            self.by_status[order.status].add(order.id)
+        if ex_order_id != order.exchange_order_id:
+            self.by_ex_order_id.pop(ex_order_id, None)
+            if order.exchange_order_id is not None:
+                self.by_ex_order_id[order.exchange_order_id] = order.id
+        self.by_symbol.setdefault(order.asset.symbol, set()).add(order.id)
+        self._indexed[order.id] = (order.status, order.exchange_order_id)
+
+    def get(self, order_id):
+        return self.orders.get(order_id)
+
+    def get_by_ex_order_id(self, ex_order_id):
+        order_id = self.by_ex_order_id.get(ex_order_id)
+        return None if order_id is None else self.orders[order_id]
+
+    def get_by_status(self, *statuses):
+        return [self.orders[order_id] for status in statuses
+                for order_id in self.by_status[status]]
+
+    def get_by_asset(self, asset, statuses=None):
+        order_ids = self.by_symbol.get(asset.symbol, set())
+        if statuses is not None:
+            order_ids = set().union(*[
+                order_ids & self.by_status[s] for s in statuses])
+        return [self.orders[order_id] for order_id in order_ids]
+
+    def get_created(self):
+        return self.get_by_status(OrderStatus.CREATED)
+
+    def get_open(self):
+        return self.get_by_status(OrderStatus.OPEN)
+
+    def get_active(self):
+        """Orders whose state can still change"""
+        return self.get_by_status(OrderStatus.CREATED, OrderStatus.OPEN)
+
+    def __contains__(self, order_id):
+        return order_id in self.orders
+
+    def __iter__(self):
+        return iter(self.orders.values())
+
+    def __len__(self):
+        return len(self.orders)
+
+
+def process_orders(exchange, balance, open_or_new_orders,
+                   sync_mode=SyncMode.ORDER):
     """
     Process orders takes open_orders from previous round
-    Places newly created orders,
+    Places newly created orders, syncs open orders with the exchange.
+    Pass an OrderRegistry to only touch created/open orders
+    instead of scanning the full list. Returns the updated orders
     """
+    if isinstance(open_or_new_orders, OrderRegistry):
+        registry = open_or_new_orders
+    else:
+        registry = OrderRegistry(open_or_new_orders)
     updated_orders = []
     # Get the newly created orders
     # and place them on the exchange
     # update the portfolio balance
-    # add the failed orders to failed_orders
-    created_orders = get_created_orders(open_or_new_orders)
+    # Open orders are taken before placing so orders placed this
+    # round aren't synced twice
+    created_orders = registry.get_created()
+    open_orders = registry.get_open()
     balance.update_with_created_orders(created_orders)
     placed_orders = place_orders(exchange, created_orders)
-    open_orders = get_open_orders(open_or_new_orders)
 
-    # Get updates for new and existing open orders
-    for order in open_orders:
-        ex_order = get_order(exchange, order.exchange_order_id, order.asset)
-        sync_order_with_exchange(order, ex_order)
+    # Get updates for existing open orders
+    if sync_mode == SyncMode.RECONCILE:
+        reconcile_orders(exchange, open_orders)
+    else:
+        sync_orders(exchange, open_orders)
 
     updated_orders.extend(placed_orders)
     updated_orders.extend(open_orders)
 
     assert_no_duplicates(updated_orders)
+    for order in updated_orders:
+        registry.update(order)
 
     return updated_orders
 
+def rebalance_portfolio(portfolio, exchange, weights, latest_prices,
+                        current_time, tolerance=0.01, fee_rate=0.0,
+                        rates=None, markets=None):
+    """
+    Builds the smallest set of orders moving the portfolio to target weights
+    - weights : {symbol: fraction of total value}, the rest is held as cash.
+        Symbols sharing a base coin are netted and traded in the first one
+    - latest_prices : {symbol: price in the quote currency}
+    - rates : {coin: price in the cash currency}, defaults to the
+        COIN/CASH price in latest_prices
+    - tolerance : coins within this fraction of total value aren't traded
+    Holdings come from the balance. Quote coins that are also targets
+    are netted with what the legs quoted in them spend or receive
+    (ex. ETH/BTC buys spend BTC, adding to what BTC/USDT has to buy).
+    Quantities are rounded down to the market lot size, orders under the
+    market's min amount/cost are dropped. Sells come before the buys
+    they fund (see place_orders)
+    """
+    cash = portfolio.cash_currency
+    symbols = list(weights.keys())
+    assets = [Asset.from_symbol(symbol) for symbol in symbols]
+    prices = np.array([latest_prices[s] for s in symbols], dtype=float)
+    coins = [cash]
+    for asset in assets:
+        for coin in [asset.base, asset.quote]:
+            if coin not in coins:
+                coins.append(coin)
+    base_idx = np.array([coins.index(a.base) for a in assets])
+    quote_idx = np.array([coins.index(a.quote) for a in assets])
+
+    # Value every coin in the cash currency
+    coin_rates = np.full(len(coins), np.nan)
+    coin_rates[0] = 1.0
+    for i, coin in enumerate(coins[1:], 1):
+        coin_rates[i] = get_cash_rate(coin, cash, latest_prices, rates)
+    quote_rates = coin_rates[quote_idx]
+    coin_rates[base_idx] = prices * quote_rates
+    holdings = np.array([
+        portfolio.balance.get(coin)[BalanceType.TOTAL] for coin in coins])
+    holdings_value = holdings * coin_rates
+    total_value = np.nansum(holdings_value)
+
+    # One leg per base coin, weights of symbols sharing a base are summed
+    target_value = np.zeros(len(coins))
+    np.add.at(target_value, base_idx, np.array(
+        [weights[s] for s in symbols], dtype=float) * total_value)
+    legs = np.unique(base_idx, return_index=True)[1]
+    leg_base = base_idx[legs]
+    delta_value = target_value - holdings_value
+    lots, min_amounts, min_costs = get_market_limits(
+        exchange, [symbols[i] for i in legs], markets)
+
+    # Legs quoted in a traded coin go first so their quote flows
+    # are netted into that coin's own leg
+    quantities = np.zeros(len(legs))
+    netted = np.isin(quote_idx[legs], leg_base)
+    for mask in [netted, ~netted]:
+        qty = get_leg_quantities(
+            delta_value[leg_base[mask]], coin_rates[leg_base[mask]],
+            prices[legs[mask]], lots[mask], min_amounts[mask],
+            min_costs[mask], tolerance * total_value, fee_rate)
+        quantities[mask] = qty
+        cost = qty * prices[legs[mask]]
+        quote_flow = -cost - np.abs(cost) * fee_rate
+        np.add.at(delta_value, quote_idx[legs[mask]],
+                  -quote_flow * quote_rates[legs[mask]])
+
+    orders = []
+    for i in np.flatnonzero(quantities)[np.argsort(
+            quantities[quantities != 0] > 0, kind='stable')]:
+        symbol_idx = legs[i]
+        order_type = (OrderType.LIMIT_BUY if quantities[i] > 0
+                      else OrderType.LIMIT_SELL)
+        orders.append(Order(
+            exchange_id=exchange.id,
+            asset=assets[symbol_idx],
+            price=prices[symbol_idx],
+            quantity=abs(quantities[i]),
+            order_type=order_type,
+            created_time=current_time
+        ))
+    return orders
+
+def get_leg_quantities(delta_value, base_rates, prices, lots, min_amounts,
+                       min_costs, min_delta_value, fee_rate):
+    """
+    Base quantities to trade for each leg, 0.0 where the delta is inside
+    the tolerance band or the order would be under the market limits
+    """
+    qty = delta_value / base_rates
+    # Leave room for the fee on buys
+    qty = np.where(qty > 0, qty / (1 + fee_rate), qty)
+    # Rounded before truncating so float error doesn't drop a lot
+    lot_qty = np.trunc(np.round(qty / lots, 8)) * lots
+    qty = np.where(np.isnan(lots), qty, lot_qty)
+    amount = np.abs(qty)
+    skip = ((np.abs(delta_value) < min_delta_value)
+            | (amount < np.nan_to_num(min_amounts))
+            | (amount * prices < np.nan_to_num(min_costs))
+            | np.isnan(qty))
+    return np.where(skip, 0.0, qty)
+
+def get_cash_rate(coin, cash_coin, latest_prices, rates=None):
+    if coin == cash_coin:
+        return 1.0
+    if rates is not None and coin in rates:
+        return rates[coin]
+    return latest_prices.get(coin + '/' + cash_coin, np.nan)
+
+def get_market_limits(exchange, symbols, markets=None):
+    """
+    Lot sizes, min amounts and min costs from exchange.get_markets()
+    as arrays aligned with symbols, NaN where the market doesn't say
+    """
+    if markets is None:
+        markets = exchange.get_markets()
+    if isinstance(markets, list):
+        markets = {m['symbol']: m for m in markets}
+    limits = np.full((len(symbols), 3), np.nan)
+    for i, symbol in enumerate(symbols):
+        market = markets.get(symbol) or {}
+        precision = (market.get('precision') or {}).get('amount')
+        market_limits = market.get('limits') or {}
+        amount = market_limits.get('amount') or {}
+        cost = market_limits.get('cost') or {}
+        limits[i] = [
+            np.nan if precision is None else 10.0 ** -precision,
+            np.nan if amount.get('min') is None else amount['min'],
+            np.nan if cost.get('min') is None else cost['min'],
+        ]
+    return limits[:, 0], limits[:, 1], limits[:, 2]
+
 def assert_no_duplicates(orders):
     keys = set()
     for o in orders:
@@ -176,12 +402,69 @@ def sync_order_with_exchange(order, ex_order):
     order.fee = ex_order.fee
     order.trades = ex_order.trades
 
+def sync_order(exchange, order):
+    ex_order = get_order(exchange, order.exchange_order_id, order.asset)
+    sync_order_with_exchange(order, ex_order)
+    return order
+
 def place_orders(exchange, orders):
-    placed = []
+    """
+    Sells are placed (concurrently if the exchange allows it) and
+    acknowledged before any buy is sent, so buys see the funds they
+    release. Returns the orders in the order given
+    """
+    sells = [order for order in orders if order.order_type.is_sell()]
+    buys = [order for order in orders if not order.order_type.is_sell()]
+    map_orders(exchange, place_order, sells)
+    map_orders(exchange, place_order, buys)
+    return orders
+
+def sync_orders(exchange, orders):
+    return map_orders(exchange, sync_order, orders)
+
+def reconcile_orders(exchange, orders):
+    """
+    Syncs open orders with one fetch_open_orders call per asset
+    (or one account wide call if the venue supports it) instead of
+    a fetch_order per order. Only orders missing from the open list
+    or with a different filled quantity are fetched.
+    Returns the orders that changed
+    """
+    if len(orders) == 0:
+        return []
+    assets = {order.asset.symbol: order.asset for order in orders}
+    if exchange.all_open_orders and len(assets) > 1:
+        ex_orders = exchange.fetch_open_orders(None, trades=False)
+    else:
+        ex_orders = []
+        for result in map_orders(exchange, fetch_open_orders,
+                                 list(assets.values())):
+            ex_orders.extend(result)
+    ex_open = {ex_order.ex_order_id: ex_order for ex_order in ex_orders}
+
+    changed = []
     for order in orders:
-        placed_order = place_order(exchange, order)
-        placed.append(placed_order)
-    return placed
+        ex_order = ex_open.get(order.exchange_order_id)
+        if (ex_order is None
+            or ex_order.filled_quantity != order.filled_quantity):
+            changed.append(order)
+    return sync_orders(exchange, changed)
+
+def fetch_open_orders(exchange, asset):
+    # Trades are fetched later, only for the orders that changed
+    return exchange.fetch_open_orders(asset, trades=False)
+
+def map_orders(exchange, fn, orders):
+    """
+    Applies fn(exchange, order) to each order, concurrently on a
+    bounded thread pool if the exchange allows it (exchange.max_workers).
+    Requests are throttled by the exchange's rate limiter
+    """
+    workers = min(getattr(exchange, 'max_workers', 1), len(orders))
+    if workers <= 1:
+        return [fn(exchange, order) for order in orders]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda order: fn(exchange, order), orders))
 
 def cancel_order(exchange, ex_order_id):
     cancel_response = exchange.cancel_order(
@@ -1,5 +1,7 @@
+import time
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 
 import punisher.config as cfg
@@ -7,15 +9,18 @@ import punisher.constants as c
 
 from punisher.data.store import FileStore
 from punisher.utils.dates import Timeframe
-from punisher.utils.dates import utc_to_epoch
+from punisher.utils.dates import epochs_to_utc, utcs_to_epochs
 
 from punisher.portfolio.portfolio import Portfolio
 from punisher.portfolio.asset import Asset
 from punisher.portfolio.balance import Balance, BalanceType
 from punisher.portfolio.performance import PerformanceTracker
+from punisher.portfolio.performance import period_to_dict, period_from_dict
 
+from punisher.feeds.ohlcv_feed import OHLCVBar
 from punisher.trading.order import Order
 from punisher.trading.order import OrderType, OrderStatus
+from punisher.trading.order import TERMINAL_STATUSES
 
 # https://www.backtrader.com/docu/position.html
 # https://www.backtrader.com/docu/order.html
@@ -35,27 +40,274 @@ PORTFOLIO_FNAME = 'portfolio'
 PERFORMANCE_FNAME = 'performance'
 METRICS_FNAME = 'metrics'
 BALANCE_FNAME = 'balance'
+PERIODS_FNAME = 'periods'
+STATE_FNAME = 'state'
+JOURNAL_FNAME = 'journal'
+
+# JSON-lines streams appended to by journaled saves
+JOURNAL_STREAMS = [ORDERS_FNAME, PERIODS_FNAME, METRICS_FNAME, STATE_FNAME]
 
 OHLCV_COLS = ['epoch', 'open', 'high', 'low', 'close', 'volume', 'utc']
 
+class SavePolicy():
+    """
+    Decides when Record.checkpoint() writes the record
+      - every_n_bars: save every n checkpoints (1 = every bar)
+      - interval_sec: save once this many seconds passed since the last save
+    With neither set the record is only written on Record.close() (exit)
+      - journal: saves append only what changed to JSON-lines streams,
+        compacted into the snapshot files every `compact_every` saves
+        and on close
+    """
+    def __init__(self, every_n_bars=None, interval_sec=None,
+                 journal=False, compact_every=None):
+        self.every_n_bars = every_n_bars
+        self.interval_sec = interval_sec
+        self.journal = journal
+        self.compact_every = compact_every
+        self.bars = 0
+        self.last_save_time = time.monotonic()
+
+    @classmethod
+    def every_bar(self):
+        return SavePolicy(every_n_bars=1)
+
+    @classmethod
+    def on_exit(self):
+        return SavePolicy()
+
+    def should_save(self):
+        self.bars += 1
+        if (self.every_n_bars is not None
+            and self.bars % self.every_n_bars == 0):
+            return True
+        if (self.interval_sec is not None
+            and time.monotonic() - self.last_save_time >= self.interval_sec):
+            return True
+        return False
+
+    def saved(self):
+        self.last_save_time = time.monotonic()
+
+
+class OHLCVBuffer():
+    """
+    Growable columnar store for the bars added to a Record.
+    Rows are copied into float64/int64 arrays that double in capacity
+    when full, the DataFrame is only built when asked for.
+    """
+    def __init__(self, capacity=1024):
+        self.columns = []
+        self.offsets = {}
+        self.epochs = np.empty(capacity, dtype=np.int64)
+        self.values = np.empty((capacity, 0), dtype=np.float64)
+        self.n_rows = 0
+        self._df = None
+
+    @property
+    def capacity(self):
+        return len(self.epochs)
+
+    def append(self, epochs, values, columns):
+        """Appends rows of `values` (n_rows, len(columns))"""
+        values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+        n_new = len(epochs)
+        if list(columns) != self.columns:
+            values = self._align(values, columns)
+        self._reserve(self.n_rows + n_new)
+        end = self.n_rows + n_new
+        self.epochs[self.n_rows:end] = epochs
+        self.values[self.n_rows:end] = values
+        self.n_rows = end
+        self._df = None
+
+    def _align(self, values, columns):
+        """Reorders `values` into the buffer's columns, adding new ones"""
+        new_columns = [col for col in columns if col not in self.offsets]
+        if len(new_columns) > 0:
+            padding = np.full((self.capacity, len(new_columns)), np.nan)
+            self.values = np.hstack([self.values, padding])
+            self.columns = self.columns + new_columns
+            self.offsets = {col: i for i, col in enumerate(self.columns)}
+        aligned = np.full((len(values), len(self.columns)), np.nan)
+        aligned[:, [self.offsets[col] for col in columns]] = values
+        return aligned
+
+    def _reserve(self, n_rows):
+        if n_rows <= self.capacity:
+            return
+        capacity = max(n_rows, 2 * self.capacity)
+        epochs = np.empty(capacity, dtype=np.int64)
+        values = np.full((capacity, len(self.columns)), np.nan)
+        epochs[:self.n_rows] = self.epochs[:self.n_rows]
+        values[:self.n_rows] = self.values[:self.n_rows]
+        self.epochs = epochs
+        self.values = values
+
+    def to_df(self, start=0):
+        """DataFrame of rows [start:], the full frame is cached"""
+        if start == 0 and self._df is not None:
+            return self._df
+        epochs = self.epochs[start:self.n_rows].copy()
+        df = pd.DataFrame(
+            self.values[start:self.n_rows].copy(), columns=self.columns,
+            index=pd.Index(epochs, name='epoch'))
+        df['utc'] = epochs_to_utc(epochs)
+        if start == 0:
+            self._df = df
+        return df
+
+    def __len__(self):
+        return self.n_rows
+
+
 class Record():
-    def __init__(self, config, portfolio, balance, store):
+    def __init__(self, config, portfolio, balance, store, save_policy=None):
         self.config = config
         self.portfolio = portfolio
         self.balance = balance
         self.store = store
+        self.save_policy = (SavePolicy.every_bar() if save_policy is None
+                            else save_policy)
         self.orders = {}
         self.metrics = {}
-        self.ohlcv = pd.DataFrame([], columns=['epoch'])
+        self.ohlcv_buffer = OHLCVBuffer()
         self.other_data = None
+        self.journal_seq = 0
+        self._snapshot_saved = False
+        self._n_periods = 0
+        self._n_ohlcv = 0
+        self._n_metrics = {}
+        self._order_states = {}
+
+    def checkpoint(self):
+        """Called once per bar, saves according to the save policy"""
+        if self.save_policy.should_save():
+            self.save()
+
+    def close(self):
+        """Final save when the run ends or is interrupted"""
+        self.save_snapshot()
+        self.save_policy.saved()
 
     def save(self):
+        if self.save_policy.journal and self._snapshot_saved:
+            self.save_journal()
+        else:
+            self.save_snapshot()
+        self.save_policy.saved()
+
+    def save_snapshot(self):
+        """Rewrites every file, folding in (and clearing) the journal"""
         self.store.save_json(CONFIG_FNAME, self.config)
         self.store.save_json(METRICS_FNAME, self.metrics)
         self.store.save_json(BALANCE_FNAME, self.balance.to_dict())
         self.save_portfolio()
         self.save_orders()
         self.save_ohlcv()
+        if self.save_policy.journal:
+            self.store.save_json(JOURNAL_FNAME, {'seq': self.journal_seq})
+            for name in JOURNAL_STREAMS:
+                self.store.delete(name, c.JSONL)
+        self.mark_journaled()
+        self._snapshot_saved = True
+
+    def save_journal(self):
+        """Appends what changed since the last save to the journal streams"""
+        self.journal_seq += 1
+        seq = self.journal_seq
+        perf = self.portfolio.perf
+
+        self.store.append_json_lines(PERIODS_FNAME, [
+            {'seq': seq, 'period': period_to_dict(p)}
+            for p in perf.periods[self._n_periods:]])
+
+        metrics = []
+        for name, values in self.metrics.items():
+            new_values = values[self._n_metrics.get(name, 0):]
+            if len(new_values) > 0:
+                metrics.append({'seq': seq, 'name': name, 'values': new_values})
+        self.store.append_json_lines(METRICS_FNAME, metrics)
+
+        orders = []
+        for id_, order in self.orders.items():
+            state = self._order_states.get(id_)
+            if (state is not None and state[0] == order.status
+                and order.status in TERMINAL_STATUSES):
+                continue
+            dct = order.to_dict()
+            if state is None or state[1] != dct:
+                orders.append({'seq': seq, 'order': dct})
+                self._order_states[id_] = (order.status, dct)
+        self.store.append_json_lines(ORDERS_FNAME, orders)
+
+        self.store.append_json_lines(STATE_FNAME, [{
+            'seq': seq,
+            'balance': self.balance.to_dict(),
+            'portfolio': self.portfolio.to_dict(include_periods=False),
+        }])
+
+        if self._n_ohlcv == 0:
+            self.save_ohlcv()
+        elif len(self.ohlcv_buffer) > self._n_ohlcv:
+            df = self.ohlcv_buffer.to_df(self._n_ohlcv)
+            header = [df.index.name] + list(df.columns)
+            if self.store.csv_header(OHLCV_FNAME) == header:
+                self.store.append_df_to_csv(df, OHLCV_FNAME)
+            else:
+                # Columns were added since the file was written, rows
+                # appended positionally would land under the wrong ones
+                self.save_ohlcv()
+        self.mark_streams_journaled()
+
+        compact_every = self.save_policy.compact_every
+        if compact_every is not None and seq % compact_every == 0:
+            self.save_snapshot()
+
+    def mark_journaled(self):
+        """Everything currently held is in the snapshot or journal"""
+        self.mark_streams_journaled()
+        self._order_states = {
+            id_: (order.status, order.to_dict())
+            for id_, order in self.orders.items()}
+
+    def mark_streams_journaled(self):
+        self._n_periods = len(self.portfolio.perf.periods)
+        self._n_ohlcv = len(self.ohlcv_buffer)
+        self._n_metrics = {
+            name: len(values) for name, values in self.metrics.items()}
+
+    def replay_journal(self):
+        """Applies the journal lines written after the last snapshot"""
+        if not self.store.exists(JOURNAL_FNAME, c.JSON):
+            return
+        snapshot_seq = self.store.load_json(JOURNAL_FNAME)['seq']
+        tails = {
+            name: [row for row in self.store.load_json_lines(name)
+                   if row['seq'] > snapshot_seq]
+            for name in JOURNAL_STREAMS
+        }
+        for row in tails[ORDERS_FNAME]:
+            order = Order.from_dict(row['order'])
+            self.orders[order.id] = order
+        for row in tails[METRICS_FNAME]:
+            self.metrics.setdefault(row['name'], []).extend(row['values'])
+
+        periods = self.portfolio.perf.periods
+        if len(tails[STATE_FNAME]) > 0:
+            state = tails[STATE_FNAME][-1]
+            self.balance = Balance.from_dict(state['balance'])
+            self.portfolio = Portfolio.from_dict(state['portfolio'])
+            self.portfolio.perf.periods = periods
+        periods.extend(
+            period_from_dict(row['period']) for row in tails[PERIODS_FNAME])
+        self.portfolio.perf.update_performance()
+
+        self.journal_seq = max(
+            [snapshot_seq] + [row['seq'] for rows in tails.values()
+                              for row in rows])
+        self._snapshot_saved = True
+        self.mark_journaled()
 
     def save_portfolio(self):
         dct = self.portfolio.to_dict()
@@ -70,14 +322,29 @@ class Record():
     def save_ohlcv(self):
         self.store.df_to_csv(self.ohlcv, OHLCV_FNAME)
 
+    @property
+    def ohlcv(self):
+        return self.ohlcv_buffer.to_df()
+
+    @ohlcv.setter
+    def ohlcv(self, df):
+        self.ohlcv_buffer = OHLCVBuffer(capacity=max(len(df), 1024))
+        self.add_ohlcv_df(df)
+
     def add_ohlcv(self, data):
-        data = data.ohlcv_df.copy()
-        data['epoch'] = [utc_to_epoch(t) for t in data['utc']]
-        data.set_index('epoch', inplace=True)
-        if len(self.ohlcv) == 0:
-            self.ohlcv = data
+        if isinstance(data, OHLCVBar):
+            self.ohlcv_buffer.append(
+                [data.epoch], data.values, data.columns)
+        else:
+            self.add_ohlcv_df(data.ohlcv_df)
+
+    def add_ohlcv_df(self, df):
+        columns = [col for col in df.columns if col not in ['epoch', 'utc']]
+        if df.index.name == 'epoch' or 'utc' not in df.columns:
+            epochs = df.index.values
         else:
-            self.ohlcv = self.ohlcv.append(data)
+            epochs = utcs_to_epochs(df['utc'])
+        self.ohlcv_buffer.append(epochs, df[columns].values, columns)
 
     @classmethod
     def load(self, root_dir):
@@ -105,5 +372,6 @@ class Record():
         record.orders = orders
         record.ohlcv = ohlcv
         record.metrics = metrics
+        record.replay_journal()
 
         return record
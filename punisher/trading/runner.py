@@ -3,11 +3,18 @@ import time
 from enum import Enum, unique
 from datetime import datetime, timedelta
 
+import numpy as np
+import pandas as pd
+
 import punisher.config as cfg
 import punisher.constants as c
 from punisher.data.store import DATA_STORES
 from punisher.exchanges import load_exchange
+from punisher.feeds import ohlcv_feed
+from punisher.portfolio.asset import Asset
+from punisher.portfolio.balance import BalanceType
 from punisher.portfolio.portfolio import Portfolio
+from punisher.portfolio.position import Position
 from punisher.trading import order_manager
 from .context import Context
 from .record import Record
@@ -16,6 +23,7 @@ from .record import Record
 @unique
 class TradeMode(Enum):
     BACKTEST = 'historical data, fake orders'
+    VECTORIZED = 'historical data, array based fills'
     SIMULATE = 'live data, fake orders'
     LIVE = 'live data, live orders'
 
@@ -42,7 +50,8 @@ def get_symbols_traded(orders, positions):
     return set(symbols_traded)
 
 
-def backtest(name, exchange, balance, portfolio, feed, strategy):
+def backtest(name, exchange, balance, portfolio, feed, strategy,
+             save_policy=None):
     '''
     :name = name of your current experiment run
     '''
@@ -61,7 +70,8 @@ def backtest(name, exchange, balance, portfolio, feed, strategy):
         config=config,
         portfolio=portfolio,
         balance=portfolio.balance,
-        store=store
+        store=store,
+        save_policy=save_policy
     )
     ctx = Context(
         exchange=exchange,
@@ -70,58 +80,173 @@ def backtest(name, exchange, balance, portfolio, feed, strategy):
     )
     row = feed.next()
     last_port_update_time = row.get('utc') - feed.timeframe.delta
-    orders = []
+    orders = order_manager.OrderRegistry()
     latest_prices = {}
     record.save()
-    while row is not None:
+    try:
+        while row is not None:
 
-        output = strategy.process(row, ctx)
-        # Add any new orders from strategy output
-        new_orders = output['new_orders']
-        cancel_ids = output['cancel_ids']
-
-        orders.extend(new_orders)
-        # TODO: Cancelling orders
-        # should we auto-cancel any outstanding orders
-        # or should we leave this decision up to the Strategy?
-        # How do we confirm the order has been cancelled by the exchange?
-        # order_manager.cancel_orders(exchange, cancel_ids)
+            output = strategy.process(row, ctx)
+            # Add any new orders from strategy output
+            new_orders = output['new_orders']
+            cancel_ids = output['cancel_ids']
 
-        updated_orders = order_manager.process_orders(
-            exchange, portfolio.balance, orders)
+            orders.add_all(new_orders)
+            # TODO: Cancelling orders
+            # should we auto-cancel any outstanding orders
+            # or should we leave this decision up to the Strategy?
+            # How do we confirm the order has been cancelled by the exchange?
+            # order_manager.cancel_orders(exchange, cancel_ids)
 
-        # Get the symbols traded in this strategy
-        symbols_traded = get_symbols_traded(
-                orders, portfolio.positions)
+            updated_orders = order_manager.process_orders(
+                exchange, portfolio.balance, orders)
 
-        # Update latest prices of positions
-        latest_prices = update_latest_prices(
-            latest_prices, symbols_traded, row, exchange.id)
+            # Get the symbols traded in this strategy
+            symbols_traded = get_symbols_traded(
+                    updated_orders, portfolio.positions)
 
-        # Portfolio needs to know about new trades and latest prices
-        portfolio.update(
-            last_port_update_time, updated_orders, latest_prices)
+            # Update latest prices of positions
+            latest_prices = update_latest_prices(
+                latest_prices, symbols_traded, row, exchange.id)
 
-        portfolio.update_performance(last_port_update_time, row.get('utc'))
+            # Portfolio needs to know about new trades and latest prices
+            portfolio.update(
+                last_port_update_time, updated_orders, latest_prices)
 
-        last_port_update_time = row.get('utc')
+            portfolio.update_performance(last_port_update_time, row.get('utc'))
 
-        # Update record with updates to orders
-        for order in updated_orders:
-            record.orders[order.id] = order
+            last_port_update_time = row.get('utc')
 
-        # Reset open orders list to only track open/created orders
-        orders = order_manager.get_open_orders(updated_orders)
-        orders.extend(
-            order_manager.get_created_orders(updated_orders))
+            # Update record with updates to orders
+            for order in updated_orders:
+                record.orders[order.id] = order
 
-        record.save()
-        row = feed.next()
+            record.checkpoint()
+            row = feed.next()
+    finally:
+        record.close()
 
     return record
 
 
-def simulate(name, exchange, balance, portfolio, feed, strategy):
+def fill_targets(prices, targets, starting_cash, fee_rate=0.0):
+    """
+    Array based fills for TradeMode.VECTORIZED
+    - prices : (n_rows, n_assets) prices in the cash currency
+    - targets : (n_rows, n_assets) base quantity to hold after each row,
+        NaN holds the previous target
+    Trades fill at the row's price, like the paper exchange fills
+    orders at the latest close. Rows before an asset's first price
+    (listed after the feed starts) can't trade it.
+    Returns a dict of arrays
+    """
+    prices = pd.DataFrame(prices).ffill().values
+    targets = np.where(
+        np.isnan(prices), np.nan, np.asarray(targets, dtype=np.float64))
+    targets = pd.DataFrame(targets).ffill().fillna(0.0).values
+    trades = np.diff(targets, axis=0, prepend=0.0)
+    traded = trades != 0.0
+    cost = np.where(traded, trades * prices, 0.0)
+    fees = np.abs(cost) * fee_rate
+    cash = starting_cash - np.cumsum((cost + fees).sum(axis=1))
+    positions_value = np.where(
+        targets != 0.0, targets * prices, 0.0).sum(axis=1)
+    return {
+        'targets': targets,
+        'prices': prices,
+        'trades': trades,
+        'fees': fees,
+        'cash': cash,
+        'positions_value': positions_value,
+        'total_value': cash + positions_value,
+    }
+
+def get_taker_rate(exchange):
+    """Taker rate of the exchange's current fee tier, 0.0 without fees"""
+    fees = getattr(exchange, 'fees', None)
+    if fees is None:
+        return 0.0
+    return fees.get_rate('taker')
+
+def backtest_vectorized(name, exchange, balance, portfolio, feed, strategy,
+                        fee_rate=None):
+    '''
+    :name = name of your current experiment run
+    :fee_rate = fee per unit traded, defaults to the exchange's taker rate
+    Runs strategies implementing `target_positions` over the whole feed
+    with array ops instead of stepping bar by bar (no orders are placed)
+    '''
+    if fee_rate is None:
+        fee_rate = get_taker_rate(exchange)
+    root = os.path.join(cfg.DATA_DIR, name)
+    store = DATA_STORES[cfg.DATA_STORE](root=root)
+
+    config = {
+        'experiment': name,
+        'strategy': strategy.name,
+        'mode': TradeMode.VECTORIZED.name,
+        'fee_rate': fee_rate,
+    }
+    record = Record(
+        config=config,
+        portfolio=portfolio,
+        balance=portfolio.balance,
+        store=store
+    )
+    data = ohlcv_feed.OHLCVData(feed.ohlcv_df)
+    targets = strategy.target_positions(data)
+    if targets is None:
+        raise Exception((
+            "{:s} does not implement target_positions, it can't be run"
+            " with TradeMode.VECTORIZED").format(strategy.name))
+    assets = [Asset.from_symbol(symbol) for symbol in targets.keys()]
+    rates = ohlcv_feed.CrossRates(data.df)
+    prices = np.column_stack([
+        rates.cash_value('close', asset, exchange.id, portfolio.cash_currency)
+        for asset in assets])
+    result = fill_targets(
+        prices, np.column_stack([targets[a.symbol] for a in assets]),
+        portfolio.starting_cash, fee_rate)
+
+    ends = pd.to_datetime(data.df['utc']).dt.to_pydatetime().tolist()
+    starts = [ends[0] - feed.timeframe.delta] + ends[:-1]
+    portfolio.perf.add_periods(
+        starts, ends, result['cash'], result['total_value'])
+    update_vectorized_portfolio(portfolio, assets, result)
+    # Only the results, the feed's bars are already on disk
+    record.save()
+    return record
+
+def update_vectorized_portfolio(portfolio, assets, result):
+    """Replays the fills into the portfolio's final positions and balance"""
+    balance = portfolio.balance
+    balance.update(
+        portfolio.cash_currency,
+        delta_free=result['cash'][-1] - portfolio.cash,
+        delta_used=0.0)
+    for i, asset in enumerate(assets):
+        rows = np.flatnonzero(result['trades'][:, i])
+        if len(rows) == 0:
+            continue
+        pos = portfolio.get_position(asset)
+        for row in rows:
+            quantity = result['trades'][row, i]
+            price = result['prices'][row, i]
+            fee = result['fees'][row, i]
+            if pos is None:
+                pos = Position(asset, quantity, price, fee)
+                portfolio.positions.append(pos)
+            else:
+                pos.update(quantity, price, fee)
+        pos.latest_price = result['prices'][-1, i]
+        held = balance.get(asset.base)[BalanceType.TOTAL]
+        balance.update(
+            asset.base,
+            delta_free=result['targets'][-1, i] - held,
+            delta_used=0.0)
+
+def simulate(name, exchange, balance, portfolio, feed, strategy,
+             save_policy=None):
     '''
     :name = name of your current experiment run
     '''
@@ -139,7 +264,8 @@ def simulate(name, exchange, balance, portfolio, feed, strategy):
         config=config,
         portfolio=portfolio,
         balance=portfolio.balance,
-        store=store
+        store=store,
+        save_policy=save_policy
     )
     ctx = Context(
         exchange=exchange,
@@ -149,70 +275,70 @@ def simulate(name, exchange, balance, portfolio, feed, strategy):
     row = feed.next()
     perf_start = datetime.utcnow()
     last_port_update_time = datetime.utcnow()
-    orders = []
+    orders = order_manager.OrderRegistry()
     latest_prices = {}
     record.save()
 
-    while True:
-
-        if row is not None:
+    try:
+        while True:
 
-            portfolio.update_performance(perf_start, row.get('utc'))
+            if row is not None:
 
-            perf_start = row.get('utc')
+                portfolio.update_performance(perf_start, row.get('utc'))
 
-            output = strategy.process(row, ctx)
-            # Add any new orders from strategy output
-            new_orders = output['new_orders']
-            cancel_ids = output['cancel_ids']
+                perf_start = row.get('utc')
 
-            # Add new orders to our orders list
-            orders.extend(new_orders)
+                output = strategy.process(row, ctx)
+                # Add any new orders from strategy output
+                new_orders = output['new_orders']
+                cancel_ids = output['cancel_ids']
 
+                # Add new orders to our orders list
+                orders.add_all(new_orders)
 
-        # TODO: Cancelling orders
-        # should we auto-cancel any outstanding orders
-        # or should we leave this decision up to the Strategy?
-        # order_manager.cancel_orders(exchange, cancel_ids)
 
-        # Place new orders, retry failed orders, sync existing orders
-        updated_orders = order_manager.process_orders(
-                            exchange=exchange,
-                            balance=portfolio.balance,
-                            open_or_new_orders=orders
-                        )
-        # Get the symbols traded in this strategy
-        symbols_traded = get_symbols_traded(
-            orders, portfolio.positions)
+            # TODO: Cancelling orders
+            # should we auto-cancel any outstanding orders
+            # or should we leave this decision up to the Strategy?
+            # order_manager.cancel_orders(exchange, cancel_ids)
 
-        # Update latest prices of positions
-        latest_prices = update_latest_prices(
-            latest_prices, symbols_traded, row, exchange.id)
+            # Place new orders, retry failed orders, sync existing orders
+            updated_orders = order_manager.process_orders(
+                                exchange=exchange,
+                                balance=portfolio.balance,
+                                open_or_new_orders=orders
+                            )
+            # Get the symbols traded in this strategy
+            symbols_traded = get_symbols_traded(
+                updated_orders, portfolio.positions)
 
-        portfolio.update(
-            last_port_update_time, updated_orders, latest_prices)
+            # Update latest prices of positions
+            latest_prices = update_latest_prices(
+                latest_prices, symbols_traded, row, exchange.id)
 
-        # Keep updating last time we updated our portfolio
-        last_port_update_time = datetime.utcnow()
+            portfolio.update(
+                last_port_update_time, updated_orders, latest_prices)
 
-        # Reset open orders list to only track open/created orders
-        orders = order_manager.get_open_orders(updated_orders)
-        orders.extend(
-            order_manager.get_created_orders(updated_orders))
+            # Keep updating last time we updated our portfolio
+            last_port_update_time = datetime.utcnow()
 
-        # Update record with updates to orders
-        for order in updated_orders:
-            record.orders[order.id] = order
+            # Update record with updates to orders
+            for order in updated_orders:
+                record.orders[order.id] = order
 
-        record.save()
-        time.sleep(cfg.SLEEP_TIME)
-        row = feed.next()
+            record.checkpoint()
+            time.sleep(cfg.SLEEP_TIME)
+            row = feed.next()
+    finally:
+        record.close()
 
     return record
 
-def live(name, exchange, balance, portfolio, feed, strategy):
+def live(name, exchange, balance, portfolio, feed, strategy,
+         save_policy=None, sync_mode=order_manager.SyncMode.RECONCILE):
     '''
     :name = name of your current experiment run
+    :sync_mode = how open orders are synced with the exchange each loop
     '''
     print("LIVE TRADING! My, man!")
 
@@ -230,7 +356,8 @@ def live(name, exchange, balance, portfolio, feed, strategy):
         config=config,
         portfolio=portfolio,
         balance=portfolio.balance,
-        store=store
+        store=store,
+        save_policy=save_policy
     )
     ctx = Context(
         exchange=exchange,
@@ -241,62 +368,61 @@ def live(name, exchange, balance, portfolio, feed, strategy):
     row = feed.next()
     perf_start = datetime.utcnow()
     last_port_update_time = datetime.utcnow()
-    orders = []
+    orders = order_manager.OrderRegistry()
     latest_prices = {}
     record.save()
 
-    while True:
-
-        if row is not None:
-
-            portfolio.update_performance(perf_start, row.get('utc'))
-            perf_start = row.get('utc')
-            output = strategy.process(row, ctx)
-            # Add any new orders from strategy output
-            new_orders = output['new_orders']
-            cancel_ids = output['cancel_ids']
-
-            # Add new orders to our orders list
-            orders.extend(new_orders)
-
-
-        # TODO: Cancelling orders
-        # should we auto-cancel any outstanding orders
-        # or should we leave this decision up to the Strategy?
-        # order_manager.cancel_orders(exchange, cancel_ids)
-
-        # Place new orders, retry failed orders, sync existing orders
-        updated_orders = order_manager.process_orders(
-                            exchange=exchange,
-                            balance=portfolio.balance,
-                            open_or_new_orders=orders
-                        )
-        # Get the symbols traded in this strategy
-        symbols_traded = get_symbols_traded(
-            orders, portfolio.positions)
-
-        # Update latest prices of positions
-        latest_prices = update_latest_prices(
-            latest_prices, symbols_traded, row, exchange.id)
-
-        # Portfolio needs to know about new trades/latest prices
-        portfolio.update(
-            last_port_update_time, updated_orders, latest_prices)
-
-        # Keep updating last time we updated our portfolio
-        last_port_update_time = datetime.utcnow()
-
-        # Reset open orders list to only track open/created orders
-        orders = order_manager.get_open_orders(updated_orders)
-        orders.extend(
-            order_manager.get_created_orders(updated_orders))
-
-        # Update record with updates to orders
-        for order in updated_orders:
-            record.orders[order.id] = order
-
-        record.save()
-        time.sleep(seconds=cfg.SLEEP_TIME)
-        row = feed.next()
+    try:
+        while True:
+
+            if row is not None:
+
+                portfolio.update_performance(perf_start, row.get('utc'))
+                perf_start = row.get('utc')
+                output = strategy.process(row, ctx)
+                # Add any new orders from strategy output
+                new_orders = output['new_orders']
+                cancel_ids = output['cancel_ids']
+
+                # Add new orders to our orders list
+                orders.add_all(new_orders)
+
+
+            # TODO: Cancelling orders
+            # should we auto-cancel any outstanding orders
+            # or should we leave this decision up to the Strategy?
+            # order_manager.cancel_orders(exchange, cancel_ids)
+
+            # Place new orders, retry failed orders, sync existing orders
+            updated_orders = order_manager.process_orders(
+                                exchange=exchange,
+                                balance=portfolio.balance,
+                                open_or_new_orders=orders,
+                                sync_mode=sync_mode
+                            )
+            # Get the symbols traded in this strategy
+            symbols_traded = get_symbols_traded(
+                updated_orders, portfolio.positions)
+
+            # Update latest prices of positions
+            latest_prices = update_latest_prices(
+                latest_prices, symbols_traded, row, exchange.id)
+
+            # Portfolio needs to know about new trades/latest prices
+            portfolio.update(
+                last_port_update_time, updated_orders, latest_prices)
+
+            # Keep updating last time we updated our portfolio
+            last_port_update_time = datetime.utcnow()
+
+            # Update record with updates to orders
+            for order in updated_orders:
+                record.orders[order.id] = order
+
+            record.checkpoint()
+            time.sleep(seconds=cfg.SLEEP_TIME)
+            row = feed.next()
+    finally:
+        record.close()
 
     return record
@@ -0,0 +1,186 @@
+import os
+import random
+import itertools
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import punisher.config as cfg
+from punisher.exchanges import load_feed_based_paper_exchange
+from punisher.feeds.ohlcv_feed import OHLCVFeed
+from punisher.portfolio.balance import Balance
+from punisher.portfolio.performance import PerformanceTracker
+from punisher.portfolio.portfolio import Portfolio
+from punisher.utils.dates import epochs_to_utc
+
+from . import runner
+from .record import SavePolicy
+from .runner import TradeMode
+
+"""
+Runs many backtests of one strategy with different hyperparameters.
+The feed's OHLCV frame is copied once into shared memory, worker
+processes attach to it instead of re-reading the csv files and each
+run is saved under its own record directory: DATA_DIR/name/run_0000
+"""
+
+RESULTS_FNAME = 'sweep.csv'
+
+# (segments, frame) attached by this worker process, the segments stay
+# open for the life of the worker since the frame is a view into them
+_ATTACHED = {}
+
+
+def make_grid(space):
+    """{'window': [5, 10], 'size': [.1, .2]} -> list of 4 param dicts"""
+    names = list(space.keys())
+    return [dict(zip(names, values))
+            for values in itertools.product(*space.values())]
+
+def sample_params(space, n_runs, seed=None):
+    """
+    Random search over `space`, lists are sampled from and
+    (low, high) tuples are sampled uniformly
+    """
+    rand = random.Random(seed)
+    runs = []
+    for i in range(n_runs):
+        params = {}
+        for name, values in space.items():
+            if isinstance(values, tuple):
+                params[name] = rand.uniform(*values)
+            else:
+                params[name] = rand.choice(values)
+        runs.append(params)
+    return runs
+
+
+class SharedOHLCV():
+    """Epochs and float64 block of an OHLCV frame in shared memory"""
+    def __init__(self, df):
+        columns = [col for col in df.columns if col != 'utc']
+        epochs = df.index.values.astype(np.int64)
+        values = df[columns].to_numpy(dtype=np.float64)
+        self.columns = columns
+        self.shape = values.shape
+        self.epochs_shm = self._share(epochs)
+        self.values_shm = self._share(values)
+
+    def _share(self, arr):
+        shm = shared_memory.SharedMemory(
+            create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+        return shm
+
+    @property
+    def spec(self):
+        """Picklable handle passed to the workers"""
+        return {
+            'epochs': self.epochs_shm.name,
+            'values': self.values_shm.name,
+            'columns': self.columns,
+            'shape': self.shape,
+        }
+
+    def close(self):
+        for shm in [self.epochs_shm, self.values_shm]:
+            shm.close()
+            shm.unlink()
+
+
+def attach_ohlcv(spec):
+    """
+    Frame of read-only views into the shared segments, built once per
+    worker process. Only the utc column is private to the worker
+    """
+    key = spec['values']
+    if key not in _ATTACHED:
+        n_rows, n_cols = spec['shape']
+        epochs_shm = shared_memory.SharedMemory(name=spec['epochs'])
+        values_shm = shared_memory.SharedMemory(name=spec['values'])
+        epochs = np.ndarray(
+            (n_rows,), dtype=np.int64, buffer=epochs_shm.buf)
+        values = np.ndarray(
+            (n_rows, n_cols), dtype=np.float64, buffer=values_shm.buf)
+        epochs.flags.writeable = False
+        values.flags.writeable = False
+        df = pd.DataFrame(
+            values, columns=spec['columns'],
+            index=pd.Index(epochs, name='epoch', copy=False), copy=False)
+        df['utc'] = epochs_to_utc(epochs)
+        _ATTACHED[key] = ([epochs_shm, values_shm], df)
+    return _ATTACHED[key][1]
+
+def run_params(job):
+    """Single sweep run, executed in a worker process"""
+    df = attach_ohlcv(job['ohlcv'])
+    feed = OHLCVFeed()
+    feed.timeframe = job['timeframe']
+    feed.initialize()
+    feed.ohlcv_df = df
+
+    balance = Balance(
+        cash_currency=job['cash_currency'],
+        starting_cash=job['starting_cash'])
+    portfolio = Portfolio(
+        cash_currency=job['cash_currency'],
+        starting_balance=deepcopy(balance),
+        perf_tracker=PerformanceTracker(
+            job['starting_cash'], job['timeframe']))
+    exchange = load_feed_based_paper_exchange(
+        balance, feed, job['exchange_id'])
+    strategy = job['strategy_cls'](**job['params'])
+
+    if job['mode'] == TradeMode.VECTORIZED:
+        runner.backtest_vectorized(
+            job['name'], exchange, portfolio.balance,
+            portfolio, feed, strategy, fee_rate=job['fee_rate'])
+    else:
+        runner.backtest(
+            job['name'], exchange, portfolio.balance,
+            portfolio, feed, strategy, save_policy=SavePolicy.on_exit())
+
+    result = {'run': job['name']}
+    result.update(job['params'])
+    result.update(portfolio.perf.summary())
+    return result
+
+def sweep(name, strategy_cls, params, feed, exchange_id, cash_currency,
+          starting_cash, mode=TradeMode.VECTORIZED, max_workers=None,
+          fee_rate=None):
+    """
+    Backtests `strategy_cls(**p)` for every p in `params` (see make_grid
+    and sample_params) on a process pool. Returns a DataFrame with the
+    params and performance summary of each run, also saved to
+    DATA_DIR/name/sweep.csv
+    VECTORIZED runs charge `fee_rate`, by default the paper exchange's
+    taker rate like the fees BACKTEST runs are charged
+    """
+    assert mode in [TradeMode.BACKTEST, TradeMode.VECTORIZED]
+    shared = SharedOHLCV(feed.ohlcv_df)
+    jobs = [{
+        'name': os.path.join(name, 'run_{:04d}'.format(i)),
+        'ohlcv': shared.spec,
+        'strategy_cls': strategy_cls,
+        'params': p,
+        'exchange_id': exchange_id,
+        'cash_currency': cash_currency,
+        'starting_cash': starting_cash,
+        'timeframe': feed.timeframe,
+        'mode': mode,
+        'fee_rate': fee_rate,
+    } for i, p in enumerate(params)]
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(run_params, jobs))
+    finally:
+        shared.close()
+
+    df = pd.DataFrame(results)
+    root = os.path.join(cfg.DATA_DIR, name)
+    os.makedirs(root, exist_ok=True)
+    df.to_csv(os.path.join(root, RESULTS_FNAME), index=False)
+    return df
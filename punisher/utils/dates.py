@@ -29,6 +29,10 @@ class Timeframe(Enum):
     def delta(self):
         return self.value['delta']
 
+    @property
+    def seconds(self):
+        return int(self.delta.total_seconds())
+
     @classmethod
     def from_id(self, id_):
         '''1m, 5m, 30m'''
@@ -68,6 +72,15 @@ def utc_to_epoch(utc_time):
 def epoch_to_utc(epoch_sec):
     return datetime.datetime.utcfromtimestamp(epoch_sec)
 
+def epochs_to_utc(epochs_sec):
+    """Vectorized epoch_to_utc for arrays of epoch seconds"""
+    return pd.to_datetime(np.asarray(epochs_sec, dtype=np.int64), unit='s')
+
+def utcs_to_epochs(utcs):
+    """Vectorized utc_to_epoch for arrays of naive utc datetimes"""
+    utcs = pd.to_datetime(utcs)
+    return np.asarray(utcs, dtype='datetime64[s]').astype(np.int64)
+
 def get_time_range(df, start_utc=None, end_utc=None):
     if start_utc is not None:
         df = df[df.index >= utc_to_epoch(start_utc)]
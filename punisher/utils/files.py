@@ -12,6 +12,19 @@ def save_str(fpath, string, mode='w'):
     with open(fpath, mode) as f:
         f.write(string)
 
+def append_json_lines(fpath, dcts):
+    """Appends one compact JSON document per line"""
+    with open(fpath, 'a') as f:
+        for dct in dcts:
+            f.write(json.dumps(
+                dct, cls=EnumEncoder, ensure_ascii=False,
+                separators=(',', ':')))
+            f.write('\n')
+
+def load_json_lines(fpath):
+    with open(fpath, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
 def load_json(fpath):
     with open(fpath, 'r') as f:
         json_ = json.load(f)
@@ -0,0 +1,35 @@
+import time
+import threading
+
+
+class TokenBucket():
+    """
+    Thread safe token bucket
+    Refills `rate` tokens per second up to `capacity`. Acquiring blocks
+    until `weight` tokens are available, so callers spending more
+    expensive requests (higher weight) wait proportionally longer.
+    """
+    def __init__(self, rate, capacity=1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, weight=1.0):
+        weight = min(weight, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= weight:
+                    self.tokens -= weight
+                    return
+                wait = (weight - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
@@ -13,6 +13,9 @@ from punisher.portfolio.asset import Asset
 from punisher.trading import coins
 import punisher.feeds.ohlcv_feed as ohlcv_feed
 from punisher.utils.dates import Timeframe
+from punisher.utils.dates import utc_to_epoch
+
+FEED_START = datetime(year=2018, month=1, day=1)
 
 
 @pytest.fixture(scope="class")
@@ -45,6 +48,24 @@ def paperexchange(balance, asset):
         balance, feed, exchange_id)
     return ex
 
+@pytest.fixture
+def make_feed():
+    """
+    Factory for an OHLCVFeed of one asset's 1m bars from FEED_START
+    bars: [(open, high, low, close, volume)]
+    """
+    def make(bars, asset=Asset.from_symbol('BTC/USDT'),
+             ex_id=ex_cfg.BINANCE):
+        epoch = utc_to_epoch(FEED_START)
+        rows = [[(epoch + i*60)*1000] + list(bar)
+                for i, bar in enumerate(bars)]
+        feed = ohlcv_feed.OHLCVFeed(start=FEED_START)
+        feed.timeframe = Timeframe.ONE_MIN
+        feed.initialize()
+        feed.ohlcv_df = ohlcv_feed.make_asset_df(rows, asset, ex_id)
+        return feed
+    return make
+
 @pytest.fixture(scope="class")
 def perf_tracker():
     return PerformanceTracker(
@@ -1,8 +1,381 @@
+import os
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
 from pytest_mock import mocker
 
+from punisher.data import tea_store
+from punisher.exchanges import ex_cfg
+from punisher.feeds import ohlcv_feed
+from punisher.feeds.ohlcv_feed import OHLCVFeed
+from punisher.portfolio.asset import Asset
+from punisher.utils.dates import Timeframe
+from punisher.utils.dates import utc_to_epoch
+
+EX_ID = 'binance'
+START = datetime.datetime(year=2018, month=1, day=1)
+ETH_BTC = Asset.from_symbol('ETH/BTC')
+
+
+def make_bars(n_rows):
+    return [(i, i+2, i-1, i+1, 10*i) for i in range(n_rows)]
+
+def make_ohlcv_rows(n_rows, start=START, step_sec=60):
+    epoch = utc_to_epoch(start)
+    return [
+        [(epoch + i*step_sec)*1000] + list(bar)
+        for i, bar in enumerate(make_bars(n_rows))
+    ]
+
+
 def inc(x):
     return x + 1
 
 def test_mocker(mocker):
     assert mocker is not None
     assert 1 == 1
+
+
+class TestOHLCVFeedCursor:
+
+    def test_next(self, make_feed):
+        feed = make_feed(make_bars(5), ETH_BTC)
+        for i in range(5):
+            row = feed.next()
+            assert row.get('close', 'ETH/BTC', EX_ID) == i+1
+            assert feed.prior_time == START + datetime.timedelta(minutes=i)
+        assert feed.next() is None
+
+    def test_peek_does_not_advance(self, make_feed):
+        feed = make_feed(make_bars(3), ETH_BTC)
+        assert feed.peek().get('open', 'ETH/BTC', EX_ID) == 0
+        assert feed.peek().get('open', 'ETH/BTC', EX_ID) == 0
+        assert feed.next().get('open', 'ETH/BTC', EX_ID) == 0
+        assert feed.peek().get('open', 'ETH/BTC', EX_ID) == 1
+
+    def test_history(self, make_feed):
+        feed = make_feed(make_bars(10), ETH_BTC)
+        assert len(feed.history()) == 0
+        for i in range(4):
+            feed.next()
+        assert len(feed.history()) == 4
+        assert len(feed.history(t_minus=2)) == 2
+        assert len(feed.history(t_minus=100)) == 4
+        assert feed.history(1).get('open', 'ETH/BTC', EX_ID) == 3
+
+    def test_reload_keeps_position(self, make_feed):
+        feed = make_feed(make_bars(5), ETH_BTC)
+        feed.next()
+        feed.next()
+        asset = Asset.from_symbol('ETH/BTC')
+        feed.ohlcv_df = ohlcv_feed.make_asset_df(
+            make_ohlcv_rows(8), asset, EX_ID)
+        assert feed.cursor == 2
+        assert feed.next().get('open', 'ETH/BTC', EX_ID) == 2
+
+
+class TestOHLCVBar:
+
+    def test_bar_matches_frame(self, make_feed):
+        feed = make_feed(make_bars(3), ETH_BTC)
+        feed.next()
+        bar = feed.next()
+        row = feed.ohlcv_df.iloc[1]
+        for field in ['open', 'high', 'low', 'close', 'volume']:
+            col_name = ohlcv_feed.get_col_name(field, 'ETH/BTC', EX_ID)
+            assert bar.get(field, 'ETH/BTC', EX_ID) == row[col_name]
+        assert bar.get('utc') == row['utc']
+        assert len(bar) == 1
+        assert bar.cash_coins == {'BTC'}
+
+    def test_lazy_df(self, make_feed):
+        feed = make_feed(make_bars(3), ETH_BTC)
+        bar = feed.next()
+        assert bar._df is None
+        df = bar.df
+        assert list(df.index) == [bar.epoch]
+        assert df['utc'].iloc[0] == bar.utc
+        assert bar.row(0)[ohlcv_feed.get_col_name(
+            'close', 'ETH/BTC', EX_ID)] == 1
+
+
+class TestIncrementalUpdate:
+
+    def test_append_asset_rows(self):
+        eth = Asset.from_symbol('ETH/BTC')
+        ltc = Asset.from_symbol('LTC/BTC')
+        rows = make_ohlcv_rows(6)
+        eth_df = ohlcv_feed.make_asset_df(rows, eth, EX_ID)
+        ltc_df = ohlcv_feed.make_asset_df(rows, ltc, EX_ID)
+        df = pd.concat([eth_df.iloc[:4].drop('utc', axis=1),
+                        ltc_df.iloc[:3]], axis=1)
+
+        df = ohlcv_feed.append_asset_rows(
+            df, [eth_df.iloc[4:], ltc_df.iloc[3:]])
+        assert list(df.index) == list(eth_df.index)
+        for col in list(eth_df.columns) + list(ltc_df.columns):
+            if col != 'utc':
+                assert not df[col].isnull().any()
+        assert df['utc'].iloc[-1] == eth_df['utc'].iloc[-1]
+
+    def test_append_asset(self, tmpdir):
+        asset = Asset.from_symbol('ETH/BTC')
+        fpath = os.path.join(str(tmpdir), 'binance_ETH_BTC_1m.csv')
+        df = ohlcv_feed.make_asset_df(make_ohlcv_rows(8), asset, EX_ID)
+        ohlcv_feed.append_asset(df.iloc[:5], fpath)
+        # Refetched last bar replaces the partial one
+        df.iloc[4, 3] = 100.0
+        ohlcv_feed.append_asset(df.iloc[4:], fpath)
+        loaded = ohlcv_feed.load_asset(fpath)
+        assert list(loaded.index) == list(df.index)
+        assert loaded.iloc[4, 3] == 100.0
+
+    def test_upsert_rows(self, make_feed):
+        feed = make_feed(make_bars(4), ETH_BTC)
+        feed.next()
+        bar = feed.next()
+        close = ohlcv_feed.get_col_name('close', 'ETH/BTC', EX_ID)
+        volume = ohlcv_feed.get_col_name('volume', 'ETH/BTC', EX_ID)
+        epochs = feed.epochs[-1] + np.array([0, 60, 120])
+        values = np.array([[100., 1.], [101., np.nan], [102., 3.]])
+
+        assert feed.upsert_rows(epochs, values, [close, volume])
+
+        assert len(feed) == 6
+        assert len(feed._epochs_buf) == 8
+        assert list(feed.ohlcv_df[close]) == [1, 2, 3, 100, 101, 102]
+        assert feed.ohlcv_df[volume].iloc[3] == 1.0
+        assert np.isnan(feed.ohlcv_df[volume].iloc[4])
+        assert feed.next().get('close', 'ETH/BTC', EX_ID) == 3
+        assert feed.next().get('close', 'ETH/BTC', EX_ID) == 100
+        assert feed.history(t_minus=2).get(
+            'close', 'ETH/BTC', EX_ID, idx=-1) == 100
+
+        # Overwrites don't reallocate
+        assert feed.upsert_rows(epochs[-1:], values[-1:] + 1, [close, volume])
+        assert len(feed._epochs_buf) == 8
+        assert feed.ohlcv_df[close].iloc[-1] == 103
+
+        assert not feed.upsert_rows(epochs[:1] - 30, values[:1], [close])
+        ltc_close = ohlcv_feed.get_col_name('close', 'LTC/BTC', EX_ID)
+        assert not feed.upsert_rows(epochs[-1:] + 60, [[1.]], [ltc_close])
+        assert len(feed) == 6
+
+
+class FakeOHLCVExchange():
+    """Serves `n_rows` 1m bars starting at `listed`, `limit` rows per call"""
+    def __init__(self, ex_id, listed, n_rows):
+        self.id = ex_id
+        self.timeframes = {'1m': '1m'}
+        self.rows = make_ohlcv_rows(n_rows, start=listed)
+        self.calls = 0
+
+    def fetch_ohlcv(self, asset, timeframe, start_utc, limit=None):
+        self.calls += 1
+        since = utc_to_epoch(start_utc) * 1000
+        rows = [r for r in self.rows if r[0] >= since]
+        return rows if limit is None else rows[:limit]
+
+
+class TestBackfill:
+
+    def test_pages_and_missing_ranges(self):
+        asset = Asset.from_symbol('ETH/BTC')
+        listed = START + datetime.timedelta(minutes=30)
+        exchange = FakeOHLCVExchange(ex_cfg.BINANCE, listed, 1200)
+        end = START + datetime.timedelta(minutes=2000)
+
+        df, missing = ohlcv_feed.backfill_asset(
+            exchange, asset, Timeframe.ONE_MIN, START, end)
+
+        assert len(df) == 1200
+        assert df.index.is_unique and df.index.is_monotonic_increasing
+        assert exchange.calls == 4
+        last_bar = listed + datetime.timedelta(minutes=1200)
+        assert missing == [(START, listed), (last_bar, end)]
+
+    def test_unlimited_exchange_single_call(self):
+        asset = Asset.from_symbol('ETH/BTC')
+        exchange = FakeOHLCVExchange(ex_cfg.POLONIEX, START, 1200)
+        end = START + datetime.timedelta(minutes=1200)
+        df, missing = ohlcv_feed.backfill_asset(
+            exchange, asset, Timeframe.ONE_MIN, START, end)
+        assert len(df) == 1200
+        assert exchange.calls == 1
+        assert missing == []
+
+    def test_page_ranges(self):
+        end = START + datetime.timedelta(minutes=25)
+        pages = ohlcv_feed.get_page_ranges(
+            START, end, Timeframe.ONE_MIN, 10)
+        assert len(pages) == 3
+        assert pages[0][0] == START
+        assert pages[-1][1] == end
+
+
+def make_gappy_df():
+    """1m bars 0-9 with bars 3, 4 and 7 missing"""
+    asset = Asset.from_symbol('ETH/BTC')
+    rows = [r for i, r in enumerate(make_ohlcv_rows(10))
+            if i not in (3, 4, 7)]
+    return ohlcv_feed.make_asset_df(rows, asset, EX_ID)
+
+
+class TestGaps:
+
+    def test_find_gaps(self):
+        df = make_gappy_df()
+        start = utc_to_epoch(START)
+        starts, ends = ohlcv_feed.find_gaps(df.index.values, 60)
+        assert list(starts) == [start + 3*60, start + 7*60]
+        assert list(ends) == [start + 5*60, start + 8*60]
+
+        report = ohlcv_feed.get_gap_report(df.index.values, 60)
+        assert report['gaps'] == 2
+        assert report['missing'] == 3
+        assert report['coverage'] == 0.7
+        assert ohlcv_feed.check_missing_timesteps(df, 60) == 3
+
+    def test_ffill(self):
+        asset = Asset.from_symbol('ETH/BTC')
+        df = ohlcv_feed.fill_gaps(
+            make_gappy_df(), asset, EX_ID, Timeframe.ONE_MIN,
+            ohlcv_feed.GapFill.FFILL)
+        cols = ohlcv_feed.get_ohlcv_columns(asset, EX_ID)[1:]
+        assert len(df) == 10
+        assert list(df[cols].iloc[3]) == [3, 3, 3, 3, 0]
+        assert list(df[cols].iloc[4]) == [3, 3, 3, 3, 0]
+        assert list(df[cols].iloc[5]) == [5, 7, 4, 6, 50]
+
+    def test_mark(self):
+        asset = Asset.from_symbol('ETH/BTC')
+        df = ohlcv_feed.fill_gaps(
+            make_gappy_df(), asset, EX_ID, Timeframe.ONE_MIN,
+            ohlcv_feed.GapFill.MARK)
+        cols = ohlcv_feed.get_ohlcv_columns(asset, EX_ID)[1:]
+        assert len(df) == 10
+        assert df[cols].iloc[7].isnull().all()
+        assert df['utc'].iloc[7] == START + datetime.timedelta(minutes=7)
+
+    def test_refetch(self):
+        asset = Asset.from_symbol('ETH/BTC')
+        exchange = FakeOHLCVExchange(ex_cfg.BINANCE, START, 10)
+        df = ohlcv_feed.fill_gaps(
+            make_gappy_df(), asset, ex_cfg.BINANCE, Timeframe.ONE_MIN,
+            ohlcv_feed.GapFill.REFETCH, exchange)
+        assert exchange.calls == 2
+        assert len(df) == 10
+        assert df['close_ETH/BTC_binance'].iloc[7] == 8
+
+    def test_file_feed_refetch(self, tmpdir, capsys):
+        store = tea_store.OHLCVTeaStore(str(tmpdir))
+        asset = Asset.from_symbol('ETH/BTC')
+        ohlcv_feed.save_asset_tea(
+            store, make_gappy_df(), asset, EX_ID, Timeframe.ONE_MIN)
+        exchange = FakeOHLCVExchange(EX_ID, START, 10)
+
+        feed = ohlcv_feed.OHLCVFileFeed(
+            [EX_ID], [asset], Timeframe.ONE_MIN, START, tea_store=store,
+            gap_fill=ohlcv_feed.GapFill.REFETCH, exchanges=[exchange])
+        assert len(feed) == 10
+        assert exchange.calls == 2
+        assert 'Coverage' not in capsys.readouterr().out
+
+        # Repaired bars were saved, nothing left to refetch or report
+        feed = ohlcv_feed.OHLCVFileFeed(
+            [EX_ID], [asset], Timeframe.ONE_MIN, START, tea_store=store,
+            report_gaps=True)
+        assert len(feed) == 10
+        assert 'Coverage' not in capsys.readouterr().out
+
+        gappy = tea_store.OHLCVTeaStore(str(tmpdir.mkdir('gappy')))
+        ohlcv_feed.save_asset_tea(
+            gappy, make_gappy_df(), asset, EX_ID, Timeframe.ONE_MIN)
+        feed = ohlcv_feed.OHLCVFileFeed(
+            [EX_ID], [asset], Timeframe.ONE_MIN, START, tea_store=gappy,
+            report_gaps=True)
+        assert len(feed) == 7
+        assert 'Coverage' in capsys.readouterr().out
+
+
+class TestAlignAssets:
+
+    def make_dfs(self):
+        eth = ohlcv_feed.make_asset_df(
+            make_ohlcv_rows(5), Asset.from_symbol('ETH/BTC'), EX_ID)
+        ltc_rows = make_ohlcv_rows(5, start=START+datetime.timedelta(minutes=2))
+        ltc = ohlcv_feed.make_asset_df(
+            ltc_rows, Asset.from_symbol('LTC/BTC'), EX_ID)
+        return eth, ltc
+
+    def test_outer_keeps_later_timestamps(self):
+        eth, ltc = self.make_dfs()
+        epochs, values, column_map = ohlcv_feed.align_asset_dfs(
+            [eth, ltc], 'outer')
+        assert len(epochs) == 7
+        assert values.shape == (7, 10)
+        assert values.flags['C_CONTIGUOUS']
+        eth_close = column_map.offset('close', 'ETH/BTC', EX_ID)
+        ltc_close = column_map.offset('close', 'LTC/BTC', EX_ID)
+        assert list(values[:5, eth_close]) == [1, 2, 3, 4, 5]
+        assert pd.isnull(values[5:, eth_close]).all()
+        assert pd.isnull(values[:2, ltc_close]).all()
+        assert list(values[2:, ltc_close]) == [1, 2, 3, 4, 5]
+
+    def test_inner(self):
+        eth, ltc = self.make_dfs()
+        epochs, values, column_map = ohlcv_feed.align_asset_dfs(
+            [eth, ltc], 'inner')
+        assert list(epochs) == list(eth.index[2:])
+        assert not pd.isnull(values).any()
+
+    def test_repeated_asset(self, tmpdir):
+        store = tea_store.OHLCVTeaStore(str(tmpdir))
+        btc = Asset.from_symbol('BTC/USDT')
+        df = ohlcv_feed.make_asset_df(make_ohlcv_rows(5), btc, EX_ID)
+        ohlcv_feed.save_asset_tea(store, df, btc, EX_ID, Timeframe.ONE_MIN)
+
+        feed = OHLCVFeed(start=START)
+        feed.initialize()
+        feed.ohlcv_df = ohlcv_feed.load_multiple_assets(
+            [EX_ID], [btc, btc], Timeframe.ONE_MIN, START,
+            tea_store=store)
+
+        assert feed.column_map.names == list(df.columns.drop('utc'))
+        bar = feed.next()
+        assert bar.get('close', btc.symbol, EX_ID) == 1
+        assert bar.get('volume', btc.symbol, EX_ID) == 0
+        with pytest.raises(AssertionError):
+            ohlcv_feed.align_asset_dfs([df, df])
+
+
+class TestCrossRates:
+
+    def make_df(self):
+        eth = ohlcv_feed.make_asset_df(
+            make_ohlcv_rows(5), Asset.from_symbol('ETH/BTC'), EX_ID)
+        btc = ohlcv_feed.make_asset_df(
+            make_ohlcv_rows(5), Asset.from_symbol('BTC/USDT'), EX_ID)
+        epochs, values, column_map = ohlcv_feed.align_asset_dfs([eth, btc])
+        return pd.DataFrame(values, index=epochs, columns=column_map.names)
+
+    def test_cash_value(self):
+        df = self.make_df()
+        eth_close = df[ohlcv_feed.get_col_name('close', 'ETH/BTC', EX_ID)]
+        btc_close = df[ohlcv_feed.get_col_name('close', 'BTC/USDT', EX_ID)]
+        value = ohlcv_feed.get_cash_value(
+            df, 'close', Asset.from_symbol('ETH/BTC'), EX_ID, 'USD')
+        assert list(value) == list(eth_close * btc_close)
+
+    def test_rates(self):
+        df = self.make_df()
+        rates = ohlcv_feed.CrossRates(df)
+        btc_close = df[ohlcv_feed.get_col_name('close', 'BTC/USDT', EX_ID)]
+        eth_close = df[ohlcv_feed.get_col_name('close', 'ETH/BTC', EX_ID)]
+        assert list(rates.rate('USD', 'BTC', EX_ID)) == list(1.0 / btc_close)
+        assert list(rates.rate('ETH', 'USDT', EX_ID)) == list(
+            eth_close * btc_close)
+        assert list(ohlcv_feed.get_exchange_rate(
+            df, 'BTC', 'BTC', EX_ID)) == [1.0] * 5
@@ -0,0 +1,99 @@
+import os
+import time
+
+import numpy as np
+
+from punisher.data import ohlcv_cache
+from punisher.feeds import ohlcv_feed
+from punisher.portfolio.asset import Asset
+from punisher.utils.dates import Timeframe
+
+from .test_feed import make_ohlcv_rows, EX_ID
+
+
+def make_asset_df(n_rows):
+    asset = Asset.from_symbol('ETH/BTC')
+    return ohlcv_feed.make_asset_df(make_ohlcv_rows(n_rows), asset, EX_ID)
+
+
+class TestOHLCVCache:
+
+    def test_save_load(self, tmpdir):
+        fpath = os.path.join(str(tmpdir), 'binance_ETH_BTC_1m.csv')
+        df = make_asset_df(10)
+        ohlcv_feed.save_asset(df, fpath)
+        assert ohlcv_cache.is_fresh(fpath)
+
+        loaded = ohlcv_feed.load_asset(fpath)
+        assert list(loaded.index) == list(df.index)
+        assert list(loaded.columns) == list(df.columns)
+        assert (loaded['utc'].values == df['utc'].values).all()
+        for col in df.columns:
+            assert (loaded[col].values == df[col].values).all()
+
+    def test_converts_stale_csv(self, tmpdir):
+        fpath = os.path.join(str(tmpdir), 'binance_ETH_BTC_1m.csv')
+        make_asset_df(5).to_csv(fpath, index=True)
+        assert not ohlcv_cache.is_fresh(fpath)
+
+        loaded = ohlcv_feed.load_asset(fpath)
+        assert len(loaded) == 5
+        assert ohlcv_cache.is_fresh(fpath)
+
+        # Csv rewritten by another tool
+        time.sleep(0.01)
+        make_asset_df(7).to_csv(fpath, index=True)
+        os.utime(fpath, None)
+        assert len(ohlcv_feed.load_asset(fpath)) == 7
+
+
+class TestResample:
+
+    def test_derives_coarse_bars_from_base(self, tmpdir):
+        asset = Asset.from_symbol('ETH/BTC')
+        outdir = str(tmpdir)
+        base_fpath = ohlcv_feed.get_ohlcv_fpath(
+            asset, EX_ID, Timeframe.ONE_MIN, outdir)
+        # 12 minutes -> two complete 5m bars, the third is still forming
+        ohlcv_feed.save_asset(make_asset_df(12), base_fpath)
+
+        df = ohlcv_feed.load_resampled_asset(
+            EX_ID, asset, Timeframe.FIVE_MIN, outdir=outdir)
+        cols = ohlcv_feed.get_ohlcv_columns(asset, EX_ID)[1:]
+        assert list(df.index) == [
+            df.index[0], df.index[0] + Timeframe.FIVE_MIN.seconds]
+        assert list(df[cols].iloc[0]) == [0, 6, -1, 5, 100]
+        assert list(df[cols].iloc[1]) == [5, 11, 4, 10, 350]
+
+        fpath = ohlcv_feed.get_resampled_fpath(
+            asset, EX_ID, Timeframe.FIVE_MIN, Timeframe.ONE_MIN, outdir)
+        assert ohlcv_cache.is_fresh(
+            fpath, ohlcv_cache.get_stamp(base_fpath))
+
+        # Base grows, derived cache is rebuilt with the completed bar
+        time.sleep(0.01)
+        ohlcv_feed.save_asset(make_asset_df(15), base_fpath)
+        df = ohlcv_feed.load_resampled_asset(
+            EX_ID, asset, Timeframe.FIVE_MIN, outdir=outdir)
+        assert len(df) == 3
+
+    def test_start_off_boundary(self):
+        # 1m bars from minute 3 to 14, row i is [5i, 5i+1, ..., 5i+4]
+        base = np.arange(12 * 5, dtype=float).reshape(12, 5)
+        epochs, values = ohlcv_feed.resample_ohlcv(
+            np.arange(3, 15) * 60, base,
+            Timeframe.FIVE_MIN.seconds, Timeframe.ONE_MIN.seconds)
+        # Minutes 3-4 only cover part of the first bar
+        assert list(epochs) == [300, 600]
+        assert list(values[0]) == [10, 31, 12, 33, 120]
+        assert values[1][0] == 35
+
+        epochs, values = ohlcv_feed.resample_ohlcv(
+            np.arange(3, 5) * 60, np.ones((2, 5)),
+            Timeframe.FIVE_MIN.seconds, Timeframe.ONE_MIN.seconds)
+        assert len(epochs) == 0
+
+    def test_no_base_series(self, tmpdir):
+        asset = Asset.from_symbol('ETH/BTC')
+        assert ohlcv_feed.load_resampled_asset(
+            EX_ID, asset, Timeframe.ONE_HOUR, outdir=str(tmpdir)) is None
@@ -0,0 +1,83 @@
+import datetime
+
+import numpy as np
+
+from punisher.data import tea_store
+from punisher.feeds import ohlcv_feed
+from punisher.portfolio.asset import Asset
+from punisher.utils.dates import Timeframe
+
+from .test_feed import EX_ID, START, FakeOHLCVExchange
+from .test_ohlcv_cache import make_asset_df
+
+
+class TestOHLCVTeaStore:
+
+    def test_save_range(self, tmpdir):
+        store = tea_store.OHLCVTeaStore(str(tmpdir))
+        asset = Asset.from_symbol('ETH/BTC')
+        df = make_asset_df(10)
+        ohlcv_feed.save_asset_tea(store, df, asset, EX_ID, Timeframe.ONE_MIN)
+
+        records = store.read(EX_ID, asset, Timeframe.ONE_MIN)
+        assert isinstance(records, np.memmap)
+        assert len(records) == 10
+
+        start = START + datetime.timedelta(minutes=2)
+        end = START + datetime.timedelta(minutes=5)
+        loaded = ohlcv_feed.load_asset_tea(
+            store, EX_ID, asset, Timeframe.ONE_MIN, start, end)
+        expected = df.iloc[2:5]
+        assert list(loaded.index) == list(expected.index)
+        for col in expected.columns:
+            assert (loaded[col].values == expected[col].values).all()
+        close = ohlcv_feed.get_col_name('close', asset.symbol, EX_ID)
+        assert np.shares_memory(loaded[close].values, records)
+        assert not loaded[close].values.flags.writeable
+
+        # A single asset feed keeps viewing the memmap
+        feed = ohlcv_feed.OHLCVFileFeed(
+            [EX_ID], [asset], Timeframe.ONE_MIN, START, tea_store=store)
+        assert np.shares_memory(feed.values, records)
+        assert not feed.values.flags.writeable
+        assert feed.next().get('close', asset.symbol, EX_ID) == (
+            df[close].iloc[0])
+
+    def test_append(self, tmpdir):
+        store = tea_store.OHLCVTeaStore(str(tmpdir))
+        asset = Asset.from_symbol('ETH/BTC')
+        df = make_asset_df(10)
+        ohlcv_feed.save_asset_tea(
+            store, df.iloc[:6], asset, EX_ID, Timeframe.ONE_MIN)
+        # Last stored bar is refetched complete
+        close = ohlcv_feed.get_col_name('close', asset.symbol, EX_ID)
+        df.loc[df.index[5], close] = 100.0
+        records = ohlcv_feed.asset_df_to_tea_records(df, asset, EX_ID)
+        assert store.append(EX_ID, asset, Timeframe.ONE_MIN, records) == 4
+        stored = store.read(EX_ID, asset, Timeframe.ONE_MIN)
+        assert len(stored) == 10
+        assert stored['Close'][5] == 100.0
+        assert store.last_epoch(
+            EX_ID, asset, Timeframe.ONE_MIN) == df.index[-1]
+
+    def test_download_writes_tea(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(
+            ohlcv_feed, 'get_ohlcv_fpath',
+            lambda asset, ex_id, timeframe: tmpdir.join(
+                ohlcv_feed.get_ohlcv_fname(asset, ex_id, timeframe)))
+        store = tea_store.OHLCVTeaStore(str(tmpdir))
+        asset = Asset.from_symbol('ETH/BTC')
+        exchange = FakeOHLCVExchange(EX_ID, START, 10)
+        end = START + datetime.timedelta(minutes=6)
+
+        ohlcv_feed.download_ohlcv(
+            [exchange], [asset], Timeframe.ONE_MIN, START, end,
+            tea_store=store)
+        assert store.last_epoch(
+            EX_ID, asset, Timeframe.ONE_MIN) == exchange.rows[5][0] // 1000
+
+        end = START + datetime.timedelta(minutes=10)
+        ohlcv_feed.download_ohlcv(
+            [exchange], [asset], Timeframe.ONE_MIN, START, end,
+            update=True, tea_store=store)
+        assert len(store.read(EX_ID, asset, Timeframe.ONE_MIN)) == 10
@@ -0,0 +1,75 @@
+from datetime import datetime
+
+from punisher.exchanges.ccxt_exchange import CCXTExchange
+from punisher.exchanges.ex_cfg import BINANCE, GDAX, GEMINI, POLONIEX
+from punisher.exchanges.ex_cfg import EXCHANGE_CONFIGS
+from punisher.exchanges.limits import get_request_weight, get_max_workers
+from punisher.portfolio.asset import Asset
+from punisher.trading.order import OrderStatus
+
+
+class TestCreateOrder:
+
+    def make_exchange(self, response):
+        exchange = CCXTExchange(BINANCE, EXCHANGE_CONFIGS[BINANCE])
+        calls = []
+        def create_limit_buy_order(symbol, quantity, price, params):
+            calls.append('create_limit_buy_order')
+            return response
+        def fetch_order(*args):
+            calls.append('fetch_order')
+        exchange.client.create_limit_buy_order = create_limit_buy_order
+        exchange.client.fetch_order = fetch_order
+        return exchange, calls
+
+    def test_ack_builds_order(self):
+        exchange, calls = self.make_exchange({
+            'id': '123', 'status': 'open', 'datetime': None})
+        asset = Asset.from_symbol('ETH/BTC')
+
+        order = exchange.create_limit_buy_order(asset, 2.0, 0.05)
+
+        assert calls == ['create_limit_buy_order']
+        assert order.ex_order_id == '123'
+        assert order.status == OrderStatus.OPEN
+        assert order.quantity == 2.0
+        assert order.price == 0.05
+        assert order.filled_quantity == 0.0
+        assert order.trades == []
+        assert order.opened_time is not None
+
+    def test_ack_timestamp_opens_order(self):
+        exchange, calls = self.make_exchange({
+            'id': '123', 'status': 'open', 'datetime': None,
+            'timestamp': 1514764800000})
+        asset = Asset.from_symbol('ETH/BTC')
+        order = exchange.create_limit_buy_order(asset, 2.0, 0.05)
+        assert order.opened_time == datetime(2018, 1, 1)
+
+    def test_request_weights(self):
+        assert get_request_weight(BINANCE, 'fetch_tickers') == 40
+        assert get_request_weight(BINANCE, 'fetch_order') == 1.0
+        assert CCXTExchange(BINANCE, EXCHANGE_CONFIGS[BINANCE]).max_workers > 1
+
+    def test_nonce_signed_single_worker(self):
+        assert get_max_workers(POLONIEX) == 1
+        assert get_max_workers(GEMINI) == 1
+        assert get_max_workers(GDAX) > 1
+        assert CCXTExchange(GEMINI, EXCHANGE_CONFIGS[GEMINI]).max_workers == 1
+
+
+class TestFetchOpenOrders:
+
+    def test_all_open_orders_without_symbol(self):
+        exchange = CCXTExchange(BINANCE, EXCHANGE_CONFIGS[BINANCE])
+        requests = []
+        def private_get_open_orders(request):
+            requests.append(request)
+            return []
+        exchange.client.load_markets = lambda *args, **kwargs: {}
+        exchange.client.privateGetOpenOrders = private_get_open_orders
+
+        orders = exchange.fetch_open_orders(None, trades=False)
+
+        assert orders == []
+        assert requests == [{}]
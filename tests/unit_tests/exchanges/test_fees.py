@@ -0,0 +1,46 @@
+import datetime
+
+from punisher.exchanges import fees
+from punisher.exchanges.ex_cfg import BINANCE
+from punisher.exchanges.fees import FeeSchedule, FeeTracker
+from punisher.portfolio.asset import Asset
+from punisher.trading import coins
+from punisher.trading.trade import Trade, TradeSide
+
+START = datetime.datetime(year=2018, month=1, day=1)
+
+
+def make_trade(symbol, quantity, price, days):
+    return Trade(None, BINANCE, None, Asset.from_symbol(symbol), quantity,
+                 price, START + datetime.timedelta(days=days),
+                 TradeSide.BUY, 0.0)
+
+
+class TestFeeTracker:
+
+    def test_tiers_follow_rolling_volume(self):
+        schedule = FeeSchedule(
+            [[100, 0.0009, 0.002], [0, 0.001, 0.003]], coins.BTC)
+        tracker = FeeTracker(schedule)
+        assert tracker.get_rate('maker') == 0.001
+        assert tracker.get_rate(None) == 0.003
+
+        tracker.add_trade(make_trade('ETH/BTC', 1000.0, 0.06, days=0))
+        tracker.add_trade(make_trade('BTC/USDT', 50.0, 10000.0, days=10))
+        # Not quoted in BTC, doesn't count
+        tracker.add_trade(make_trade('ETH/USDT', 100.0, 500.0, days=10))
+        assert tracker.volume == 110.0
+        assert tracker.get_rate('taker') == 0.002
+
+        # The first trade leaves the 30 day window
+        later = START + datetime.timedelta(days=31)
+        assert tracker.get_rate('taker', later) == 0.003
+        assert tracker.volume == 50.0
+
+    def test_load_schedule(self, tmpdir):
+        schedule = fees.load_fee_schedule(BINANCE, outdir=str(tmpdir))
+        assert schedule.volume_coin == coins.BTC
+        assert schedule.get_tier(0)[1:] == [0.001, 0.001]
+
+        unknown = fees.load_fee_schedule('unknown', outdir=str(tmpdir))
+        assert unknown.get_tier(1e9)[1:] == [0.0, 0.0]
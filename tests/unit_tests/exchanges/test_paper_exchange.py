@@ -0,0 +1,467 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from punisher.exchanges.data_providers import CCXTExchangeDataProvider
+from punisher.exchanges.data_providers import FeedExchangeDataProvider
+from punisher.exchanges.fees import ZERO_FEES, FeeSchedule, FeeTracker
+from punisher.exchanges.latency import LatencyModel
+from punisher.exchanges.paper_exchange import LimitBook, PaperExchange
+from punisher.feeds import ohlcv_feed
+from punisher.feeds.order_book_feed import BookReplay
+from punisher.portfolio.asset import Asset
+from punisher.portfolio.balance import Balance, BalanceType
+from punisher.trading import coins
+from punisher.trading.order import ExchangeOrder, OrderStatus, OrderType
+from punisher.utils.dates import Timeframe, utc_to_epoch
+
+EX_ID = 'binance'
+ASSET = Asset.from_symbol('BTC/USDT')
+START = datetime.datetime(year=2018, month=1, day=1)
+
+
+@pytest.fixture
+def make_exchange(make_feed):
+    """Factory for a PaperExchange trading ASSET over `bars`"""
+    def make(bars, participation=0.5, latency=None, fees=ZERO_FEES):
+        feed = make_feed(bars, ASSET, EX_ID)
+        balance = Balance(coins.USDT, 100000.0)
+        balance.add_currency(coins.BTC)
+        balance.update(coins.BTC, 10.0, 0.0)
+        exchange = PaperExchange(
+            EX_ID, balance, FeedExchangeDataProvider(feed, EX_ID),
+            participation=participation,
+            fees=FeeTracker(FeeSchedule.from_dict(fees)),
+            latency=latency)
+        return exchange, feed
+    return make
+
+def make_order(price, quantity, order_type=OrderType.LIMIT_BUY):
+    return ExchangeOrder(None, EX_ID, ASSET, quantity, price, 0.0,
+                         order_type, OrderStatus.OPEN)
+
+
+class TestLimitBook:
+
+    def test_price_time_priority(self):
+        book = LimitBook()
+        first = make_order(100.0, 1.0)
+        second = make_order(100.0, 1.0)
+        better = make_order(101.0, 1.0)
+        far = make_order(90.0, 1.0)
+        for order in [first, second, better, far]:
+            book.add(order)
+
+        fills = book.match(high=105.0, low=99.0, max_quantity=2.5)
+
+        assert [(o, q) for o, q in fills] == [
+            (better, 1.0), (first, 1.0), (second, 0.5)]
+        assert book.orders['buy'] == [second, far]
+        assert list(book.remaining['buy']) == [0.5, 1.0]
+
+    def test_queue_ahead_at_touch(self):
+        book = LimitBook()
+        touch = make_order(95.0, 1.0)
+        through = make_order(96.0, 1.0)
+        book.add(touch, queue_ahead=3.0)
+        book.add(through, queue_ahead=3.0)
+
+        # Traded through 96, only touched 95
+        fills = book.match(high=100.0, low=95.0, max_quantity=2.0)
+        assert fills == [(through, 1.0)]
+        assert list(book.queue['buy']) == [1.0]
+
+        fills = book.match(high=100.0, low=95.0, max_quantity=2.0)
+        assert fills == [(touch, 1.0)]
+        assert len(book) == 0
+
+        book.add(touch)
+        assert book.remove(touch)
+        assert not book.remove(touch)
+
+    def test_skips_orders_opened_during_bar(self):
+        book = LimitBook()
+        early = make_order(95.0, 1.0)
+        early.opened_time = START
+        late = make_order(96.0, 1.0)
+        late.opened_time = START + datetime.timedelta(seconds=30)
+        book.add(early, queue_ahead=1.0)
+        book.add(late, queue_ahead=1.0)
+
+        # Bar opened before `late` was placed, its range traded before it
+        bar_epoch = utc_to_epoch(START + datetime.timedelta(seconds=10))
+        fills = book.match(high=100.0, low=95.0, max_quantity=2.0,
+                           bar_epoch=bar_epoch)
+        assert fills == [(early, 1.0)]
+        assert book.orders['buy'] == [late]
+        assert list(book.queue['buy']) == [1.0]
+
+        bar_epoch = utc_to_epoch(START + datetime.timedelta(seconds=60))
+        fills = book.match(high=100.0, low=95.0, max_quantity=2.0,
+                           bar_epoch=bar_epoch)
+        assert fills == [(late, 1.0)]
+
+
+class TestFeedDataProvider:
+
+    def test_ticker_from_latest_bar(self, make_feed):
+        feed = make_feed([(100, 110, 90, 105, 10), (105, 120, 95, 96, 4)])
+        provider = FeedExchangeDataProvider(feed, EX_ID)
+        feed.next()
+        feed.next()
+        feed.history = None
+
+        ticker = provider.fetch_ticker(ASSET)
+        assert ticker['high'] == 120 and ticker['low'] == 95
+        assert ticker['open'] == 105 and ticker['bid'] == 96
+        assert ticker['datetime'] == START + datetime.timedelta(minutes=1)
+        assert ticker['quoteVolume'] == 4 * 100.5
+
+
+class TestCCXTDataProvider:
+
+    def test_fetch_bar_skips_forming_candle(self):
+        class FakeExchange():
+            def fetch_ohlcv(self, asset, timeframe, start_utc):
+                now_ms = utc_to_epoch(datetime.datetime.utcnow()) * 1000
+                minute = now_ms - now_ms % 60000
+                return [[minute - 60000, 1, 2, 0.5, 1.5, 10],
+                        [minute, 1.5, 1.6, 1.4, 1.5, 1]]
+
+        bar = CCXTExchangeDataProvider(FakeExchange()).fetch_bar(ASSET)
+        assert bar['volume'] == 10
+        assert bar['utc'] < datetime.datetime.utcnow().replace(
+            second=0, microsecond=0)
+
+    def test_matches_once_per_closed_bar(self):
+        class FakeExchange():
+            calls = 0
+            def fetch_ohlcv(self, asset, timeframe, start_utc):
+                FakeExchange.calls += 1
+                return [[0, 100, 100, 100, 100, 10]]
+            def fetch_ticker(self, asset):
+                return {'ask': 100.0, 'bid': 100.0}
+
+        provider = CCXTExchangeDataProvider(FakeExchange())
+        bar_time = provider.get_bar_time()
+        assert bar_time.second == 0 and bar_time.microsecond == 0
+        assert bar_time < datetime.datetime.utcnow() - datetime.timedelta(
+            minutes=1)
+
+        provider.get_bar_time = lambda: START
+        balance = Balance(coins.USDT, 1000.0)
+        exchange = PaperExchange(
+            EX_ID, balance, provider,
+            fees=FeeTracker(FeeSchedule.from_dict(ZERO_FEES)))
+        exchange.create_limit_buy_order(ASSET, 1.0, 90.0)
+        exchange.create_limit_buy_order(ASSET, 1.0, 80.0)
+        for _ in range(5):
+            exchange.fetch_open_orders(ASSET)
+        assert FakeExchange.calls == 0
+
+        # One fetch for both orders once the next bar closes
+        provider.get_bar_time = lambda: START + datetime.timedelta(minutes=1)
+        for _ in range(5):
+            exchange.fetch_open_orders(ASSET)
+        assert FakeExchange.calls == 1
+
+
+class TestBarMatching:
+
+    def test_resting_limit_fills_on_later_bar(self, make_exchange):
+        bars = [(100, 100, 100, 100, 10),
+                (100, 101, 95, 96, 10),
+                (96, 97, 90, 91, 10)]
+        exchange, feed = make_exchange(bars)
+        feed.next()
+
+        order = exchange.create_limit_buy_order(ASSET, 8.0, 92.0)
+        assert order.status == OrderStatus.OPEN
+        assert order.filled_quantity == 0.0
+
+        feed.next()
+        assert exchange.fetch_order(order.ex_order_id, ASSET).trades == []
+
+        # Capped at half the bar's volume
+        feed.next()
+        order = exchange.fetch_order(order.ex_order_id, ASSET)
+        assert order.filled_quantity == 5.0
+        assert order.status == OrderStatus.OPEN
+        exchange.fetch_order(order.ex_order_id, ASSET)
+        assert order.filled_quantity == 5.0
+        assert exchange.balance.get(coins.BTC)[BalanceType.TOTAL] == 15.0
+
+    def test_marketable_limit_fills_immediately(self, make_exchange):
+        exchange, feed = make_exchange([(100, 100, 100, 100, 10)])
+        feed.next()
+
+        order = exchange.create_limit_sell_order(ASSET, 1.0, 99.0)
+
+        assert order.status == OrderStatus.FILLED
+        assert order.filled_quantity == 1.0
+        assert order.trades[0].price == 100.0
+        assert exchange.books == {}
+        usdt = exchange.balance.get(coins.USDT)
+        assert usdt[BalanceType.FREE] == 100000.0 + 100.0
+
+    def test_marketable_limit_fills_at_open(self, make_exchange):
+        bars = [(100, 100, 100, 100, 10), (95, 96, 94, 95, 10)]
+        exchange, feed = make_exchange(
+            bars, latency=LatencyModel(ack=[0.5, 0.0]))
+        feed.next()
+
+        # Holds funds at the limit, fills at the lower open
+        order = exchange.create_limit_buy_order(ASSET, 2.0, 101.0)
+        assert exchange.balance.get(coins.USDT)[BalanceType.USED] == 202.0
+        feed.next()
+        exchange.fetch_order(order.ex_order_id, ASSET)
+
+        assert order.status == OrderStatus.FILLED
+        assert order.trades[0].price == 95.0
+        usdt = exchange.balance.get(coins.USDT)
+        assert usdt[BalanceType.USED] == 0.0
+        assert usdt[BalanceType.FREE] == 100000.0 - 190.0
+
+    def test_buy_fees_release_held_funds(self, make_exchange):
+        fees = {'volume_coin': None, 'tiers': [[0, 0.001, 0.002]]}
+        bars = [(100, 100, 100, 100, 10), (100, 100, 90, 95, 10)]
+        exchange, feed = make_exchange(bars, fees=fees)
+        feed.next()
+
+        exchange.create_market_buy_order(ASSET, 1.0)
+        order = exchange.create_limit_buy_order(ASSET, 2.0, 92.0)
+        feed.next()
+        order = exchange.fetch_order(order.ex_order_id, ASSET)
+        assert order.status == OrderStatus.FILLED
+
+        # Taker fee .2 on the market buy, maker fee .184 on the limit
+        usdt = exchange.balance.get(coins.USDT)
+        assert usdt[BalanceType.USED] == 0.0
+        assert np.isclose(usdt[BalanceType.FREE], 100000.0 - 284.384)
+
+    def test_fetch_ohlcv_pages(self, make_exchange):
+        bars = [(i, i + 2, i - 1, i + 1, 10.0) for i in range(1200)]
+        exchange, feed = make_exchange(bars)
+        for _ in range(1100):
+            feed.next()
+
+        rows = exchange.fetch_ohlcv(ASSET, Timeframe.ONE_MIN, START, limit=3)
+        assert rows[-1] == [(utc_to_epoch(START) + 120) * 1000,
+                            2.0, 4.0, 1.0, 3.0, 10.0]
+
+        # Pages of binance's 500 bars, only what the feed has vended
+        end = START + datetime.timedelta(minutes=1200)
+        df, missing = ohlcv_feed.backfill_asset(
+            exchange, ASSET, Timeframe.ONE_MIN, START, end)
+        assert len(df) == 1100
+        assert list(df['open_BTC/USDT_binance'][-2:]) == [1098, 1099]
+        assert missing == [(START + datetime.timedelta(minutes=1100), end)]
+
+
+def make_replay():
+    epoch_ms = utc_to_epoch(START) * 1000
+    return BookReplay.from_snapshots([
+        {'timestamp': epoch_ms,
+         'asks': [[101.0, 1.0], [102.0, 2.0]],
+         'bids': [[99.0, 1.0], [98.0, 1.0]]},
+        {'timestamp': epoch_ms + 60000,
+         'asks': [[110.0, 5.0]],
+         'bids': [[90.0, 5.0]]},
+    ])
+
+
+class TestBookReplay:
+
+    def test_fill_walks_snapshot_in_effect(self, tmpdir):
+        replay = make_replay()
+        epoch_ms = utc_to_epoch(START) * 1000
+
+        prices, filled = replay.fill(
+            'buy', [0.5, 2.0, 5.0, 1.0],
+            [epoch_ms, epoch_ms + 30000, epoch_ms, epoch_ms - 1])
+
+        assert np.allclose(prices[:3], [101.0, 101.5, 101 / 3 + 68.0])
+        assert np.allclose(filled, [0.5, 2.0, 3.0, 0.0])
+        assert np.isnan(prices[3])
+
+        fpath = str(tmpdir.join('book.npz'))
+        replay.save(fpath)
+        prices, filled = BookReplay.load(fpath).fill(
+            'sell', [2.0], [epoch_ms + 60000])
+        assert prices[0] == 90.0 and filled[0] == 2.0
+
+    def test_market_order_slippage(self, make_exchange):
+        exchange, feed = make_exchange([(100, 100, 100, 100, 10)])
+        exchange.order_books[ASSET.symbol] = make_replay()
+        feed.next()
+
+        order = exchange.create_market_buy_order(ASSET, 2.0)
+        assert order.price == 101.5
+        assert order.status == OrderStatus.FILLED
+
+        order = exchange.create_market_sell_order(ASSET, 3.0)
+        assert order.price == 98.5
+        assert order.filled_quantity == 2.0
+        assert order.status == OrderStatus.CANCELED
+        btc = exchange.balance.get(coins.BTC)
+        assert btc[BalanceType.TOTAL] == 10.0
+        assert btc[BalanceType.USED] == 0.0
+
+    def test_market_order_before_replay(self, make_exchange):
+        exchange, feed = make_exchange([(100, 100, 100, 100, 10)])
+        replay = make_replay()
+        replay.epochs = replay.epochs + 3600 * 1000
+        exchange.order_books[ASSET.symbol] = replay
+        feed.next()
+
+        # No snapshot in effect yet, fills at the ticker
+        order = exchange.create_market_buy_order(ASSET, 2.0)
+        assert order.price == 100.0
+        assert order.status == OrderStatus.FILLED
+
+
+class TestPaperOrderStore:
+
+    def test_indexes_and_archive(self, make_exchange):
+        exchange, feed = make_exchange(
+            [(100, 100, 100, 100, 100), (100, 100, 90, 95, 100)],
+            participation=1.0)
+        exchange.orders.max_archived = 2
+        feed.next()
+        resting = exchange.create_limit_buy_order(ASSET, 1.0, 91.0)
+        filled = [exchange.create_limit_buy_order(ASSET, 1.0, 100.0)
+                  for i in range(2)]
+
+        assert exchange.fetch_open_orders(ASSET) == [resting]
+        assert exchange.fetch_closed_orders(ASSET) == filled
+        assert len(exchange.fetch_my_trades(ASSET)) == 2
+
+        # Oldest filled order drops out once the resting one fills
+        feed.next()
+        assert exchange.fetch_open_orders(ASSET) == []
+        assert exchange.fetch_closed_orders(ASSET) == [filled[1], resting]
+        assert exchange.fetch_order(filled[0].ex_order_id, ASSET) is None
+        assert exchange.fetch_order(resting.ex_order_id, ASSET) is resting
+        assert len(exchange.orders) == 2
+
+
+class TestLatency:
+
+    def test_no_latency_by_default(self, make_exchange):
+        exchange, feed = make_exchange([(100, 100, 100, 100, 10)])
+        feed.next()
+        assert exchange.latency.get_order_delay().total_seconds() == 0.0
+        order = exchange.create_market_buy_order(ASSET, 1.0)
+        assert order.status == OrderStatus.FILLED
+        assert LatencyModel.from_config(EX_ID).delays['ack'][0] > 0
+
+    def test_market_order_fills_at_next_open(self, make_exchange):
+        bars = [(100, 100, 100, 100, 10), (105, 106, 104, 105, 10)]
+        exchange, feed = make_exchange(
+            bars, latency=LatencyModel(ack=[0.5, 0.0]))
+        feed.next()
+
+        order = exchange.create_market_buy_order(ASSET, 1.0)
+        assert order.status == OrderStatus.OPEN
+        assert exchange.balance.get(coins.USDT)[BalanceType.USED] == 100.0
+
+        feed.next()
+        order = exchange.fetch_order(order.ex_order_id, ASSET)
+        assert order.status == OrderStatus.FILLED
+        assert order.price == 105.0
+        usdt = exchange.balance.get(coins.USDT)
+        assert usdt[BalanceType.USED] == 0.0
+        assert usdt[BalanceType.TOTAL] == 100000.0 - 105.0
+
+    def test_order_fills_until_cancel_arrives(self, make_exchange):
+        bars = [(100, 100, 100, 100, 10),
+                (100, 100, 90, 95, 10),
+                (95, 95, 80, 85, 10)]
+        exchange, feed = make_exchange(
+            bars, participation=1.0,
+            latency=LatencyModel(cancel=[90.0, 0.0]))
+        feed.next()
+        order = exchange.create_limit_buy_order(ASSET, 20.0, 91.0)
+
+        assert exchange.cancel_order(order.ex_order_id) is order
+        assert order.status == OrderStatus.OPEN
+
+        # Cancel takes effect on the bar after this one
+        feed.next()
+        exchange.fetch_order(order.ex_order_id, ASSET)
+        assert order.filled_quantity == 10.0
+        assert order.status == OrderStatus.OPEN
+
+        feed.next()
+        exchange.fetch_order(order.ex_order_id, ASSET)
+        assert order.filled_quantity == 10.0
+        assert order.status == OrderStatus.CANCELED
+        assert exchange.books[ASSET.symbol].orders['buy'] == []
+        assert exchange.balance.get(coins.USDT)[BalanceType.USED] == 0.0
+
+    def test_cancel_before_pending_order_arrives(self, make_exchange):
+        bars = [(100, 100, 100, 100, 10), (95, 96, 90, 95, 10)]
+        exchange, feed = make_exchange(
+            bars, participation=1.0,
+            latency=LatencyModel(ack=[30.0, 0.0], cancel=[10.0, 0.0]))
+        feed.next()
+        marketable = exchange.create_limit_buy_order(ASSET, 1.0, 101.0)
+        resting = exchange.create_limit_buy_order(ASSET, 1.0, 92.0)
+        exchange.cancel_order(marketable.ex_order_id)
+        exchange.cancel_order(resting.ex_order_id)
+
+        # Orders and cancels all reach the exchange before the next bar
+        feed.next()
+        exchange.fetch_open_orders(ASSET)
+        for order in [marketable, resting]:
+            assert order.status == OrderStatus.CANCELED
+            assert order.trades == []
+        assert ASSET.symbol not in exchange.books
+        usdt = exchange.balance.get(coins.USDT)
+        assert usdt[BalanceType.FREE] == 100000.0
+        assert usdt[BalanceType.USED] == 0.0
+
+    def test_cancel_without_latency(self, make_exchange):
+        exchange, feed = make_exchange([(100, 100, 100, 100, 10)])
+        feed.next()
+        order = exchange.create_limit_sell_order(ASSET, 2.0, 110.0)
+
+        exchange.cancel_order(order.ex_order_id)
+
+        assert order.status == OrderStatus.CANCELED
+        assert exchange.fetch_open_orders(ASSET) == []
+        assert exchange.balance.get(coins.BTC)[BalanceType.FREE] == 10.0
+
+    def test_queue_from_recorded_book(self, make_exchange):
+        bars = [(100, 100, 100, 100, 10), (100, 100, 99, 99, 4)]
+        exchange, feed = make_exchange(bars, participation=1.0)
+        exchange.order_books[ASSET.symbol] = make_replay()
+        feed.next()
+
+        # 1.0 displayed at 99 ahead of us, 4 traded at the touch
+        order = exchange.create_limit_buy_order(ASSET, 5.0, 99.0)
+        assert exchange.books[ASSET.symbol].queue['buy'][0] == 1.0
+
+        feed.next()
+        exchange.fetch_order(order.ex_order_id, ASSET)
+        assert order.filled_quantity == 3.0
+
+    def test_rejects_repriced_buy_without_funds(self, make_exchange):
+        bars = [(100, 100, 100, 100, 10), (105, 106, 104, 105, 10)]
+        exchange, feed = make_exchange(
+            bars, latency=LatencyModel(ack=[0.5, 0.0]))
+        feed.next()
+
+        # Holds every USDT at the ticker, the next open is 5% higher
+        order = exchange.create_market_buy_order(ASSET, 1000.0)
+        assert exchange.balance.get(coins.USDT)[BalanceType.FREE] == 0.0
+
+        feed.next()
+        exchange.fetch_order(order.ex_order_id, ASSET)
+        assert order.status == OrderStatus.KILLED
+        assert order.filled_quantity == 0.0
+        usdt = exchange.balance.get(coins.USDT)
+        assert usdt[BalanceType.FREE] == 100000.0
+        assert usdt[BalanceType.USED] == 0.0
+        assert exchange.fetch_closed_orders(ASSET) == [order]
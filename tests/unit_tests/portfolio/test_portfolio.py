@@ -5,6 +5,15 @@ from copy import deepcopy
 from punisher.trading.order_manager import (build_limit_buy_order,
                                             build_limit_sell_order,
                                             process_orders)
+from punisher.portfolio.asset import Asset
+from punisher.portfolio.balance import Balance, BalanceType
+from punisher.portfolio.performance import PerformanceTracker
+from punisher.portfolio.portfolio import Portfolio
+from punisher.trading import coins
+from punisher.trading.order import Order, OrderStatus, OrderType
+from punisher.trading.trade import Trade, TradeSide
+from punisher.utils.dates import Timeframe
+
 class TestSingleExchangePortfolio:
 
     def test_portfolio(self, portfolio, paperexchange):
@@ -91,3 +100,37 @@ class TestSingleExchangePortfolio:
         assert portfolio.positions[0].cost_value == 19000
         # position.market_value - position.cost_value = pnl
         assert portfolio.perf.pnl == -1000 # price went down
+
+
+class TestTradeCursor:
+
+    def make_trade(self, asset, quantity, price):
+        return Trade(None, 'paper', 'ex1', asset, quantity, price,
+                     None, TradeSide.BUY, 0.0)
+
+    def test_trades_applied_once(self):
+        asset = Asset.from_symbol('BTC/USDT')
+        balance = Balance(coins.USDT, 30000.0)
+        portfolio = Portfolio(
+            coins.USDT, balance,
+            PerformanceTracker(30000.0, Timeframe.ONE_MIN))
+        order = Order('paper', asset, 10000.0, 2.0,
+                      OrderType.LIMIT_BUY, None)
+        portfolio.balance.update_with_created_order(order)
+        order.status = OrderStatus.OPEN
+        order.trades = [self.make_trade(asset, 1.0, 10000.0)]
+
+        portfolio.update_positions([order])
+        portfolio.update_positions([order])
+        assert portfolio.get_position(asset).quantity == 1.0
+        assert portfolio.balance.get(coins.BTC)[BalanceType.TOTAL] == 1.0
+
+        # Syncing replaces the trade list with the exchange's full list
+        order.trades = order.trades + [self.make_trade(asset, 1.0, 10000.0)]
+        assert len(order.get_new_trades()) == 1
+        portfolio.update_positions([order])
+        assert portfolio.get_position(asset).quantity == 2.0
+        assert portfolio.balance.get(coins.BTC)[BalanceType.TOTAL] == 2.0
+        assert portfolio.balance.get(coins.USDT)[BalanceType.TOTAL] == 10000.0
+        assert order.get_new_trades() == []
+        assert Order.from_dict(order.to_dict()).trades_consumed == 2
@@ -1,9 +1,17 @@
 import math
+import threading
+import time
+import uuid
 import pytest
 from copy import deepcopy
 from punisher.trading import coins
-from punisher.trading.order import OrderStatus
-from punisher.portfolio.balance import BalanceType
+from punisher.portfolio.asset import Asset
+from punisher.trading.order import Order, ExchangeOrder
+from punisher.trading.order import OrderStatus, OrderType
+from punisher.portfolio.balance import Balance, BalanceType
+from punisher.portfolio.performance import PerformanceTracker
+from punisher.portfolio.portfolio import Portfolio
+from punisher.utils.dates import Timeframe
 import punisher.trading.order_manager as om
 
 
@@ -120,3 +128,247 @@ class TestGetOrdersByTypes:
     # get the filled order among other non-filled
     # get multiple filled orders
     # No filled orders
+
+
+class FakeOrderExchange():
+    id = 'fake'
+
+    def __init__(self):
+        self.fetched = []
+
+    def create_limit_buy_order(self, asset, quantity, price):
+        return self.make_ex_order(asset, quantity, price)
+
+    def fetch_order(self, ex_order_id, asset):
+        self.fetched.append(ex_order_id)
+        return self.make_ex_order(asset, 1.0, 1.0, ex_order_id)
+
+    def make_ex_order(self, asset, quantity, price, ex_order_id=None):
+        return ExchangeOrder(
+            ex_order_id=ex_order_id or 'ex' + str(len(self.fetched)),
+            exchange_id=self.id, asset=asset, quantity=quantity,
+            price=price, filled_quantity=0.0,
+            order_type=OrderType.LIMIT_BUY, status=OrderStatus.OPEN)
+
+
+class FakeBalance():
+    def update_with_created_orders(self, orders):
+        pass
+
+
+class TestOrderRegistry:
+
+    def make_order(self, symbol='ETH/BTC', status=OrderStatus.CREATED):
+        order = Order('fake', Asset.from_symbol(symbol), 1.0, 1.0,
+                      OrderType.LIMIT_BUY, None)
+        order.status = status
+        return order
+
+    def test_indexes(self):
+        created = self.make_order()
+        filled = self.make_order('BTC/USD', OrderStatus.FILLED)
+        registry = om.OrderRegistry([created, filled])
+
+        assert len(registry) == 2
+        assert registry.get_created() == [created]
+        assert registry.get_active() == [created]
+        assert registry.get_by_asset(created.asset) == [created]
+        assert registry.get_by_asset(
+            filled.asset, [OrderStatus.OPEN]) == []
+
+        created.status = OrderStatus.OPEN
+        created.exchange_order_id = 'abc'
+        registry.update(created)
+        assert registry.get_created() == []
+        assert registry.get_open() == [created]
+        assert registry.get_by_ex_order_id('abc') is created
+
+    def test_process_orders_touches_active_orders(self):
+        exchange = FakeOrderExchange()
+        resting = self.make_order(status=OrderStatus.OPEN)
+        resting.exchange_order_id = 'resting'
+        registry = om.OrderRegistry([resting])
+        registry.add_all([
+            self.make_order(status=OrderStatus.FILLED) for i in range(5)])
+        new = self.make_order()
+        registry.add(new)
+
+        updated = om.process_orders(exchange, FakeBalance(), registry)
+
+        assert set(o.id for o in updated) == set([resting.id, new.id])
+        assert exchange.fetched == ['resting']
+        assert len(registry.get_open()) == 2
+        assert registry.get_by_ex_order_id(new.exchange_order_id) is new
+
+
+class SlowOrderExchange(FakeOrderExchange):
+    max_workers = 4
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def create_limit_buy_order(self, asset, quantity, price):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        return self.make_ex_order(asset, quantity, price, uuid.uuid4().hex)
+
+
+class TestConcurrentOrders:
+
+    def test_place_orders_concurrently(self):
+        exchange = SlowOrderExchange()
+        orders = [TestOrderRegistry().make_order() for i in range(8)]
+
+        placed = om.place_orders(exchange, orders)
+
+        assert placed == orders
+        assert exchange.max_active == 4
+        assert all(o.status == OrderStatus.OPEN for o in placed)
+        assert len(set(o.exchange_order_id for o in placed)) == 8
+
+    def test_serial_exchange(self):
+        exchange = SlowOrderExchange()
+        exchange.max_workers = 1
+        orders = [TestOrderRegistry().make_order() for i in range(3)]
+
+        om.place_orders(exchange, orders)
+
+        assert exchange.max_active == 1
+
+    def test_sells_placed_before_buys(self):
+        exchange = SlowOrderExchange()
+        sold = []
+        def create_limit_sell_order(asset, quantity, price):
+            time.sleep(0.05)
+            with exchange.lock:
+                sold.append(asset.symbol)
+            return exchange.make_ex_order(asset, quantity, price, 'sell')
+        def create_limit_buy_order(asset, quantity, price):
+            # Every sell funding the buys has been acknowledged
+            assert len(sold) == 2
+            return exchange.make_ex_order(asset, quantity, price, 'buy')
+        exchange.create_limit_sell_order = create_limit_sell_order
+        exchange.create_limit_buy_order = create_limit_buy_order
+        buys = [TestOrderRegistry().make_order() for i in range(2)]
+        sells = [TestOrderRegistry().make_order() for i in range(2)]
+        for order in sells:
+            order.order_type = OrderType.LIMIT_SELL
+        orders = [buys[0], sells[0], buys[1], sells[1]]
+
+        placed = om.place_orders(exchange, orders)
+
+        assert placed == orders
+        assert [o.exchange_order_id for o in placed] == [
+            'buy', 'sell', 'buy', 'sell']
+
+
+class ReconcileExchange(FakeOrderExchange):
+    all_open_orders = False
+
+    def __init__(self, ex_orders):
+        super().__init__()
+        self.ex_orders = ex_orders
+        self.open_requests = []
+
+    def fetch_open_orders(self, asset, trades=True):
+        self.open_requests.append(asset.symbol)
+        return [o for o in self.ex_orders if o.asset.symbol == asset.symbol]
+
+
+class TestReconcileOrders:
+
+    def make_open_order(self, symbol, ex_order_id):
+        order = TestOrderRegistry().make_order(symbol, OrderStatus.OPEN)
+        order.exchange_order_id = ex_order_id
+        return order
+
+    def test_reconcile_fetches_changed_orders(self):
+        unchanged = self.make_open_order('ETH/BTC', 'a')
+        partial = self.make_open_order('ETH/BTC', 'b')
+        closed = self.make_open_order('LTC/BTC', 'c')
+        exchange = ReconcileExchange([])
+        ex_a = exchange.make_ex_order(unchanged.asset, 1.0, 1.0, 'a')
+        ex_b = exchange.make_ex_order(partial.asset, 1.0, 1.0, 'b')
+        ex_b.filled_quantity = 0.5
+        exchange.ex_orders = [ex_a, ex_b]
+
+        changed = om.reconcile_orders(exchange, [unchanged, partial, closed])
+
+        assert sorted(exchange.open_requests) == ['ETH/BTC', 'LTC/BTC']
+        assert sorted(exchange.fetched) == ['b', 'c']
+        assert changed == [partial, closed]
+
+    def test_process_orders_reconcile_mode(self):
+        order = self.make_open_order('ETH/BTC', 'a')
+        exchange = ReconcileExchange([])
+        exchange.ex_orders = [exchange.make_ex_order(order.asset, 1.0, 1.0, 'a')]
+
+        updated = om.process_orders(
+            exchange, FakeBalance(), om.OrderRegistry([order]),
+            sync_mode=om.SyncMode.RECONCILE)
+
+        assert updated == [order]
+        assert exchange.fetched == []
+
+
+class FakeMarketsExchange():
+    id = 'fake'
+
+    def get_markets(self):
+        return [
+            {'symbol': 'ETH/BTC', 'precision': {'amount': 2},
+             'limits': {'amount': {'min': 0.1}, 'cost': {}}},
+            {'symbol': 'LTC/USDT', 'precision': {'amount': 0},
+             'limits': {'amount': {}, 'cost': {'min': 10.0}}},
+        ]
+
+
+class TestRebalancePortfolio:
+
+    def make_portfolio(self, btc):
+        balance = Balance(coins.USDT, 10000.0)
+        balance.add_currency(coins.BTC)
+        balance.update(coins.BTC, btc, 0.0)
+        return Portfolio(coins.USDT, balance,
+                         PerformanceTracker(10000.0, Timeframe.ONE_MIN))
+
+    def test_nets_quote_currencies(self):
+        portfolio = self.make_portfolio(btc=1.0)
+        prices = {'BTC/USDT': 5000.0, 'ETH/BTC': 0.05, 'LTC/USDT': 100.0}
+        weights = {'BTC/USDT': 0.5, 'ETH/BTC': 0.2, 'LTC/USDT': 0.001}
+
+        orders = om.rebalance_portfolio(
+            portfolio, FakeMarketsExchange(), weights, prices, None)
+
+        # 15000 total: ETH buy spends 0.6 BTC, BTC leg covers it
+        # LTC is under the market's 10.0 min cost
+        by_symbol = {o.asset.symbol: o for o in orders}
+        assert sorted(by_symbol) == ['BTC/USDT', 'ETH/BTC']
+        assert by_symbol['ETH/BTC'].quantity == 12.0
+        assert math.isclose(by_symbol['BTC/USDT'].quantity, 1.1)
+        assert all(o.order_type == OrderType.LIMIT_BUY for o in orders)
+
+    def test_tolerance_and_sells_first(self):
+        portfolio = self.make_portfolio(btc=2.0)
+        prices = {'BTC/USDT': 5000.0, 'LTC/USDT': 100.0}
+
+        orders = om.rebalance_portfolio(
+            portfolio, FakeMarketsExchange(),
+            {'LTC/USDT': 0.3, 'BTC/USDT': 0.1}, prices, None,
+            tolerance=0.05)
+        assert [o.order_type for o in orders] == [
+            OrderType.LIMIT_SELL, OrderType.LIMIT_BUY]
+        assert orders[0].quantity == 1.6
+        assert orders[1].quantity == 60.0
+
+        orders = om.rebalance_portfolio(
+            portfolio, FakeMarketsExchange(),
+            {'BTC/USDT': 0.48}, prices, None, tolerance=0.05)
+        assert orders == []
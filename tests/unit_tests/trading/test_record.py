@@ -0,0 +1,124 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from punisher.data.store import FileStore
+from punisher.feeds.ohlcv_feed import ColumnMap, OHLCVBar
+from punisher.portfolio.asset import Asset
+from punisher.portfolio.balance import Balance
+from punisher.portfolio.performance import PerformanceTracker
+from punisher.portfolio.portfolio import Portfolio
+from punisher.trading import coins
+from punisher.trading.order import Order, OrderType, OrderStatus
+from punisher.trading.record import OHLCVBuffer, Record, SavePolicy
+from punisher.utils.dates import Timeframe
+
+START = datetime.datetime(year=2018, month=1, day=1)
+
+
+def make_record(root, save_policy):
+    balance = Balance(cash_currency=coins.USDT, starting_cash=100.0)
+    portfolio = Portfolio(
+        cash_currency=coins.USDT,
+        starting_balance=balance,
+        perf_tracker=PerformanceTracker(100.0, Timeframe.ONE_MIN))
+    return Record({'experiment': 'journal'}, portfolio, portfolio.balance,
+                  FileStore(root), save_policy)
+
+def step(record, i):
+    """Simulates one bar of activity"""
+    utc = START + datetime.timedelta(minutes=i)
+    record.portfolio.perf.add_period(
+        utc, utc, 100.0 + i, record.portfolio.positions)
+    record.metrics.setdefault('SMA', []).append(float(i))
+    order = Order(
+        exchange_id='binance', asset=Asset.from_symbol('BTC/USDT'),
+        price=10.0 + i, quantity=1.0, order_type=OrderType.LIMIT_BUY,
+        created_time=utc)
+    record.orders[order.id] = order
+    record.ohlcv = pd.DataFrame(
+        {'close': [float(j) for j in range(i + 1)]},
+        index=pd.Index(range(i + 1), name='epoch'))
+    record.checkpoint()
+    return order
+
+
+class TestRecordJournal:
+
+    def test_load_snapshot_plus_tail(self, tmpdir):
+        root = str(tmpdir)
+        record = make_record(root, SavePolicy(every_n_bars=1, journal=True))
+        record.save()
+        orders = [step(record, i) for i in range(5)]
+        orders[0].status = OrderStatus.FILLED
+        record.save()
+
+        assert tmpdir.join('periods.jsonl').exists()
+        loaded = Record.load(root)
+        assert len(loaded.portfolio.perf.periods) == 5
+        assert loaded.portfolio.perf.pnl == 4.0
+        assert loaded.metrics['SMA'] == [0., 1., 2., 3., 4.]
+        assert len(loaded.orders) == 5
+        assert loaded.orders[orders[0].id].status == OrderStatus.FILLED
+        assert len(loaded.ohlcv) == 5
+
+    def test_compaction(self, tmpdir):
+        root = str(tmpdir)
+        record = make_record(
+            root, SavePolicy(every_n_bars=1, journal=True, compact_every=3))
+        record.save()
+        for i in range(4):
+            step(record, i)
+        # 3rd journal save compacted into the snapshot, 4th is in the tail
+        assert len(tmpdir.join('periods.jsonl').readlines()) == 1
+        loaded = Record.load(root)
+        assert len(loaded.portfolio.perf.periods) == 4
+        assert loaded.metrics['SMA'] == [0., 1., 2., 3.]
+
+        record.close()
+        assert not tmpdir.join('periods.jsonl').exists()
+        assert len(Record.load(root).orders) == 4
+
+    def test_append_with_new_columns(self, tmpdir):
+        root = str(tmpdir)
+        record = make_record(root, SavePolicy(every_n_bars=1, journal=True))
+        record.ohlcv_buffer.append([0], [[1., 2.]], ['a', 'b'])
+        record.save()
+        record.ohlcv_buffer.append([60], [[3., 4.]], ['a', 'b'])
+        record.save()
+        record.ohlcv_buffer.append([120], [[5., 6.]], ['b', 'c'])
+        record.save()
+
+        df = Record.load(root).ohlcv
+        assert list(df.index) == [0, 60, 120]
+        assert list(df.columns) == ['a', 'b', 'c', 'utc']
+        assert list(df['b']) == [2., 4., 5.]
+        assert df['c'].iloc[2] == 6. and np.isnan(df['c'].iloc[0])
+
+
+class TestOHLCVBuffer:
+
+    def test_add_bars(self, tmpdir):
+        record = make_record(str(tmpdir), SavePolicy.on_exit())
+        record.ohlcv_buffer = OHLCVBuffer(capacity=2)
+        column_map = ColumnMap(['open_BTC/USDT_binance', 'close_BTC/USDT_binance'])
+        for i in range(5):
+            bar = OHLCVBar(np.array([i, i + 1.]), column_map, 60 * i)
+            record.add_ohlcv(bar)
+        assert record.ohlcv_buffer.capacity == 8
+
+        df = record.ohlcv
+        assert list(df.index) == [0, 60, 120, 180, 240]
+        assert list(df['close_BTC/USDT_binance']) == [1., 2., 3., 4., 5.]
+        assert df['utc'].iloc[1] == datetime.datetime(1970, 1, 1, 0, 1)
+        assert record.ohlcv is df
+
+    def test_new_columns(self):
+        buffer = OHLCVBuffer()
+        buffer.append([0], [[1., 2.]], ['a', 'b'])
+        buffer.append([60], [[3., 4.]], ['b', 'c'])
+        df = buffer.to_df()
+        assert list(df.columns) == ['a', 'b', 'c', 'utc']
+        assert list(df['b']) == [2., 3.]
+        assert np.isnan(df['a'].iloc[1]) and np.isnan(df['c'].iloc[0])
@@ -0,0 +1,195 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import punisher.config as cfg
+from punisher.feeds.ohlcv_feed import OHLCVFeed
+from punisher.portfolio.balance import Balance, BalanceType
+from punisher.portfolio.performance import PerformanceTracker
+from punisher.portfolio.portfolio import Portfolio
+from punisher.strategies.strategy import Strategy
+from punisher.trading import coins
+from punisher.trading import runner
+from punisher.trading import sweep
+from punisher.trading.record import Record, SavePolicy
+from punisher.utils.dates import Timeframe
+
+EX_ID = 'binance'
+START = datetime.datetime(year=2018, month=1, day=1)
+
+
+class FakeExchange():
+    id = EX_ID
+
+
+class HoldEveryOtherBar(Strategy):
+    def target_positions(self, data):
+        closes = data.col('close', 'BTC/USDT', EX_ID)
+        return {'BTC/USDT': np.arange(len(closes)) % 2 * 1.0}
+
+
+def make_bars(closes):
+    return [(c, c, c, c, 1.0) for c in closes]
+
+
+class TestVectorizedBacktest:
+
+    def test_fill_targets(self):
+        prices = np.array([[10.], [11.], [12.], [13.]])
+        targets = np.array([[1.], [1.], [0.], [2.]])
+        result = runner.fill_targets(prices, targets, 100.0, fee_rate=0.01)
+        assert np.allclose(result['fees'][:, 0], [.1, 0, .12, .26])
+        assert np.allclose(result['cash'], [89.9, 89.9, 101.78, 75.52])
+        assert np.allclose(
+            result['total_value'], [99.9, 100.9, 101.78, 101.52])
+
+    def test_fill_targets_before_listing(self):
+        prices = np.array([[10., np.nan], [11., np.nan], [12., 5.]])
+        targets = np.array([[1., 2.], [1., 2.], [1., 2.]])
+        result = runner.fill_targets(prices, targets, 100.0)
+        assert list(result['trades'][:, 1]) == [0., 0., 2.]
+        assert np.allclose(result['cash'], [90., 90., 80.])
+        assert np.allclose(result['total_value'], [100., 101., 102.])
+
+    def test_requires_target_positions(self, make_feed):
+        assert Strategy().target_positions(None) is None
+        with pytest.raises(Exception):
+            runner.backtest_vectorized(
+                'vectorized', FakeExchange(), None, None,
+                make_feed(make_bars([10.])), Strategy())
+
+    def test_backtest_vectorized(self, make_feed, tmpdir, monkeypatch):
+        monkeypatch.setattr(cfg, 'DATA_DIR', str(tmpdir))
+        balance = Balance(cash_currency=coins.USDT, starting_cash=100.0)
+        portfolio = Portfolio(
+            cash_currency=coins.USDT,
+            starting_balance=balance,
+            perf_tracker=PerformanceTracker(100.0, Timeframe.ONE_MIN))
+        feed = make_feed(make_bars([10., 12., 11., 15.]))
+
+        record = runner.backtest_vectorized(
+            'vectorized', FakeExchange(), portfolio.balance, portfolio,
+            feed, HoldEveryOtherBar())
+
+        # Bought at 12, sold at 11, bought at 15
+        periods = portfolio.perf.periods
+        assert len(periods) == 4
+        assert periods[0]['end_time'] == START
+        assert np.isclose(portfolio.perf.pnl, -1.0)
+        assert np.isclose(portfolio.cash, 84.0)
+        assert portfolio.balance.get(coins.BTC)[BalanceType.TOTAL] == 1.0
+        assert portfolio.positions[0].quantity == 1.0
+        assert record.config['mode'] == 'VECTORIZED'
+        # Results only, the price history isn't copied into the record
+        assert len(record.ohlcv) == 0
+
+
+class HoldFromBar(Strategy):
+    def __init__(self, start_bar):
+        super().__init__()
+        self.start_bar = start_bar
+
+    def target_positions(self, data):
+        targets = np.zeros(len(data))
+        targets[self.start_bar:] = 1.0
+        return {'BTC/USDT': targets}
+
+
+class TestSweep:
+
+    def test_make_grid(self):
+        grid = sweep.make_grid({'a': [1, 2], 'b': ['x', 'y', 'z']})
+        assert len(grid) == 6
+        assert grid[0] == {'a': 1, 'b': 'x'}
+        runs = sweep.sample_params({'a': [1, 2], 'b': (0., 1.)}, 5, seed=1)
+        assert len(runs) == 5
+        assert all(0. <= r['b'] <= 1. for r in runs)
+
+    def test_attach_ohlcv_views(self, make_feed):
+        feed = make_feed(make_bars([10., 12., 11., 15.]))
+        shared = sweep.SharedOHLCV(feed.ohlcv_df)
+        try:
+            df = sweep.attach_ohlcv(shared.spec)
+            segments = sweep._ATTACHED[shared.spec['values']][0]
+            shared_values = np.ndarray(
+                shared.shape, dtype=np.float64, buffer=segments[1].buf)
+            worker_feed = OHLCVFeed()
+            worker_feed.initialize()
+            worker_feed.ohlcv_df = df
+
+            assert np.shares_memory(worker_feed.values, shared_values)
+            assert np.shares_memory(worker_feed.epochs, np.ndarray(
+                (4,), dtype=np.int64, buffer=segments[0].buf))
+            assert not worker_feed.values.flags.writeable
+            assert list(df['close_BTC/USDT_binance']) == [10., 12., 11., 15.]
+            assert sweep.attach_ohlcv(shared.spec) is df
+        finally:
+            del shared_values
+            sweep._ATTACHED.pop(shared.spec['values'])
+            shared.close()
+
+    def test_sweep(self, make_feed, tmpdir, monkeypatch):
+        monkeypatch.setattr(cfg, 'DATA_DIR', str(tmpdir))
+        feed = make_feed(make_bars([10., 12., 11., 15.]))
+        results = sweep.sweep(
+            'sweep', HoldFromBar, sweep.make_grid({'start_bar': [0, 2]}),
+            feed, EX_ID, coins.USDT, 100.0, max_workers=2)
+        assert list(results['start_bar']) == [0, 2]
+        # Charged binance's 0.1% taker rate like the paper exchange
+        assert np.allclose(results['pnl'], [5.0 - .01, 4.0 - .011])
+        assert tmpdir.join('sweep', 'run_0001', 'portfolio.json').exists()
+        assert tmpdir.join('sweep', sweep.RESULTS_FNAME).exists()
+
+        results = sweep.sweep(
+            'no_fees', HoldFromBar, sweep.make_grid({'start_bar': [0, 2]}),
+            feed, EX_ID, coins.USDT, 100.0, max_workers=2, fee_rate=0.0)
+        assert np.allclose(results['pnl'], [5.0, 4.0])
+
+
+class CountingStore():
+    def __init__(self):
+        self.saves = 0
+
+    def save_json(self, name, dct):
+        if name == 'config':
+            self.saves += 1
+
+    def df_to_csv(self, df, name):
+        pass
+
+
+class TestSavePolicy:
+
+    def make_record(self, save_policy):
+        balance = Balance(cash_currency=coins.USDT, starting_cash=100.0)
+        portfolio = Portfolio(
+            cash_currency=coins.USDT,
+            starting_balance=balance,
+            perf_tracker=PerformanceTracker(100.0, Timeframe.ONE_MIN))
+        return Record({}, portfolio, portfolio.balance,
+                      CountingStore(), save_policy)
+
+    def test_every_n_bars(self):
+        record = self.make_record(SavePolicy(every_n_bars=3))
+        for i in range(10):
+            record.checkpoint()
+        assert record.store.saves == 3
+        record.close()
+        assert record.store.saves == 4
+
+    def test_on_exit(self):
+        record = self.make_record(SavePolicy.on_exit())
+        for i in range(10):
+            record.checkpoint()
+        assert record.store.saves == 0
+        record.close()
+        assert record.store.saves == 1
+
+    def test_interval(self):
+        record = self.make_record(SavePolicy(interval_sec=0.0))
+        record.checkpoint()
+        assert record.store.saves == 1
+        record.save_policy.interval_sec = 3600
+        record.checkpoint()
+        assert record.store.saves == 1